@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import time
+
+from app.settings import settings
+from app.store import redis_conn
+
+_ACTIVE_KEY = "bw:active"
+_BUCKET_KEY = "bw:bucket"
+
+# How long a job stays registered without a heartbeat (crashed workers drop out).
+_HEARTBEAT_SECONDS = 30
+
+# Token bucket shared by all workers. Reservation style: the request is always
+# debited and the caller sleeps for the returned deficit, so concurrent jobs
+# queue up fairly instead of retrying.
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+if now > ts then
+  tokens = math.min(capacity, tokens + (now - ts) * rate)
+  ts = now
+end
+tokens = tokens - requested
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(ts))
+redis.call('EXPIRE', KEYS[1], 60)
+if tokens >= 0 then
+  return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+def enabled() -> bool:
+    return settings.bandwidth_total_bytes_per_second > 0 or settings.bandwidth_per_job_bytes_per_second > 0
+
+
+class BandwidthLease:
+    """A job's slice of the cluster-wide download budget.
+
+    The share is recomputed from the number of registered jobs (total /
+    active, capped per job) and fed to yt-dlp's ``ratelimit``; bytes actually
+    transferred are also charged to a global token bucket so the total stays
+    within budget while shares are adjusting.
+    """
+
+    def __init__(self, job_id: str) -> None:
+        self.job_id = job_id
+        self._pending = 0
+        self._last_refresh = 0.0
+        self.rate: int | None = None
+        self._take = redis_conn().register_script(_TAKE_SCRIPT)
+
+    def refresh(self) -> int | None:
+        """Heartbeat and return the current per-job rate (bytes/s, None = unlimited)."""
+
+        r = redis_conn()
+        now = time.time()
+        pipe = r.pipeline()
+        pipe.zadd(_ACTIVE_KEY, {self.job_id: now + _HEARTBEAT_SECONDS})
+        pipe.zremrangebyscore(_ACTIVE_KEY, "-inf", now)
+        pipe.zcard(_ACTIVE_KEY)
+        active = max(1, int(pipe.execute()[2]))
+
+        rate = 0
+        total = settings.bandwidth_total_bytes_per_second
+        if total > 0:
+            rate = total // active
+        per_job = settings.bandwidth_per_job_bytes_per_second
+        if per_job > 0:
+            rate = min(rate, per_job) if rate else per_job
+        self.rate = max(1, rate) if rate else None
+        self._last_refresh = time.monotonic()
+        return self.rate
+
+    def due(self) -> bool:
+        return time.monotonic() - self._last_refresh >= settings.bandwidth_refresh_seconds
+
+    def consume(self, nbytes: int) -> None:
+        """Charge transferred bytes to the global bucket, sleeping if over budget."""
+
+        total = settings.bandwidth_total_bytes_per_second
+        if total <= 0 or nbytes <= 0:
+            return
+        self._pending += nbytes
+        if self._pending < settings.bandwidth_charge_bytes:
+            return
+        requested, self._pending = self._pending, 0
+        # One second of burst keeps short stalls from being "saved up" indefinitely.
+        wait = float(self._take(keys=[_BUCKET_KEY], args=[total, total, time.time(), requested]) or 0)
+        if wait > 0:
+            time.sleep(min(wait, 5.0))
+
+    def release(self) -> None:
+        redis_conn().zrem(_ACTIVE_KEY, self.job_id)
@@ -0,0 +1,319 @@
+from __future__ import annotations
+
+import json
+import time
+import uuid
+from typing import Any, cast
+
+from app import warm
+from app.cookies import lease_account, report_failure
+from app.info_cache import EXTRACT_OPTS
+from app.queueing import enqueue_download, get_job_state, q
+from app.settings import settings
+from app.store import TERMINAL_STATUSES, job_key, redis_conn
+
+# batch:<id>          hash, one JSON value per field (like job states)
+# batch:<id>:pending  list of {"url", "title", "duration"} not submitted yet
+# batch:<id>:jobs     list of child job ids, in submission order
+# batch:<id>:open     set of child job ids that were not terminal at the last look
+
+
+def _key(batch_id: str, part: str = "") -> str:
+    return f"batch:{batch_id}:{part}" if part else f"batch:{batch_id}"
+
+
+def _ttl() -> int:
+    return settings.job_ttl_hours * 3600
+
+
+def _keys(batch_id: str) -> list[str]:
+    return [_key(batch_id), _key(batch_id, "pending"), _key(batch_id, "jobs"), _key(batch_id, "open")]
+
+
+def _get(batch_id: str) -> dict[str, Any] | None:
+    raw = redis_conn().hgetall(_key(batch_id))
+    if not raw:
+        return None
+    return {f: json.loads(v) for f, v in raw.items()}
+
+
+def _set(batch_id: str, patch: dict[str, Any]) -> None:
+    redis_conn().hset(_key(batch_id), mapping={f: json.dumps(v) for f, v in patch.items()})
+
+
+def create_batch(*, urls: list[str], playlist_url: str, format_id: str, container: str, mode: str) -> str:
+    """Register a batch and start its first children.
+
+    Either urls (submitted as given) or playlist_url (expanded page by page by
+    a worker as children finish) is used.
+    """
+
+    batch_id = str(uuid.uuid4())
+    urls = urls[: settings.batch_max_items]
+    r = redis_conn()
+    pipe = r.pipeline(transaction=True)
+    pipe.hset(
+        _key(batch_id),
+        mapping={
+            f: json.dumps(v)
+            for f, v in {
+                "batch_id": batch_id,
+                "format_id": format_id,
+                "container": container,
+                "mode": mode,
+                "playlist_url": playlist_url,
+                "expanded": len(urls),
+                "exhausted": not playlist_url,
+                "created_at": int(time.time()),
+            }.items()
+        },
+    )
+    if urls:
+        pipe.rpush(_key(batch_id, "pending"), *[json.dumps({"url": u}) for u in urls])
+    for k in _keys(batch_id):
+        pipe.expire(k, _ttl())
+    pipe.execute()
+
+    if playlist_url:
+        _schedule_expand(batch_id)
+    else:
+        advance(batch_id, expand=False)
+    return batch_id
+
+
+def _expand_page(url: str, start: int, size: int) -> tuple[list[dict[str, Any]], bool]:
+    """Flat-extract entries start..start+size-1 (1-based) of a playlist; returns (entries, more)."""
+
+    opts = dict(EXTRACT_OPTS)
+    opts.update(
+        {
+            "noplaylist": False,
+            "extract_flat": "in_playlist",
+            "playliststart": start,
+            "playlistend": start + size - 1,
+        }
+    )
+    account = lease_account()
+    if account:
+        opts["cookiefile"] = account.path()
+    try:
+        with warm.youtube_dl(opts) as ydl:
+            info = cast(dict[str, Any], ydl.extract_info(url, download=False))
+    except Exception as e:
+        report_failure(account, str(e))
+        raise
+    finally:
+        if account:
+            account.release()
+
+    if info.get("_type") not in ("playlist", "multi_video"):
+        # Not a playlist after all: a batch of one.
+        return ([{"url": info.get("webpage_url") or url, "title": info.get("title")}] if start == 1 else []), False
+
+    entries = []
+    for e in list(info.get("entries") or []):
+        if not e:
+            continue
+        entry_url = e.get("url") or e.get("webpage_url")
+        if not entry_url:
+            continue
+        entries.append({"url": entry_url, "title": e.get("title"), "duration": e.get("duration")})
+    return entries, len(entries) >= size
+
+
+def _expand(batch_id: str, batch: dict[str, Any]) -> None:
+    expanded = int(batch.get("expanded") or 0)
+    size = min(settings.batch_expand_page_size, settings.batch_max_items - expanded)
+    try:
+        entries, more = _expand_page(str(batch["playlist_url"]), expanded + 1, size) if size > 0 else ([], False)
+    except Exception as e:
+        _set(batch_id, {"exhausted": True, "error": str(e)})
+        return
+    r = redis_conn()
+    pipe = r.pipeline(transaction=True)
+    if entries:
+        pipe.rpush(_key(batch_id, "pending"), *[json.dumps(e) for e in entries])
+        pipe.expire(_key(batch_id, "pending"), _ttl())
+    # Playlist positions count even for entries without a usable URL.
+    pipe.hset(
+        _key(batch_id),
+        mapping={"expanded": json.dumps(expanded + size), "exhausted": json.dumps(not more)},
+    )
+    pipe.execute()
+
+
+def _schedule_expand(batch_id: str) -> None:
+    # At most one queued expansion per batch.
+    if redis_conn().set(_key(batch_id, "expanding"), "1", nx=True, ex=300):
+        q("short").enqueue(
+            advance_batch,
+            kwargs={"batch_id": batch_id},
+            result_ttl=0,
+            failure_ttl=_ttl(),
+        )
+
+
+def _refresh_open(batch_id: str) -> int:
+    """Drop terminal children from the open set; returns how many are still running."""
+
+    r = redis_conn()
+    running = 0
+    for cid in r.smembers(_key(batch_id, "open")):
+        state = get_job_state(cid)
+        if state and state.get("status") not in TERMINAL_STATUSES:
+            running += 1
+        else:
+            r.srem(_key(batch_id, "open"), cid)
+    return running
+
+
+def advance(batch_id: str, *, expand: bool = True) -> None:
+    """Submit pending children while the batch is below BATCH_MAX_CONCURRENCY.
+
+    With expand=False (web requests), the next playlist page is left to a worker.
+    Concurrent calls are serialized per batch; a call that finds the batch busy
+    marks it dirty so the running one takes another pass.
+    """
+
+    r = redis_conn()
+    lock, dirty = _key(batch_id, "lock"), _key(batch_id, "dirty")
+    token = uuid.uuid4().hex
+    if not r.set(lock, token, nx=True, ex=300):
+        r.set(dirty, "1", ex=300)
+        return
+    try:
+        while True:
+            r.delete(dirty)
+            _advance_locked(batch_id, expand=expand)
+            if not r.exists(dirty):
+                break
+    finally:
+        # The lock may have expired and been taken by another call meanwhile.
+        if r.get(lock) == token:
+            r.delete(lock)
+
+
+def _advance_locked(batch_id: str, *, expand: bool) -> None:
+    r = redis_conn()
+    batch = _get(batch_id)
+    if not batch:
+        return
+    running = _refresh_open(batch_id)
+    while running < settings.batch_max_concurrency:
+        raw = r.lpop(_key(batch_id, "pending"))
+        if raw is None:
+            if batch.get("exhausted"):
+                break
+            if not expand:
+                _schedule_expand(batch_id)
+                break
+            _expand(batch_id, batch)
+            batch = _get(batch_id) or batch
+            continue
+        entry = json.loads(raw)
+        job_id = enqueue_download(
+            url=entry["url"],
+            format_id=batch["format_id"],
+            container=batch["container"],
+            mode=batch["mode"],
+            duration=entry.get("duration"),
+            batch_id=batch_id,
+        )
+        pipe = r.pipeline(transaction=True)
+        pipe.rpush(_key(batch_id, "jobs"), job_id)
+        pipe.sadd(_key(batch_id, "open"), job_id)
+        pipe.execute()
+        # Outputs already on disk finish at once and do not take a slot.
+        state = get_job_state(job_id)
+        if state and state.get("status") not in TERMINAL_STATUSES:
+            running += 1
+        else:
+            r.srem(_key(batch_id, "open"), job_id)
+
+    pipe = r.pipeline(transaction=False)
+    for k in _keys(batch_id):
+        pipe.expire(k, _ttl())
+    pipe.execute()
+
+
+def advance_batch(batch_id: str) -> None:
+    """RQ entry point: expand the next playlist page and submit children."""
+
+    redis_conn().delete(_key(batch_id, "expanding"))
+    advance(batch_id, expand=True)
+
+
+def on_jobs_settled(job_ids: list[str]) -> None:
+    """Advance the batches of jobs that just reached a terminal state."""
+
+    try:
+        r = redis_conn()
+        pipe = r.pipeline(transaction=False)
+        for jid in job_ids:
+            pipe.hget(job_key(jid), "batch_id")
+        batch_ids = {json.loads(v) for v in pipe.execute() if v}
+        for bid in batch_ids:
+            if bid:
+                advance(bid)
+    except Exception:
+        # A batch that misses a wake-up still advances on its next status read.
+        pass
+
+
+def child_job_ids(batch_id: str) -> list[str] | None:
+    r = redis_conn()
+    if not r.exists(_key(batch_id)):
+        return None
+    return list(r.lrange(_key(batch_id, "jobs"), 0, -1))
+
+
+def batch_status(batch_id: str) -> dict[str, Any] | None:
+    batch = _get(batch_id)
+    if not batch:
+        return None
+    r = redis_conn()
+    pending = int(r.llen(_key(batch_id, "pending")))
+    children = []
+    counts = {"queued": 0, "started": 0, "finished": 0, "failed": 0}
+    progress_sum = 0.0
+    for cid in r.lrange(_key(batch_id, "jobs"), 0, -1):
+        state = get_job_state(cid) or {"status": "failed", "error": "job expired"}
+        status = str(state.get("status") or "queued")
+        counts[status if status in counts else "started"] += 1
+        progress = 100 if status == "finished" else int(state.get("progress") or 0)
+        progress_sum += progress
+        children.append(
+            {
+                "job_id": cid,
+                "url": state.get("url"),
+                "title": state.get("title"),
+                "status": status,
+                "progress": progress,
+                "error": state.get("error"),
+                "download_url": state.get("download_url"),
+            }
+        )
+
+    total = len(children) + pending
+    done = counts["finished"] + counts["failed"]
+    if not batch.get("exhausted"):
+        status = "expanding"
+    elif done == total:
+        status = "finished"
+    else:
+        status = "running"
+    return {
+        "batch_id": batch_id,
+        "status": status,
+        "format_id": batch.get("format_id"),
+        "container": batch.get("container"),
+        "mode": batch.get("mode"),
+        "playlist_url": batch.get("playlist_url") or None,
+        "error": batch.get("error"),
+        "total": total,
+        "pending": pending,
+        **counts,
+        # Children not yet known (unexpanded playlist pages) are not counted.
+        "progress": int(progress_sum / total) if total else 0,
+        "jobs": children,
+    }
@@ -1,54 +1,103 @@
 from __future__ import annotations
 
-import json
 import os
 import time
 
 from redis import Redis
 from redis.exceptions import ConnectionError
 
+from app import disk_budget
+from app.outputs import last_ref_deadline, live_refs
 from app.settings import settings
+from app.store import EXPIRY_KEY, file_expiry_member, redis_conn
 
+_RECONCILE_KEY = "cleaner:reconcile"
 
-def cleanup_once() -> None:
-    now = int(time.time())
-    cutoff = now - (settings.job_ttl_hours * 3600)
 
-    os.makedirs(settings.download_dir, exist_ok=True)
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except Exception:
+        pass
+
+
+def sweep_expired(r: Redis, now: float) -> int:
+    """Delete what the expiry index says is due; returns the number of entries handled."""
+
+    handled = 0
+    while True:
+        due = r.zrangebyscore(EXPIRY_KEY, "-inf", now, start=0, num=settings.clean_batch_size)
+        if not due:
+            return handled
+        handled += len(due)
+
+        jobs = [m for m in due if m.startswith("job:")]
+        files = [m.split(":", 1)[1] for m in due if m.startswith("file:")]
+
+        pipe = r.pipeline(transaction=False)
+        # Removed before the reference check, so a concurrent add_ref re-adds the file.
+        pipe.zrem(EXPIRY_KEY, *due)
+        if jobs:
+            pipe.delete(*jobs)
+        pipe.execute()
+
+        for path in files:
+            # Under a disk budget, tracked outputs are only removed by LRU eviction.
+            if disk_budget.enabled() and disk_budget.tracked(path):
+                continue
+            # Outputs reused by newer jobs stay until the last reference expires.
+            if live_refs(path):
+                r.zadd(EXPIRY_KEY, {file_expiry_member(path): last_ref_deadline(path)}, gt=True)
+                continue
+            _remove_file(path)
+
+
+def reconcile(r: Redis, now: float) -> None:
+    """Full pass for orphans the index does not know about (partial files, pre-index keys)."""
+
+    cutoff = now - (settings.job_ttl_hours * 3600)
 
-    # Delete old files
     for name in os.listdir(settings.download_dir):
         path = os.path.join(settings.download_dir, name)
         try:
             st = os.stat(path)
         except Exception:
             continue
-        if int(st.st_mtime) < cutoff:
-            try:
-                os.remove(path)
-            except Exception:
-                pass
-
-    # Delete old job states (extra safety; Redis TTL also applies)
-    r = Redis.from_url(settings.redis_url, decode_responses=True)
+        if st.st_mtime < cutoff and not live_refs(path):
+            if disk_budget.enabled() and disk_budget.tracked(path):
+                continue
+            _remove_file(path)
+
+    if disk_budget.enabled():
+        disk_budget.reconcile()
+
     cursor = 0
     while True:
-        cursor, keys = r.scan(cursor=cursor, match="job:*", count=200)
-        for k in keys:
-            raw = r.get(k)
-            if not raw:
-                continue
-            try:
-                data = json.loads(raw)
-            except Exception:
-                continue
-            created_at = int(data.get("created_at") or 0)
-            if created_at and created_at < cutoff:
-                r.delete(k)
+        cursor, keys = r.scan(cursor=cursor, match="job:*", count=settings.clean_batch_size)
+        if keys:
+            pipe = r.pipeline(transaction=False)
+            for k in keys:
+                pipe.hget(k, "created_at")
+            created = pipe.execute(raise_on_error=False)
+            stale = [k for k, c in zip(keys, created) if isinstance(c, str) and c.isdigit() and int(c) < cutoff]
+            if stale:
+                r.delete(*stale)
         if cursor == 0:
             break
 
 
+def cleanup_once() -> None:
+    now = time.time()
+    os.makedirs(settings.download_dir, exist_ok=True)
+    r = redis_conn()
+
+    sweep_expired(r, now)
+
+    # At most one reconcile per interval across all cleaner instances.
+    if r.set(_RECONCILE_KEY, int(now), nx=True, ex=settings.clean_reconcile_interval_seconds):
+        reconcile(r, now)
+
+
 def main() -> None:
     interval = int(os.getenv("CLEAN_INTERVAL_SECONDS", str(settings.clean_interval_seconds)))
     while True:
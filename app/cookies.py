@@ -1,55 +1,246 @@
 from __future__ import annotations
 
 import base64
+import contextlib
+import functools
+import hashlib
+import itertools
 import os
+import threading
+import time
+from collections.abc import Iterator
 from pathlib import Path
+from typing import Any
 
+from app.settings import settings
+from app.store import redis_conn
 
-def ensure_cookiefile() -> str:
-    """Return a valid cookiefile path if available.
+_B64_ENV = "YTDLP_COOKIES_B64"
+_LRU_KEY = "cookies:lru"
+_COOLDOWN_PREFIX = "cookies:cooldown:"
+_STATS_PREFIX = "cookies:stats:"
+
+# Cookie files and directories are re-read at most this often.
+_RESCAN_SECONDS = 30
+
+_BOT_CHECK_MARKERS = ("confirm you're not a bot", "confirm you’re not a bot", "confirm that you're not a bot")
+
+
+class CookieAccount:
+    """One identity: a Netscape cookies.txt from an env var, a file or a pool directory."""
+
+    def __init__(self, name: str, data: bytes) -> None:
+        self.name = name
+        self.data = data
+        self.digest = hashlib.sha256(data).hexdigest()[:16]
+
+    def directory(self) -> Path:
+        download_dir = (os.getenv("DOWNLOAD_DIR") or "/data").strip() or "/data"
+        return Path(download_dir) / "cookies" / self.digest
+
+    def _copy(self) -> Path:
+        return self.directory() / f"{os.getpid()}-{threading.get_ident()}.txt"
+
+    def path(self) -> str:
+        """Materialized copy for the calling thread; release() deletes it again.
+
+        yt-dlp rewrites its cookiefile in place when it closes, so each thread gets
+        its own copy instead of racing on a shared file.
+        """
+
+        p = self._copy()
+        if not p.exists():
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp = p.with_suffix(".tmp")
+            tmp.write_bytes(self.data)
+            try:
+                os.chmod(str(tmp), 0o600)
+            except Exception:
+                pass
+            os.replace(tmp, p)
+        return str(p)
+
+    def release(self) -> None:
+        """Delete the calling thread's copy once its YoutubeDLs are closed.
+
+        Forking workers run every job in a new process, so copies left behind
+        would pile up one per job.
+        """
+
+        with contextlib.suppress(OSError):
+            self._copy().unlink()
+
+
+@functools.lru_cache(maxsize=32)
+def _decode_b64(value: str) -> bytes:
+    raw = value
+    # tolerate missing padding
+    pad = (-len(raw)) % 4
+    if pad:
+        raw = raw + ("=" * pad)
+    return base64.b64decode(raw.encode("ascii"))
+
+
+def _scan() -> list[CookieAccount]:
+    """Collect cookie sources.
 
     Supported inputs:
+    - YTDLP_COOKIES_B64 and YTDLP_COOKIES_B64_<NAME>: base64-encoded cookies.txt content
     - YTDLP_COOKIES: filesystem path to a Netscape cookies.txt
-    - YTDLP_COOKIES_B64: base64-encoded cookies.txt content (optional)
+    - YTDLP_COOKIES_DIR: directory with one <name>.txt per account
 
-    If YTDLP_COOKIES is set but the file does not exist, we ignore it
-    to avoid breaking the service.
+    Missing files are ignored to avoid breaking the service.
     """
 
     download_dir = (os.getenv("DOWNLOAD_DIR") or "/data").strip() or "/data"
+    found: dict[str, CookieAccount] = {}
+
+    for key in sorted(os.environ):
+        if key != _B64_ENV and not key.startswith(_B64_ENV + "_"):
+            continue
+        value = os.environ[key].strip()
+        if value:
+            name = key[len(_B64_ENV) + 1 :].lower() or "default"
+            found[name] = CookieAccount(name, _decode_b64(value))
+
+    files: list[Path] = []
     cookie_path = (os.getenv("YTDLP_COOKIES") or "").strip()
-    cookie_b64 = (os.getenv("YTDLP_COOKIES_B64") or "").strip()
+    if cookie_path:
+        files.append(Path(cookie_path))
+    cookie_dir = (os.getenv("YTDLP_COOKIES_DIR") or "").strip()
+    if cookie_dir and Path(cookie_dir).is_dir():
+        files.extend(sorted(Path(cookie_dir).glob("*.txt")))
+    if not found and not files:
+        # Convenience fallback: if a cookies.txt exists in the shared volume,
+        # use it even if env vars are not set (helps when only one service got env).
+        files.append(Path(download_dir) / "cookies.txt")
+
+    for f in files:
+        try:
+            data = f.read_bytes()
+        except OSError:
+            continue
+        name = f.stem if f.stem not in found else f"{f.stem}-{len(found)}"
+        found[name] = CookieAccount(name, data)
+
+    return list(found.values())
+
+
+_accounts_cache: tuple[float, list[CookieAccount]] = (0.0, [])
+_accounts_lock = threading.Lock()
+_local_rr = itertools.count()
+
+
+def accounts() -> list[CookieAccount]:
+    global _accounts_cache
+    with _accounts_lock:
+        loaded_at, cached = _accounts_cache
+        if time.monotonic() - loaded_at >= _RESCAN_SECONDS:
+            cached = _scan()
+            _accounts_cache = (time.monotonic(), cached)
+        return cached
 
-    if cookie_b64:
-        if not cookie_path:
-            cookie_path = str(Path(download_dir) / "cookies.txt")
 
-        p = Path(cookie_path)
-        p.parent.mkdir(parents=True, exist_ok=True)
+def is_bot_check(message: str) -> bool:
+    text = (message or "").lower()
+    return any(marker in text for marker in _BOT_CHECK_MARKERS)
 
-        raw = cookie_b64
-        # tolerate missing padding
-        pad = (-len(raw)) % 4
-        if pad:
-            raw = raw + ("=" * pad)
 
-        data = base64.b64decode(raw.encode("ascii"))
-        p.write_bytes(data)
+def lease_account() -> CookieAccount | None:
+    """Pick the least recently used account that is not cooling down, cluster-wide."""
 
+    pool = accounts()
+    if not pool:
+        return None
+    if len(pool) == 1:
+        chosen = pool[0]
+    else:
         try:
-            os.chmod(str(p), 0o600)
+            r = redis_conn()
+            pipe = r.pipeline(transaction=False)
+            for a in pool:
+                pipe.zscore(_LRU_KEY, a.name)
+            for a in pool:
+                pipe.exists(_COOLDOWN_PREFIX + a.name)
+            res = pipe.execute()
+            last_used, cooling = res[: len(pool)], res[len(pool) :]
+            ready = [(score or 0.0, i) for i, (score, c) in enumerate(zip(last_used, cooling)) if not c]
+            # Everyone is cooling down: keep going with the least recently used one.
+            candidates = ready or [(score or 0.0, i) for i, score in enumerate(last_used)]
+            chosen = pool[min(candidates)[1]]
         except Exception:
-            pass
+            # Redis trouble must not stop downloads; rotate locally instead.
+            chosen = pool[next(_local_rr) % len(pool)]
 
-        return str(p)
+    try:
+        now = time.time()
+        pipe = redis_conn().pipeline(transaction=False)
+        pipe.zadd(_LRU_KEY, {chosen.name: now})
+        pipe.hincrby(_STATS_PREFIX + chosen.name, "leases", 1)
+        pipe.hset(_STATS_PREFIX + chosen.name, "last_used", int(now))
+        pipe.execute()
+    except Exception:
+        pass
+    return chosen
+
+
+def report_failure(account: CookieAccount | None, message: str) -> bool:
+    """Put the account on cool-down if message is a bot check; returns True if it was."""
+
+    if account is None or not is_bot_check(message):
+        return False
+    try:
+        r = redis_conn()
+        pipe = r.pipeline(transaction=False)
+        pipe.set(_COOLDOWN_PREFIX + account.name, int(time.time()), ex=settings.cookie_cooldown_seconds)
+        pipe.hincrby(_STATS_PREFIX + account.name, "bot_checks", 1)
+        pipe.hset(_STATS_PREFIX + account.name, "last_bot_check", int(time.time()))
+        pipe.execute()
+    except Exception:
+        pass
+    return True
+
+
+@contextlib.contextmanager
+def ensure_cookiefile() -> Iterator[str]:
+    """Yield a cookiefile path for the next account in the pool, or "" without cookies.
+
+    The calling thread's copy is deleted again on exit.
+    """
 
-    if cookie_path and Path(cookie_path).exists():
-        return cookie_path
+    account = lease_account()
+    try:
+        yield account.path() if account else ""
+    finally:
+        if account:
+            account.release()
 
-    # Convenience fallback: if a cookies.txt exists in the shared volume,
-    # use it even if env vars are not set (helps when only one service got env).
-    default_path = Path(download_dir) / "cookies.txt"
-    if default_path.exists():
-        return str(default_path)
 
-    return ""
+def pool_status() -> dict[str, Any]:
+    pool = accounts()
+    if not pool:
+        return {"enabled": False}
+    r = redis_conn()
+    items = []
+    for a in pool:
+        stats = r.hgetall(_STATS_PREFIX + a.name)
+        cooldown = r.ttl(_COOLDOWN_PREFIX + a.name)
+        items.append(
+            {
+                "name": a.name,
+                "hash": a.digest,
+                "size": len(a.data),
+                "leases": int(stats.get("leases") or 0),
+                "bot_checks": int(stats.get("bot_checks") or 0),
+                "last_used": int(stats.get("last_used") or 0) or None,
+                "last_bot_check": int(stats.get("last_bot_check") or 0) or None,
+                "cooldown_seconds": max(0, cooldown),
+            }
+        )
+    return {
+        "enabled": True,
+        "path": str(pool[0].directory()),
+        "size": len(pool[0].data),
+        "accounts": items,
+        "available": sum(1 for i in items if not i["cooldown_seconds"]),
+    }
@@ -14,19 +14,18 @@ def run_ydlp_debug(url: str) -> dict[str, Any]:
     This is meant for internal debugging only.
     """
 
-    cookiefile = ensure_cookiefile()
-
-    base_cmd = ["yt-dlp", "--ignore-config", "--no-playlist", "--no-warnings", "--verbose"]
-    if cookiefile:
-        base_cmd += ["--cookies", cookiefile]
-
-    # 1) list formats
-    cmd_F = base_cmd + ["-F", url]
-    p1 = subprocess.run(cmd_F, capture_output=True, text=True)
-
-    # 2) dump json (metadata)
-    cmd_J = base_cmd + ["-J", url]
-    p2 = subprocess.run(cmd_J, capture_output=True, text=True)
+    with ensure_cookiefile() as cookiefile:
+        base_cmd = ["yt-dlp", "--ignore-config", "--no-playlist", "--no-warnings", "--verbose"]
+        if cookiefile:
+            base_cmd += ["--cookies", cookiefile]
+
+        # 1) list formats
+        cmd_F = base_cmd + ["-F", url]
+        p1 = subprocess.run(cmd_F, capture_output=True, text=True)
+
+        # 2) dump json (metadata)
+        cmd_J = base_cmd + ["-J", url]
+        p2 = subprocess.run(cmd_J, capture_output=True, text=True)
 
     def pack(cmd: list[str], p: subprocess.CompletedProcess[str]) -> dict[str, Any]:
         return {
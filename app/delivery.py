@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from collections.abc import AsyncIterator
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+
+from secrets import token_hex
+
+import anyio
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.types import Send
+
+from app.events import hub
+from app.queueing import get_job_state
+from app.settings import settings
+
+_TAIL_READ_BYTES = 256 * 1024
+
+
+class StreamAborted(RuntimeError):
+    """The job producing a streamed file failed; the client must not see a clean EOF."""
+
+
+class OutputFileResponse(FileResponse):
+    """FileResponse with a standards-conforming multipart/byteranges body.
+
+    The bundled Starlette sends multi-range replies with the boundary in
+    Content-Range and a Content-Length one byte short; single ranges and
+    If-Range are inherited unchanged.
+    """
+
+    async def _handle_multiple_ranges(
+        self,
+        send: Send,
+        ranges: list[tuple[int, int]],
+        file_size: int,
+        send_header_only: bool,
+    ) -> None:
+        boundary = token_hex(13)
+        content_type = self.headers["content-type"]
+        heads = [
+            (
+                f"--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end - 1}/{file_size}\r\n\r\n"
+            ).encode("latin-1")
+            for start, end in ranges
+        ]
+        tail = f"--{boundary}--\r\n".encode("latin-1")
+        length = sum(len(h) + (end - start) + 2 for h, (start, end) in zip(heads, ranges)) + len(tail)
+
+        self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        self.headers["content-length"] = str(length)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        if send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            for head, (start, end) in zip(heads, ranges):
+                await send({"type": "http.response.body", "body": head, "more_body": True})
+                await file.seek(start)
+                while start < end:
+                    chunk = await file.read(min(self.chunk_size, end - start))
+                    if not chunk:
+                        break
+                    start += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+            await send({"type": "http.response.body", "body": tail, "more_body": False})
+
+
+def etag_for(st: os.stat_result) -> str:
+    # Strong validator: outputs are written once and never modified in place.
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison (RFC 9110 13.1.2).
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def deliver_file(request: Request, path: str, filename: str) -> Response:
+    """Serve a finished output with validators, 304s, Range, or hand it to the proxy.
+
+    Range (single and multi-part) and If-Range are handled by the response;
+    with DOWNLOAD_OFFLOAD the reverse proxy sends the bytes itself.
+    """
+
+    st = os.stat(path)
+    etag = etag_for(st)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+    }
+    if not_modified(request, etag, st.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    mode = settings.download_offload
+    if mode == "x-accel":
+        rel = os.path.relpath(path, settings.download_dir)
+        headers["X-Accel-Redirect"] = settings.download_accel_prefix.rstrip("/") + "/" + quote(rel)
+    elif mode == "x-sendfile":
+        headers["X-Sendfile"] = path
+    else:
+        return OutputFileResponse(
+            path, filename=filename, media_type="application/octet-stream", headers=headers, stat_result=st
+        )
+
+    headers["Content-Disposition"] = content_disposition(filename)
+    return Response(status_code=200, headers=headers, media_type="application/octet-stream")
+
+
+async def _tail(job_id: str, watch_ids: tuple[str, ...], path: str) -> AsyncIterator[bytes]:
+    # Send what the worker has written, then sleep until its next progress notification.
+    with hub.watch(*watch_ids) as changed:
+        async with await anyio.open_file(path, mode="rb") as file:
+            while True:
+                data = await file.read(_TAIL_READ_BYTES)
+                if data:
+                    yield data
+                    continue
+                state = await run_in_threadpool(get_job_state, job_id) or {}
+                status = state.get("status")
+                if status == "finished":
+                    while data := await file.read(_TAIL_READ_BYTES):
+                        yield data
+                    return
+                if status in (None, "failed"):
+                    raise StreamAborted(f"job {job_id} failed while streaming")
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=settings.sse_keepalive_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                changed.clear()
+
+
+def stream_growing_file(request: Request, job_id: str, state: dict) -> Response:
+    """Stream a progressive output while the worker is still writing it (no Range, no length)."""
+
+    path = str(state["stream_path"])
+    headers = {
+        "Content-Disposition": content_disposition(state.get("file_name") or os.path.basename(path)),
+        "Cache-Control": "no-store",
+        "Accept-Ranges": "none",
+        "X-Accel-Buffering": "no",
+    }
+    if request.method == "HEAD":
+        return Response(status_code=200, headers=headers, media_type="application/octet-stream")
+    watch_ids = (job_id, state.get("leader_id") or "")
+    return StreamingResponse(_tail(job_id, watch_ids, path), media_type="application/octet-stream", headers=headers)
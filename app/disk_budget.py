@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import Any
+
+from app.settings import settings
+from app.store import EXPIRY_KEY, file_expiry_member, redis_conn
+
+_USED_KEY = "disk:used"
+_SIZES_KEY = "disk:sizes"
+_LRU_KEY = "disk:lru"
+_OUTPUT_KEYS_KEY = "disk:outkeys"
+_RESERVED_KEY = "disk:reserved"
+_RESERVATIONS_KEY = "disk:reservations"
+_EVICT_LOCK_KEY = "disk:evict-lock"
+
+# Sources and the merged/converted output coexist until post-processing ends.
+_PEAK_FACTOR = 2
+
+# Drop reservations of crashed workers, then grant ARGV[2] bytes if they fit in ARGV[5].
+_RESERVE_SCRIPT = """
+local now = tonumber(ARGV[3])
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+  redis.call('HDEL', KEYS[1], id)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+local reserved = 0
+for _, v in ipairs(redis.call('HVALS', KEYS[1])) do
+  reserved = reserved + tonumber(v)
+end
+local used = tonumber(redis.call('GET', KEYS[3]) or '0')
+local want = tonumber(ARGV[2])
+if used + reserved + want > tonumber(ARGV[5]) then
+  return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], want)
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[1])
+return 1
+"""
+
+# Turn a job's reservation into the actual size of the file it produced.
+_COMMIT_SCRIPT = """
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+local old = tonumber(redis.call('HGET', KEYS[3], ARGV[2]) or '0')
+redis.call('HSET', KEYS[3], ARGV[2], ARGV[3])
+redis.call('INCRBY', KEYS[4], tonumber(ARGV[3]) - old)
+redis.call('ZADD', KEYS[5], ARGV[4], ARGV[2])
+if ARGV[5] ~= '' then
+  redis.call('HSET', KEYS[6], ARGV[2], ARGV[5])
+end
+return 1
+"""
+
+# Stop accounting for a file; returns its output index key (or false).
+_FORGET_SCRIPT = """
+local size = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('DECRBY', KEYS[2], size)
+redis.call('ZREM', KEYS[3], ARGV[1])
+local key = redis.call('HGET', KEYS[4], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+return key
+"""
+
+
+class DiskFull(RuntimeError):
+    pass
+
+
+def enabled() -> bool:
+    return settings.disk_budget_bytes > 0
+
+
+def estimate_bytes(resolved: dict[str, Any]) -> int:
+    """Peak disk usage of a download from its resolved formats."""
+
+    total = 0
+    for f in resolved.get("requested_formats") or [resolved]:
+        size = f.get("filesize") or f.get("filesize_approx")
+        if not size and f.get("tbr") and resolved.get("duration"):
+            size = float(f["tbr"]) * 1000 / 8 * float(resolved["duration"])
+        if not size:
+            return settings.disk_default_reservation_bytes
+        total += int(size)
+    return total * _PEAK_FACTOR
+
+
+def usage() -> int:
+    """Bytes used by tracked outputs plus bytes reserved by running downloads."""
+
+    r = redis_conn()
+    pipe = r.pipeline(transaction=False)
+    pipe.get(_USED_KEY)
+    pipe.hvals(_RESERVED_KEY)
+    used, reserved = pipe.execute()
+    return int(used or 0) + sum(int(v) for v in reserved)
+
+
+def _remove_output(path: str) -> None:
+    r = redis_conn()
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    key = forget(path)
+    pipe = r.pipeline(transaction=False)
+    if key:
+        pipe.delete(key)
+    pipe.zrem(EXPIRY_KEY, file_expiry_member(path))
+    pipe.execute()
+
+
+def evict(target: int, *, keep: str = "") -> int:
+    """Delete least-recently-downloaded outputs until usage() <= target; returns bytes freed."""
+
+    r = redis_conn()
+    # One evictor at a time, so concurrent jobs do not each free the same headroom.
+    if not r.set(_EVICT_LOCK_KEY, "1", nx=True, ex=60):
+        return 0
+    freed = 0
+    try:
+        while usage() > target:
+            oldest = [p for p in r.zrange(_LRU_KEY, 0, 20) if p != keep][:20]
+            if not oldest:
+                break
+            for path in oldest:
+                if usage() <= target:
+                    break
+                freed += int(r.hget(_SIZES_KEY, path) or 0)
+                _remove_output(path)
+    finally:
+        r.delete(_EVICT_LOCK_KEY)
+    return freed
+
+
+def reserve(job_id: str, nbytes: int) -> None:
+    """Reserve space for a download, evicting LRU outputs past the high watermark.
+
+    Waits up to DISK_RESERVE_WAIT_SECONDS for other jobs to finish or release
+    space, then raises DiskFull.
+    """
+
+    limit = settings.disk_budget_bytes
+    if nbytes > limit:
+        raise DiskFull(f"download needs {nbytes} bytes, more than the disk budget")
+    r = redis_conn()
+    deadline = time.monotonic() + settings.disk_reserve_wait_seconds
+    while True:
+        if usage() + nbytes > limit * settings.disk_high_watermark:
+            evict(max(0, int(limit * settings.disk_low_watermark) - nbytes))
+        now = time.time()
+        expires = now + settings.disk_reservation_ttl_seconds
+        granted = r.eval(
+            _RESERVE_SCRIPT,
+            3,
+            _RESERVED_KEY,
+            _RESERVATIONS_KEY,
+            _USED_KEY,
+            job_id,
+            nbytes,
+            now,
+            expires,
+            limit,
+        )
+        if int(granted):
+            return
+        if time.monotonic() >= deadline:
+            raise DiskFull(f"not enough disk space for {nbytes} bytes")
+        time.sleep(5)
+
+
+def release(job_id: str) -> None:
+    r = redis_conn()
+    pipe = r.pipeline(transaction=False)
+    pipe.hdel(_RESERVED_KEY, job_id)
+    pipe.zrem(_RESERVATIONS_KEY, job_id)
+    pipe.execute()
+
+
+def commit(job_id: str, path: str, out_key: str = "") -> None:
+    """Account for a finished output in place of the job's reservation."""
+
+    size = os.path.getsize(path)
+    redis_conn().eval(
+        _COMMIT_SCRIPT,
+        6,
+        _RESERVED_KEY,
+        _RESERVATIONS_KEY,
+        _SIZES_KEY,
+        _USED_KEY,
+        _LRU_KEY,
+        _OUTPUT_KEYS_KEY,
+        job_id,
+        path,
+        size,
+        time.time(),
+        out_key,
+    )
+    limit = settings.disk_budget_bytes
+    if usage() > limit * settings.disk_high_watermark:
+        evict(int(limit * settings.disk_low_watermark), keep=path)
+
+
+def forget(path: str) -> str | None:
+    r = redis_conn()
+    return r.eval(_FORGET_SCRIPT, 4, _SIZES_KEY, _USED_KEY, _LRU_KEY, _OUTPUT_KEYS_KEY, path)
+
+
+def touch(path: str) -> None:
+    """Mark an output as just downloaded (moves it to the back of the eviction order)."""
+
+    redis_conn().zadd(_LRU_KEY, {path: time.time()}, xx=True)
+
+
+def tracked(path: str) -> bool:
+    return bool(redis_conn().hexists(_SIZES_KEY, path))
+
+
+def reconcile() -> None:
+    """Forget outputs whose files disappeared outside of eviction."""
+
+    r = redis_conn()
+    for path in r.hkeys(_SIZES_KEY):
+        if not os.path.exists(path):
+            key = forget(path)
+            if key:
+                r.delete(key)
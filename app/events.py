@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from typing import Iterator
+
+from redis import asyncio as aioredis
+
+from app.settings import settings
+from app.store import EVENTS_PREFIX
+
+
+class EventHub:
+    """Fans job-state notifications out to waiting SSE streams.
+
+    One pattern subscription per web process, so open streams do not each
+    hold a Redis connection. Waiters just get woken up and re-read the state.
+    """
+
+    def __init__(self) -> None:
+        self._waiters: dict[str, set[asyncio.Event]] = {}
+        self._task: asyncio.Task[None] | None = None
+
+    def _wake(self, job_id: str | None = None) -> None:
+        if job_id is None:
+            groups = list(self._waiters.values())
+        else:
+            groups = [self._waiters.get(job_id) or set()]
+        for group in groups:
+            for ev in group:
+                ev.set()
+
+    async def _run(self) -> None:
+        while True:
+            r = aioredis.Redis.from_url(
+                settings.redis_url,
+                decode_responses=True,
+                health_check_interval=settings.redis_health_check_interval_seconds,
+                socket_connect_timeout=settings.redis_socket_connect_timeout_seconds,
+            )
+            try:
+                pubsub = r.pubsub()
+                await pubsub.psubscribe(f"{EVENTS_PREFIX}*")
+                async for msg in pubsub.listen():
+                    if msg.get("type") != "pmessage":
+                        continue
+                    self._wake(str(msg.get("channel") or "")[len(EVENTS_PREFIX):])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Lost the subscription: wake everyone so they re-read state, then reconnect.
+                self._wake()
+                await asyncio.sleep(1)
+            finally:
+                with contextlib.suppress(Exception):
+                    await r.aclose()
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    @contextlib.contextmanager
+    def watch(self, *job_ids: str) -> Iterator[asyncio.Event]:
+        """Yield an event that is set whenever any of job_ids changes."""
+
+        self._ensure_started()
+        ev = asyncio.Event()
+        ids = [j for j in job_ids if j]
+        for j in ids:
+            self._waiters.setdefault(j, set()).add(ev)
+        try:
+            yield ev
+        finally:
+            for j in ids:
+                group = self._waiters.get(j)
+                if group is not None:
+                    group.discard(ev)
+                    if not group:
+                        self._waiters.pop(j, None)
+
+
+hub = EventHub()
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+from app.settings import settings
+
+T = TypeVar("T")
+
+
+class ExtractorBusy(RuntimeError):
+    pass
+
+
+class ExtractorTimeout(RuntimeError):
+    pass
+
+
+_executor = ThreadPoolExecutor(max_workers=max(1, settings.extract_workers), thread_name_prefix="extract")
+# Running + waiting extractions; anything beyond this is rejected immediately.
+_slots = threading.BoundedSemaphore(max(1, settings.extract_workers) + max(0, settings.extract_queue_max))
+
+
+async def run_extraction(fn: Callable[..., T], *args: Any) -> T:
+    """Run a blocking yt-dlp call on the dedicated extraction pool.
+
+    Keeps Starlette's shared threadpool free for the lightweight endpoints.
+    Raises ExtractorBusy when the pool and its queue are full, and
+    ExtractorTimeout when the call takes longer than the configured limit (the
+    thread keeps its slot until yt-dlp actually returns).
+    """
+
+    if not _slots.acquire(blocking=False):
+        raise ExtractorBusy("too many format lookups in progress")
+
+    loop = asyncio.get_running_loop()
+    try:
+        fut = loop.run_in_executor(_executor, fn, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    fut.add_done_callback(lambda _: _slots.release())
+
+    try:
+        return await asyncio.wait_for(asyncio.shield(fut), timeout=settings.extract_timeout_seconds)
+    except asyncio.TimeoutError:
+        raise ExtractorTimeout("format lookup timed out") from None
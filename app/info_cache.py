@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from typing import Any, cast
+from urllib.parse import parse_qs, urlparse
+
+from app import warm
+from app.cookies import CookieAccount, accounts, lease_account, report_failure
+from app.metrics import EXTRACT_SECONDS
+from app.settings import settings
+from app.store import redis_conn
+
+_YT_ID = re.compile(r"^[A-Za-z0-9_-]{11}$")
+_YT_HOSTS = ("youtube.com", "youtube-nocookie.com", "youtu.be")
+_YT_PATH_PREFIXES = ("shorts", "embed", "live", "v", "e")
+
+# Keys that are large and never used by the listing/download code paths.
+_DROP_KEYS = (
+    "automatic_captions",
+    "subtitles",
+    "thumbnails",
+    "heatmap",
+    "description",
+    "tags",
+    "categories",
+    "chapters",
+)
+
+# Options used for metadata extraction (shared by the web and the worker).
+EXTRACT_OPTS: dict[str, Any] = {
+    "quiet": True,
+    "no_warnings": True,
+    "skip_download": True,
+    "noplaylist": True,
+    # Avoid unexpected global config (e.g. format overrides)
+    "ignoreconfig": True,
+    # Be explicit: some environments end up with an implicit format constraint.
+    "format": "best",
+}
+
+
+def canonical_video_id(url: str) -> str:
+    """Return a stable cache key for a video URL.
+
+    YouTube watch?v=, youtu.be, shorts, embed and live URLs all map to
+    ``yt:<id>``; anything else falls back to a hash of the stripped URL.
+    """
+
+    raw = (url or "").strip()
+    try:
+        p = urlparse(raw if "://" in raw else f"https://{raw}")
+    except ValueError:
+        p = None
+
+    if p is not None:
+        host = (p.hostname or "").lower()
+        if host.startswith("www.") or host.startswith("m.") or host.startswith("music."):
+            host = host.split(".", 1)[1]
+        if host in _YT_HOSTS:
+            parts = [x for x in p.path.split("/") if x]
+            vid = ""
+            if host == "youtu.be":
+                vid = parts[0] if parts else ""
+            elif parts and parts[0] == "watch":
+                vid = (parse_qs(p.query).get("v") or [""])[0]
+            elif len(parts) >= 2 and parts[0] in _YT_PATH_PREFIXES:
+                vid = parts[1]
+            if _YT_ID.match(vid):
+                return f"yt:{vid}"
+
+    return "url:" + hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def info_key(video_id: str) -> str:
+    return f"ytinfo:{video_id}"
+
+
+def _lock_key(video_id: str) -> str:
+    return f"ytinfo:lock:{video_id}"
+
+
+def _trim(info: dict[str, Any]) -> dict[str, Any]:
+    import yt_dlp
+
+    # Same cleanup yt-dlp applies for --load-info-json, so the cached dict can be
+    # handed back to YoutubeDL.process_ie_result later.
+    data = cast(dict[str, Any], yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True))
+    for k in _DROP_KEYS:
+        data.pop(k, None)
+    return data
+
+
+def _extract_with(url: str, account: CookieAccount | None) -> dict[str, Any]:
+    opts = dict(EXTRACT_OPTS)
+    if account:
+        opts["cookiefile"] = account.path()
+
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        with warm.youtube_dl(opts) as ydl:
+            # yt-dlp returns a typed InfoDict; treat as plain dict.
+            info = ydl.extract_info(url, download=False)
+            outcome = "ok"
+            return _trim(cast(dict[str, Any], dict(info)))
+    finally:
+        EXTRACT_SECONDS.labels(outcome=outcome).observe(time.perf_counter() - start)
+        if account:
+            account.release()
+
+
+def _extract(url: str) -> dict[str, Any]:
+    account = lease_account()
+    try:
+        return _extract_with(url, account)
+    except Exception as e:
+        # A bot check cools the account down; retry once on another account of the pool.
+        if not report_failure(account, str(e)) or len(accounts()) < 2:
+            raise
+    return _extract_with(url, lease_account())
+
+
+def peek_info(url: str) -> dict[str, Any] | None:
+    """Return cached info for url without extracting."""
+
+    raw = redis_conn().get(info_key(canonical_video_id(url)))
+    if not raw:
+        return None
+    try:
+        return json.loads(raw)
+    except Exception:
+        return None
+
+
+class _Flight:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: dict[str, Any] | None = None
+        self.error: BaseException | None = None
+
+
+_flights: dict[str, _Flight] = {}
+_flights_lock = threading.Lock()
+
+
+def get_info(url: str) -> dict[str, Any]:
+    """Return (trimmed) yt-dlp info for url, using the shared Redis cache.
+
+    Concurrent callers for the same video are collapsed into one extraction:
+    threads of this process wait on an in-memory flight, other processes wait
+    on a short Redis lock and then read the cached result.
+    """
+
+    vid = canonical_video_id(url)
+
+    cached = peek_info(url)
+    if cached is not None:
+        return cached
+
+    with _flights_lock:
+        flight = _flights.get(vid)
+        leader = flight is None
+        if leader:
+            flight = _flights[vid] = _Flight()
+    assert flight is not None
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        assert flight.result is not None
+        return flight.result
+
+    try:
+        flight.result = _get_info_shared(url, vid)
+        return flight.result
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(vid, None)
+        flight.done.set()
+
+
+def _get_info_shared(url: str, vid: str) -> dict[str, Any]:
+    r = redis_conn()
+    ttl = max(1, int(settings.info_cache_ttl_seconds))
+    lock_ttl = max(1, int(settings.info_cache_lock_seconds))
+    deadline = time.monotonic() + lock_ttl
+
+    token = uuid.uuid4().hex
+    owned = False
+    while True:
+        if r.set(_lock_key(vid), token, nx=True, ex=lock_ttl):
+            owned = True
+            break
+        if time.monotonic() > deadline:
+            # Leader is stuck; extract ourselves.
+            break
+        # Another process is extracting the same video; wait for its result.
+        time.sleep(0.25)
+        cached = peek_info(url)
+        if cached is not None:
+            return cached
+
+    try:
+        if owned:
+            # The previous holder may have cached the result just before releasing the lock.
+            cached = peek_info(url)
+            if cached is not None:
+                return cached
+        info = _extract(url)
+        r.set(info_key(vid), json.dumps(info), ex=ttl)
+        return info
+    finally:
+        if owned and r.get(_lock_key(vid)) == token:
+            r.delete(_lock_key(vid))
@@ -1,16 +1,27 @@
 from __future__ import annotations
 
+import asyncio
+import json
 import os
+import time
 
 from fastapi import Depends, FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from jinja2 import Template
 
+from app import disk_budget, metrics, stats
+from app.batches import advance, batch_status, child_job_ids, create_batch
+from app.delivery import deliver_file, stream_growing_file
+from app.events import hub
+from app.extract_pool import ExtractorBusy, ExtractorTimeout, run_extraction
 from app.queueing import enqueue_download, get_job_state
 from app.settings import settings
-from app.cookies import ensure_cookiefile
-from app.yt_meta import list_formats
+from app.store import TERMINAL_STATUSES
+from app.cookies import pool_status
+from app.yt_meta import AUDIO_MODES, list_formats
+from app.zipstream import archive_name, deliver_zip
 from app.debug_ydlp import run_ydlp_debug
 
 
@@ -69,6 +80,7 @@ INDEX_HTML = Template(
         <select id="modeSelect" style="min-width: 170px;">
           <option value="auto">Video (auto)</option>
           <option value="audio_mp3">Audio (mp3)</option>
+          <option value="audio">Audio (original, sem conversao)</option>
         </select>
         <select id="formatSelect" style="flex:1; min-width: 360px;">
           <option value="">Primeiro busque os formatos...</option>
@@ -135,7 +147,7 @@ function showStatus(text, pct, linkHtml, isError=false) {
 
 function renderFormatOptions() {
   const mode = modeSelect.value;
-  const list = mode === 'audio_mp3' ? (cachedFormats?.audio_formats || []) : (cachedFormats?.video_formats || []);
+  const list = mode.startsWith('audio') ? (cachedFormats?.audio_formats || []) : (cachedFormats?.video_formats || []);
   formatSelect.innerHTML = '';
   if (!cachedFormats) {
     formatSelect.innerHTML = '<option value="">Primeiro busque os formatos...</option>';
@@ -201,31 +213,57 @@ btnDownload.addEventListener('click', async () => {
     const res = await fetch('/api/jobs', {
       method: 'POST',
       headers: {'Content-Type':'application/json'},
-      body: JSON.stringify({url, format_id, container, mode})
+      body: JSON.stringify({url, format_id, container, mode, duration: cachedFormats?.duration || 0})
     });
     const data = await readJsonResponse(res);
 
     const jobId = data.job_id;
-    const poll = async () => {
-      const r = await fetch(`/api/jobs/${jobId}`);
-      const s = await readJsonResponse(r);
-
+    // Returns true when the job reached a final state.
+    const render = (s) => {
       const pct = s.progress || 0;
       if (s.status === 'finished') {
         showStatus('Finalizado.', 100, `<a href="${s.download_url}">Clique para baixar</a>`);
         btnDownload.disabled = false;
-        return;
+        return true;
       }
       if (s.status === 'failed') {
         showStatus('Falhou: ' + (s.error || 'erro desconhecido'), pct, '', true);
         btnDownload.disabled = false;
-        return;
+        return true;
       }
       const msg = s.message ? ` - ${s.message}` : '';
-      showStatus(`${s.status}${msg}`, pct);
-      setTimeout(poll, 1200);
+      // Progressive jobs can already be downloaded while they are being written.
+      const link = s.download_url ? `<a href="${s.download_url}">Baixar agora (em andamento)</a>` : '';
+      showStatus(`${s.status}${msg}`, pct, link);
+      return false;
+    };
+    // Fallback when the event stream is unavailable.
+    const poll = async () => {
+      try {
+        const r = await fetch(`/api/jobs/${jobId}`);
+        const s = await readJsonResponse(r);
+        if (!render(s)) setTimeout(poll, 1200);
+      } catch (e) {
+        showStatus(e.message, 0, '', true);
+        btnDownload.disabled = false;
+      }
     };
-    poll();
+    if (window.EventSource) {
+      const es = new EventSource(`/api/jobs/${jobId}/events`);
+      let done = false;
+      es.onmessage = (ev) => {
+        if (render(JSON.parse(ev.data))) {
+          done = true;
+          es.close();
+        }
+      };
+      es.onerror = () => {
+        es.close();
+        if (!done) poll();
+      };
+    } else {
+      poll();
+    }
   } catch (e) {
     showStatus(e.message, 0, '', true);
     btnDownload.disabled = false;
@@ -248,6 +286,24 @@ def optional_basic_auth(credentials: HTTPBasicCredentials = Depends(security)) -
 
 app = FastAPI()
 
+_metrics_registry = metrics.registry(snapshot=True)
+
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Route templates, not raw paths, keep the label set small.
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        metrics.HTTP_REQUEST_SECONDS.labels(method=request.method, route=route, status=str(status)).observe(
+            time.perf_counter() - start
+        )
+
 
 @app.exception_handler(Exception)
 async def unhandled_exception_handler(request: Request, exc: Exception):
@@ -256,20 +312,24 @@ async def unhandled_exception_handler(request: Request, exc: Exception):
 
 
 @app.get("/health")
-def health() -> dict:
+async def health() -> dict:
     return {"ok": True}
 
 
+@app.get("/metrics")
+def prometheus_metrics() -> Response:
+    body, content_type = metrics.render(_metrics_registry)
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/api/stats", dependencies=[Depends(optional_basic_auth)])
+def api_stats(window: int = 3600) -> dict:
+    return stats.summary(window)
+
+
 @app.get("/api/cookies/status", dependencies=[Depends(optional_basic_auth)])
 def cookie_status() -> dict:
-    path = ensure_cookiefile()
-    if not path:
-        return {"enabled": False}
-    try:
-        st = os.stat(path)
-        return {"enabled": True, "path": path, "size": int(st.st_size)}
-    except Exception:
-        return {"enabled": True, "path": path}
+    return pool_status()
 
 
 @app.post("/api/debug/ydlp", dependencies=[Depends(optional_basic_auth)])
@@ -291,17 +351,31 @@ def index() -> str:
 
 
 @app.post("/api/formats", dependencies=[Depends(optional_basic_auth)])
-def api_formats(payload: dict) -> dict:
+async def api_formats(payload: dict) -> dict:
     url = (payload.get("url") or "").strip()
     if not url:
         raise HTTPException(status_code=400, detail="url required")
+    start = time.perf_counter()
+    outcome = "error"
     try:
-        return list_formats(url)
+        result = await run_extraction(list_formats, url)
+        outcome = "ok"
+        return result
     except HTTPException:
         raise
+    except ExtractorBusy as e:
+        outcome = "busy"
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except ExtractorTimeout as e:
+        outcome = "timeout"
+        metrics.count_failure("formats", "timeout")
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         # yt-dlp errors are common (age restriction, bot check, etc.)
+        metrics.count_failure("formats", str(e))
         raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        metrics.LIST_FORMATS_SECONDS.labels(outcome=outcome).observe(time.perf_counter() - start)
 
 
 @app.post("/api/jobs", dependencies=[Depends(optional_basic_auth)])
@@ -310,21 +384,63 @@ def api_jobs(payload: dict) -> dict:
     format_id = (payload.get("format_id") or "").strip()
     container = (payload.get("container") or "mp4").strip().lower()
     mode = (payload.get("mode") or "auto").strip().lower()
+    try:
+        duration = float(payload.get("duration") or 0)
+    except (TypeError, ValueError):
+        duration = 0.0
 
     if not url or not format_id:
         raise HTTPException(status_code=400, detail="url and format_id required")
     if container not in ("mp4", "mkv", "webm"):
         raise HTTPException(status_code=400, detail="invalid container")
-    if mode not in ("auto", "audio_mp3"):
+    if mode not in ("auto", *AUDIO_MODES):
         raise HTTPException(status_code=400, detail="invalid mode")
 
     try:
-        job_id = enqueue_download(url=url, format_id=format_id, container=container, mode=mode)
+        job_id = enqueue_download(
+            url=url, format_id=format_id, container=container, mode=mode, duration=duration
+        )
         return {"job_id": job_id}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@app.post("/api/batches", dependencies=[Depends(optional_basic_auth)])
+def api_batches(payload: dict) -> dict:
+    urls = [str(u).strip() for u in (payload.get("urls") or []) if str(u).strip()]
+    playlist_url = (payload.get("url") or "").strip()
+    format_id = (payload.get("format_id") or "").strip()
+    container = (payload.get("container") or "mp4").strip().lower()
+    mode = (payload.get("mode") or "auto").strip().lower()
+
+    if bool(urls) == bool(playlist_url):
+        raise HTTPException(status_code=400, detail="either urls or url (playlist) required")
+    if not format_id:
+        raise HTTPException(status_code=400, detail="format_id required")
+    if container not in ("mp4", "mkv", "webm"):
+        raise HTTPException(status_code=400, detail="invalid container")
+    if mode not in ("auto", *AUDIO_MODES):
+        raise HTTPException(status_code=400, detail="invalid mode")
+
+    try:
+        batch_id = create_batch(
+            urls=urls, playlist_url=playlist_url, format_id=format_id, container=container, mode=mode
+        )
+        return {"batch_id": batch_id}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/batches/{batch_id}", dependencies=[Depends(optional_basic_auth)])
+def api_batch(batch_id: str) -> dict:
+    # Also catches up on slots freed by children whose wake-up was missed.
+    advance(batch_id, expand=False)
+    state = batch_status(batch_id)
+    if not state:
+        raise HTTPException(status_code=404, detail="batch not found")
+    return state
+
+
 @app.get("/api/jobs/{job_id}", dependencies=[Depends(optional_basic_auth)])
 def api_job(job_id: str) -> dict:
     state = get_job_state(job_id)
@@ -333,19 +449,88 @@ def api_job(job_id: str) -> dict:
     return state
 
 
-@app.get("/download/{job_id}", dependencies=[Depends(optional_basic_auth)])
-def download(job_id: str):
+@app.get("/api/jobs/{job_id}/events", dependencies=[Depends(optional_basic_auth)])
+async def api_job_events(job_id: str):
+    state = await run_in_threadpool(get_job_state, job_id)
+    if not state:
+        raise HTTPException(status_code=404, detail="job not found")
+
+    async def stream():
+        # Followers mirror their leader, so wake up on either job's changes.
+        with hub.watch(job_id, state.get("leader_id") or "") as changed:
+            # Re-read after registering so a change in between is not missed.
+            current = await run_in_threadpool(get_job_state, job_id) or state
+            last = None
+            while True:
+                payload = json.dumps(current)
+                if payload != last:
+                    yield f"data: {payload}\n\n"
+                    last = payload
+                if current.get("status") in TERMINAL_STATUSES:
+                    return
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=settings.sse_keepalive_seconds)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                changed.clear()
+                current = await run_in_threadpool(get_job_state, job_id) or current
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.api_route("/download/zip", methods=["GET", "HEAD"], dependencies=[Depends(optional_basic_auth)])
+def download_zip(request: Request, jobs: str = "", batch: str = ""):
+    # Explicit job ids must all be ready; a batch bundles whichever children finished.
+    if batch:
+        ids = child_job_ids(batch)
+        if ids is None:
+            raise HTTPException(status_code=404, detail="batch not found")
+        strict = False
+    else:
+        ids = [j.strip() for j in jobs.split(",") if j.strip()]
+        strict = True
+    if not ids:
+        raise HTTPException(status_code=400, detail="jobs or batch required")
+
+    files: list[tuple[str, str]] = []
+    names: set[str] = set()
+    for job_id in dict.fromkeys(ids):
+        state = get_job_state(job_id)
+        path = (state or {}).get("file_path")
+        if not state or state.get("status") != "finished" or not path or not os.path.exists(path):
+            if strict:
+                raise HTTPException(status_code=409, detail=f"job {job_id} has no finished file")
+            continue
+        files.append((path, archive_name(str(state.get("file_name") or path), names)))
+        if disk_budget.enabled():
+            disk_budget.touch(path)
+    if not files:
+        raise HTTPException(status_code=409, detail="no finished files")
+    return deliver_zip(request, files, f"baixar-{batch[:8]}.zip" if batch else "baixar.zip")
+
+
+@app.api_route("/download/{job_id}", methods=["GET", "HEAD"], dependencies=[Depends(optional_basic_auth)])
+def download(job_id: str, request: Request):
     state = get_job_state(job_id)
     if not state:
         raise HTTPException(status_code=404, detail="job not found")
     if state.get("status") != "finished":
+        stream_path = state.get("stream_path")
+        if stream_path and state.get("status") not in TERMINAL_STATUSES and os.path.exists(stream_path):
+            return stream_growing_file(request, job_id, state)
         raise HTTPException(status_code=409, detail="job not finished")
 
     path = state.get("file_path")
     if not path or not os.path.exists(path):
         raise HTTPException(status_code=404, detail="file not found (maybe expired)")
     filename = os.path.basename(path)
-    return FileResponse(path, filename=filename, media_type="application/octet-stream")
+    if disk_budget.enabled():
+        disk_budget.touch(path)
+    return deliver_file(request, path, filename)
 
 
 def main() -> None:
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import os
+import shutil
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from app.settings import settings
+
+# Must be set before prometheus_client is imported: it picks the value storage at import time.
+if settings.metrics_multiproc_dir:
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", settings.metrics_multiproc_dir)
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    values,
+)
+from prometheus_client.core import GaugeMetricFamily  # noqa: E402
+
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+# RQ forks a short-lived work horse per job. Horses of one worker run one at a
+# time, so they can share a metrics file instead of leaving one file per job.
+_identity = {"id": ""}
+
+
+def _process_identifier() -> str:
+    return _identity["id"] or str(os.getpid())
+
+
+if MULTIPROCESS:
+    values.ValueClass = values.MultiProcessValue(_process_identifier)
+
+
+def share_with_parent() -> None:
+    """Call in an RQ work horse: record into the metrics file of the worker that forked it."""
+
+    _identity["id"] = f"horse-{os.getppid()}"
+
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_REDIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+_JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+_THROUGHPUT_BUCKETS = tuple(float(2**n) * 65536 for n in range(0, 12))
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "baixar_http_request_duration_seconds",
+    "Web request latency by route.",
+    ["method", "route", "status"],
+    buckets=_LATENCY_BUCKETS,
+)
+LIST_FORMATS_SECONDS = Histogram(
+    "baixar_list_formats_seconds",
+    "/api/formats latency, including the metadata cache.",
+    ["outcome"],
+    buckets=_LATENCY_BUCKETS,
+)
+EXTRACT_SECONDS = Histogram(
+    "baixar_ytdlp_extract_seconds",
+    "yt-dlp metadata extractions (cache misses).",
+    ["outcome"],
+    buckets=_LATENCY_BUCKETS,
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "baixar_queue_wait_seconds",
+    "Time from enqueue until a worker starts the job.",
+    ["queue"],
+    buckets=_JOB_BUCKETS,
+)
+DOWNLOAD_SECONDS = Histogram(
+    "baixar_download_seconds",
+    "Transfer time of a download (until the last stream is written).",
+    ["mode"],
+    buckets=_JOB_BUCKETS,
+)
+DOWNLOAD_THROUGHPUT = Histogram(
+    "baixar_download_throughput_bytes_per_second",
+    "Average transfer rate of a download.",
+    ["mode"],
+    buckets=_THROUGHPUT_BUCKETS,
+)
+DOWNLOADED_BYTES = Counter("baixar_downloaded_bytes", "Bytes transferred by downloads.", ["mode"])
+POSTPROCESS_SECONDS = Histogram(
+    "baixar_postprocess_seconds",
+    "yt-dlp post-processor (ffmpeg merge/convert) run time.",
+    ["postprocessor"],
+    buckets=_JOB_BUCKETS,
+)
+REDIS_OP_SECONDS = Histogram(
+    "baixar_redis_op_seconds",
+    "Latency of job state reads and writes.",
+    ["op"],
+    buckets=_REDIS_BUCKETS,
+)
+FAILURES = Counter("baixar_failures", "Failed lookups and jobs by cause.", ["stage", "reason"])
+
+
+def failure_reason(message: str) -> str:
+    from app.cookies import is_bot_check
+
+    text = (message or "").lower()
+    if is_bot_check(text):
+        return "bot_check"
+    if "requested format is not available" in text or "format_id not found" in text:
+        return "format_not_available"
+    if "timeout" in text or "timed out" in text:
+        return "timeout"
+    if "disk space" in text or "disk budget" in text:
+        return "disk_full"
+    return "other"
+
+
+def count_failure(stage: str, message: str) -> None:
+    FAILURES.labels(stage=stage, reason=failure_reason(message)).inc()
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+
+
+class _SnapshotCollector:
+    """Queue depth and download volume usage, read at scrape time."""
+
+    def collect(self) -> Iterator[Any]:
+        from rq.registry import StartedJobRegistry
+
+        from app import disk_budget
+        from app.postprocess import POSTPROCESS_QUEUE
+        from app.queueing import LANE_QUEUES, postprocess_q, q
+
+        depth = GaugeMetricFamily("baixar_queue_depth", "Jobs waiting in each RQ queue.", labels=["queue"])
+        running = GaugeMetricFamily("baixar_queue_running", "Jobs being worked on per RQ queue.", labels=["queue"])
+        try:
+            queues = [(name, q(lane)) for lane, name in LANE_QUEUES.items()]
+            queues.append((POSTPROCESS_QUEUE, postprocess_q()))
+            for name, queue in queues:
+                depth.add_metric([name], queue.count)
+                running.add_metric([name], StartedJobRegistry(queue=queue).count)
+        except Exception:
+            pass
+        yield depth
+        yield running
+
+        disk = GaugeMetricFamily("baixar_data_bytes", "Download volume usage.", labels=["kind"])
+        try:
+            usage = shutil.disk_usage(settings.download_dir)
+            disk.add_metric(["total"], usage.total)
+            disk.add_metric(["used"], usage.used)
+            disk.add_metric(["free"], usage.free)
+            if disk_budget.enabled():
+                disk.add_metric(["budget"], settings.disk_budget_bytes)
+                disk.add_metric(["budget_used"], disk_budget.usage())
+        except Exception:
+            pass
+        yield disk
+
+
+def registry(*, snapshot: bool) -> CollectorRegistry:
+    """Registry to expose: this process's metrics, or all processes' in multiprocess mode."""
+
+    if MULTIPROCESS:
+        reg = CollectorRegistry()
+        multiprocess.MultiProcessCollector(reg)
+    else:
+        from prometheus_client import REGISTRY
+
+        reg = REGISTRY
+    if snapshot:
+        reg.register(_SnapshotCollector())  # type: ignore[arg-type]
+    return reg
+
+
+def render(reg: CollectorRegistry) -> tuple[bytes, str]:
+    return generate_latest(reg), CONTENT_TYPE_LATEST
+
+
+def reset_multiprocess_dir() -> None:
+    """Drop files left by previous runs; call once, in the process that starts the others."""
+
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if not path:
+        return
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+
+def start_exporter(port: int) -> None:
+    from prometheus_client import start_http_server
+
+    start_http_server(port, registry=registry(snapshot=False))
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from typing import Any
+
+from app import disk_budget
+from app.info_cache import canonical_video_id
+from app.settings import settings
+from app.store import EXPIRY_KEY, file_expiry_member, redis_conn, set_state
+from app.yt_meta import AUDIO_MODES, format_selector
+
+
+def output_key(*, url: str, format_id: str, container: str, mode: str) -> str:
+    """Content key for a finished output: (video, resolved selector, container/mode)."""
+
+    vid = canonical_video_id(url)
+    if mode == "audio_mp3":
+        kind = "mp3"
+    else:
+        kind = container
+    if str(format_id).startswith("h:") or format_id in ("best", "bestaudio") or mode in AUDIO_MODES:
+        selector = format_selector(format_id, mode)
+    else:
+        # Raw yt-dlp format ids resolve against the format list; key on the id itself.
+        selector = f"id:{format_id}"
+    return f"out:{vid}:{mode}:{kind}:{selector}"
+
+
+def _refs_key(path: str) -> str:
+    return f"outrefs:{os.path.basename(path)}"
+
+
+def _ttl() -> int:
+    return settings.job_ttl_hours * 3600
+
+
+def find_output(key: str) -> dict[str, Any] | None:
+    """Return {"file_path", "title"} for a reusable output, or None."""
+
+    r = redis_conn()
+    raw = r.get(key)
+    if not raw:
+        return None
+    try:
+        data = json.loads(raw)
+    except Exception:
+        data = {}
+    path = data.get("file_path") or ""
+    if not path or not os.path.exists(path):
+        r.delete(key)
+        return None
+    return data
+
+
+def add_ref(path: str, job_id: str) -> None:
+    """Record that job_id serves path until its job state expires."""
+
+    r = redis_conn()
+    k = _refs_key(path)
+    deadline = time.time() + _ttl()
+    pipe = r.pipeline()
+    pipe.zadd(k, {job_id: deadline})
+    pipe.expire(k, _ttl())
+    # The file may go once its last reference has expired.
+    pipe.zadd(EXPIRY_KEY, {file_expiry_member(path): deadline}, gt=True)
+    pipe.execute()
+
+
+def last_ref_deadline(path: str) -> float:
+    """Expiry of the longest-lived reference to path (0 if none)."""
+
+    found = redis_conn().zrange(_refs_key(path), -1, -1, withscores=True)
+    return float(found[0][1]) if found else 0.0
+
+
+def live_refs(path: str) -> int:
+    """Number of jobs still pointing at path (expired references are dropped)."""
+
+    r = redis_conn()
+    k = _refs_key(path)
+    pipe = r.pipeline()
+    pipe.zremrangebyscore(k, "-inf", time.time())
+    pipe.zcard(k)
+    return int(pipe.execute()[1])
+
+
+def publish_output(key: str, *, path: str, title: str, job_id: str) -> None:
+    r = redis_conn()
+    # Under a disk budget outputs stay reusable until evicted, not just for the job TTL.
+    ex = None if disk_budget.enabled() else _ttl()
+    r.set(key, json.dumps({"file_path": path, "title": title}), ex=ex)
+    add_ref(path, job_id)
+
+
+def reuse_output(key: str, job_id: str) -> dict[str, Any] | None:
+    """Point job_id at an existing output; returns the finished-state patch or None."""
+
+    found = find_output(key)
+    if not found:
+        return None
+    path = str(found["file_path"])
+    add_ref(path, job_id)
+    # Keep the index alive as long as someone is using the file.
+    if not disk_budget.enabled():
+        redis_conn().expire(key, _ttl())
+    return {
+        "status": "finished",
+        "progress": 100,
+        "message": "ok (reused)",
+        "title": found.get("title") or "",
+        "file_path": path,
+        "file_name": os.path.basename(path),
+        "reused": True,
+    }
+
+
+# Compare-and-delete: only the job holding the claim may release it.
+_RELEASE_INFLIGHT_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _inflight_key(key: str) -> str:
+    return f"inflight:{key}"
+
+
+def _followers_key(leader_id: str) -> str:
+    return f"followers:{leader_id}"
+
+
+def claim_inflight(key: str, job_id: str) -> str:
+    """Claim key for job_id; returns the job that owns it (job_id itself if claimed)."""
+
+    r = redis_conn()
+    if r.set(_inflight_key(key), job_id, nx=True, ex=_ttl()):
+        return job_id
+    return r.get(_inflight_key(key)) or ""
+
+
+def release_inflight(key: str, job_id: str) -> None:
+    redis_conn().eval(_RELEASE_INFLIGHT_SCRIPT, 1, _inflight_key(key), job_id)
+
+
+def add_follower(leader_id: str, job_id: str) -> None:
+    r = redis_conn()
+    pipe = r.pipeline()
+    pipe.sadd(_followers_key(leader_id), job_id)
+    pipe.expire(_followers_key(leader_id), _ttl())
+    pipe.execute()
+
+
+def adopt_followers(old_leader_id: str, new_leader_id: str) -> None:
+    """Attach the followers of a dead leader to the job that took over its claim."""
+
+    r = redis_conn()
+    followers = list(r.smembers(_followers_key(old_leader_id)))
+    if not followers:
+        return
+    pipe = r.pipeline()
+    pipe.sadd(_followers_key(new_leader_id), *followers)
+    pipe.expire(_followers_key(new_leader_id), _ttl())
+    pipe.delete(_followers_key(old_leader_id))
+    pipe.execute()
+    for fid in followers:
+        set_state(fid, {"leader_id": new_leader_id})
+
+
+def settle_followers(leader_id: str, patch: dict[str, Any]) -> list[str]:
+    """Copy the leader's terminal state to every follower; returns the follower ids."""
+
+    r = redis_conn()
+    followers = list(r.smembers(_followers_key(leader_id)))
+    for fid in followers:
+        if patch.get("status") == "finished" and patch.get("file_path"):
+            add_ref(str(patch["file_path"]), fid)
+        set_state(fid, patch)
+    r.delete(_followers_key(leader_id))
+    return followers
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import subprocess
+from typing import Any
+
+from app.settings import settings
+
+# Pipeline stages: download jobs fetch the raw streams of their plan and hand
+# the ffmpeg work (merge, remux, mp3) to this queue, drained by CPU-sized workers.
+POSTPROCESS_QUEUE = "postprocess"
+
+# The yt-dlp post-processor each step replaces (metrics labels match the single-job path).
+PP_NAMES = {"merge": "FFmpegMerger", "remux": "FFmpegVideoRemuxer", "transcode": "FFmpegExtractAudio"}
+
+_MUXERS = {"mp4": "mp4", "webm": "webm", "mkv": "matroska", "m4a": "ipod", "opus": "opus", "ogg": "ogg", "mp3": "mp3"}
+
+
+def enabled() -> bool:
+    return settings.split_postprocess
+
+
+def wants_handoff(plan: dict[str, Any]) -> bool:
+    """Whether the plan's ffmpeg step can run as a separate stage (concrete streams, known processing)."""
+
+    if plan.get("processing") not in PP_NAMES:
+        return False
+    ids = [plan[k].get("format_id") for k in ("video", "audio") if k in plan]
+    return bool(ids) and (plan["processing"] != "merge" or len(ids) == 2)
+
+
+def raw_ids(plan: dict[str, Any]) -> list[str]:
+    """Format ids of the plan's streams, video first."""
+
+    return [str(plan[k]["format_id"]) for k in ("video", "audio") if k in plan]
+
+
+def raw_format(plan: dict[str, Any]) -> str:
+    """yt-dlp selector that downloads the plan's streams as separate files ("137,140").
+
+    It has no fallback: a stream that is gone is simply not downloaded.
+    """
+
+    return ",".join(raw_ids(plan))
+
+
+def command(inputs: list[dict[str, Any]], output: str, *, processing: str, ext: str) -> list[str]:
+    """ffmpeg command for one step. inputs: [{"path", "video"}] in plan order (video first)."""
+
+    cmd = ["ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "error", "-y"]
+    for src in inputs:
+        cmd += ["-i", src["path"]]
+
+    if processing == "transcode":
+        cmd += ["-map", "0:a:0", "-vn", "-c:a", "libmp3lame", "-q:a", "0"]
+    elif processing == "merge":
+        video = next((i for i, src in enumerate(inputs) if src["video"]), 0)
+        audio = next((i for i, src in enumerate(inputs) if i != video), 1)
+        cmd += ["-map", f"{video}:v:0", "-map", f"{audio}:a:0", "-c", "copy"]
+    elif inputs[0]["video"]:
+        cmd += ["-map", "0:v:0", "-map", "0:a:0?", "-c", "copy"]
+    else:
+        cmd += ["-map", "0:a:0", "-vn", "-c", "copy"]
+
+    if ext in ("mp4", "m4a"):
+        cmd += ["-movflags", "+faststart"]
+    return cmd + ["-f", _MUXERS.get(ext, ext), output]
+
+
+def run(cmd: list[str]) -> None:
+    proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        lines = proc.stderr.decode("utf-8", "replace").strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f"ffmpeg exited with status {proc.returncode}")
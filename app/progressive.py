@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import subprocess
+import threading
+from typing import Any, Callable
+
+from app.settings import settings
+from app.yt_meta import CONTAINER_CODECS
+
+_MUXERS = {
+    # Fragmented MP4 with an empty moov is playable from the first fragment.
+    "mp4": ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4"],
+    "webm": ["-f", "webm"],
+    "mkv": ["-f", "matroska"],
+}
+
+_READ_BYTES = 256 * 1024
+
+
+def enabled() -> bool:
+    return settings.progressive_downloads
+
+
+def _has(codec: Any) -> bool:
+    return bool(codec) and codec != "none"
+
+
+def _codec_ok(codec: Any, allowed: tuple[str, ...]) -> bool:
+    return str(codec).lower().startswith(allowed)
+
+
+def _headers(ydl: Any, fmt: dict[str, Any]) -> str:
+    headers = dict(fmt.get("http_headers") or {})
+    cookie = ydl.cookiejar.get_cookie_header(fmt["url"])
+    if cookie:
+        headers["Cookie"] = cookie
+    return "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+
+
+def plan(ydl: Any, resolved: dict[str, Any], *, mode: str, container: str) -> list[dict[str, Any]] | None:
+    """Return ffmpeg inputs for the resolved formats if the output can be streamed.
+
+    resolved is the info after format selection (process_ie_result with
+    download=False). Streamable means plain HTTP sources and, for video, codecs
+    the container can carry as-is; anything else (HLS/DASH manifests, codec
+    mismatches) returns None and the job takes the normal download-then-merge path.
+    """
+
+    formats = resolved.get("requested_formats") or [resolved]
+    if any(f.get("protocol") not in ("http", "https") or not f.get("url") for f in formats):
+        return None
+
+    if mode == "audio":
+        # Native audio needs at most a remux into a seekable container; the normal path does that.
+        return None
+    if mode == "audio_mp3":
+        if len(formats) != 1 or not _has(formats[0].get("acodec")):
+            return None
+    else:
+        if container not in _MUXERS:
+            return None
+        allowed = CONTAINER_CODECS.get(container)
+        for f in formats:
+            vcodec, acodec = f.get("vcodec"), f.get("acodec")
+            if allowed and _has(vcodec) and not _codec_ok(vcodec, allowed[0]):
+                return None
+            if allowed and _has(acodec) and not _codec_ok(acodec, allowed[1]):
+                return None
+
+    return [
+        {
+            "url": f["url"],
+            "headers": _headers(ydl, f),
+            "video": _has(f.get("vcodec")),
+            "audio": _has(f.get("acodec")),
+        }
+        for f in formats
+    ]
+
+
+def ffmpeg_command(inputs: list[dict[str, Any]], *, mode: str, container: str) -> list[str]:
+    cmd = ["ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "error", "-nostats", "-progress", "pipe:2"]
+    for src in inputs:
+        cmd += ["-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5"]
+        if src["headers"]:
+            cmd += ["-headers", src["headers"]]
+        cmd += ["-i", src["url"]]
+
+    if mode == "audio_mp3":
+        cmd += ["-map", "0:a:0", "-c:a", "libmp3lame", "-q:a", "0", "-f", "mp3"]
+    else:
+        video = next((i for i, src in enumerate(inputs) if src["video"]), None)
+        audio = next((i for i, src in enumerate(inputs) if src["audio"] and i != video), None)
+        if audio is None:
+            audio = next((i for i, src in enumerate(inputs) if src["audio"]), None)
+        if video is not None:
+            cmd += ["-map", f"{video}:v:0"]
+        if audio is not None:
+            cmd += ["-map", f"{audio}:a:0"]
+        cmd += ["-c", "copy"] + _MUXERS[container]
+    # A pipe is not seekable, so the muxer never goes back to rewrite bytes already served.
+    return cmd + ["pipe:1"]
+
+
+def stream_to_file(cmd: list[str], path: str, on_progress: Callable[[int, float], None]) -> None:
+    """Run ffmpeg and append its output to path as it is produced.
+
+    on_progress(new_bytes, media_seconds) is called after every write.
+    """
+
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    errors: list[str] = []
+    position = [0.0]
+
+    def read_stderr() -> None:
+        assert proc.stderr is not None
+        for raw in proc.stderr:
+            line = raw.decode("utf-8", "replace").strip()
+            key, sep, value = line.partition("=")
+            if key == "out_time_us" and value.isdigit():
+                position[0] = int(value) / 1_000_000
+            elif line and not (sep and " " not in key):
+                errors.append(line)
+
+    reader = threading.Thread(target=read_stderr, daemon=True)
+    reader.start()
+    try:
+        assert proc.stdout is not None
+        with open(path, "wb") as out:
+            while True:
+                data = proc.stdout.read1(_READ_BYTES)
+                if not data:
+                    break
+                out.write(data)
+                out.flush()
+                on_progress(len(data), position[0])
+        rc = proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    reader.join(timeout=5)
+    if rc != 0:
+        raise RuntimeError(errors[-1] if errors else f"ffmpeg exited with status {rc}")
@@ -1,28 +1,165 @@
 from __future__ import annotations
 
 import os
+import time
+import uuid
 from typing import Any
 
 from redis import Redis
-from rq import Queue
+from rq import Queue, Worker
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
 
+from app.info_cache import peek_info
+from app.postprocess import POSTPROCESS_QUEUE
+from app.outputs import add_follower, add_ref, adopt_followers, claim_inflight, output_key, release_inflight, reuse_output
 from app.settings import settings
-from app.store import get_state, set_state
-from app.yt_job import run_download
+from app.store import TERMINAL_STATUSES, get_state, redis_bytes_conn, set_state
+from app.yt_job import run_download, run_postprocess
+from app.yt_meta import AUDIO_MODES
 
 
 def rq_conn() -> Redis:
-    return Redis.from_url(settings.redis_url)
+    return redis_bytes_conn()
 
 
-def q() -> Queue:
-    return Queue("downloads", connection=rq_conn())
+# Priority lanes, in default drain order.
+LANE_QUEUES = {
+    "short": "downloads_short",
+    "normal": "downloads",
+    "long": "downloads_long",
+}
 
 
-def enqueue_download(*, url: str, format_id: str, container: str, mode: str) -> str:
+def q(lane: str = "normal") -> Queue:
+    return Queue(LANE_QUEUES[lane], connection=rq_conn())
+
+
+def postprocess_q() -> Queue:
+    return Queue(POSTPROCESS_QUEUE, connection=rq_conn())
+
+
+def lane_queues() -> list[Queue]:
+    return [q(lane) for lane in LANE_QUEUES]
+
+
+def classify_lane(*, mode: str, duration: float | None) -> str:
+    """Pick a lane from the job's mode and (if known) the video duration."""
+
+    d = float(duration or 0)
+    if d and d >= settings.lane_long_min_duration_seconds:
+        return "long"
+    if d and d <= settings.lane_short_max_duration_seconds:
+        return "short"
+    # Audio is quick unless long; without a duration it may be a multi-hour podcast.
+    if d and mode in AUDIO_MODES:
+        return "short"
+    return "normal"
+
+
+def _lane_timeout(lane: str) -> int:
+    return {
+        "short": settings.lane_short_timeout_seconds,
+        "normal": settings.lane_normal_timeout_seconds,
+        "long": settings.lane_long_timeout_seconds,
+    }[lane]
+
+
+# A leader whose RQ job is not there yet may still be between writing its state and enqueueing.
+_ENQUEUE_GRACE_SECONDS = 10
+
+
+def _leader_alive(leader_id: str, leader: dict[str, Any]) -> bool:
+    """Whether the leader's RQ job is still waiting or running on a live worker.
+
+    Its state alone stays "downloading" forever when the worker is killed.
+    """
+
+    handoff = leader.get("handoff") or {}
+    rq_job_id = str(handoff.get("rq_job_id") or leader_id) if leader.get("stage") == "postprocess" else leader_id
+    conn = rq_conn()
+    try:
+        job = Job.fetch(rq_job_id, connection=conn)
+    except NoSuchJobError:
+        queued_at = float((leader.get("timings") or {}).get("queued") or 0)
+        return time.time() - queued_at < _ENQUEUE_GRACE_SECONDS
+    status = job.get_status(refresh=False)
+    if status == JobStatus.STARTED:
+        # Worker keys expire shortly after the worker stops sending heartbeats.
+        return bool(job.worker_name) and bool(conn.exists(Worker.redis_worker_namespace_prefix + job.worker_name))
+    return status in (JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED)
+
+
+# Fields a follower copies from the job it is attached to.
+_MIRRORED_FIELDS = ("status", "progress", "message", "error", "title", "file_path", "file_name", "stream_path")
+
+
+def enqueue_download(
+    *,
+    url: str,
+    format_id: str,
+    container: str,
+    mode: str,
+    duration: float | None = None,
+    batch_id: str = "",
+) -> str:
     os.makedirs(settings.download_dir, exist_ok=True)
 
-    job = q().enqueue(
+    base_state = {
+        "status": "queued",
+        "progress": 0,
+        "message": "queued",
+        "url": url,
+        "format_id": format_id,
+        "container": container,
+        "mode": mode,
+        "timings": {"queued": round(time.time(), 3)},
+    }
+    if batch_id:
+        base_state["batch_id"] = batch_id
+
+    # Same video/selector/container already on disk: finish without a worker.
+    job_id = str(uuid.uuid4())
+    key = output_key(url=url, format_id=format_id, container=container, mode=mode)
+    reused = reuse_output(key, job_id)
+    if reused:
+        set_state(job_id, {"job_id": job_id, **base_state, **reused})
+        return job_id
+
+    # Written before claiming, so a request that finds our claim sees a live leader
+    # (within _ENQUEUE_GRACE_SECONDS) rather than a missing state it would take over.
+    set_state(job_id, {"job_id": job_id, **base_state})
+
+    # Same output already queued/downloading: follow that job instead of pulling the stream twice.
+    stale_id = ""
+    for _ in range(3):
+        leader_id = claim_inflight(key, job_id)
+        if leader_id == job_id:
+            if stale_id:
+                adopt_followers(stale_id, job_id)
+            break
+        leader = get_state(leader_id) if leader_id else None
+        if leader and leader.get("status") not in TERMINAL_STATUSES and _leader_alive(leader_id, leader):
+            set_state(job_id, {"leader_id": leader_id, "message": "waiting for identical download"})
+            add_follower(leader_id, job_id)
+            return job_id
+        # Stale claim (leader gone, dead or already done); take it over.
+        if leader_id:
+            release_inflight(key, leader_id)
+            stale_id = leader_id
+    else:
+        # Never enqueue without holding the claim: that would download the same output twice.
+        set_state(job_id, {"status": "failed", "message": "failed", "error": "identical download is restarting; try again"})
+        return job_id
+
+    if not duration:
+        # Usually warm from the format listing; never extract here.
+        duration = (peek_info(url) or {}).get("duration")
+    lane = classify_lane(mode=mode, duration=duration)
+
+    # Write the lane first so a fast worker's "started" is not overwritten.
+    set_state(job_id, {"lane": lane})
+    q(lane).enqueue(
         run_download,
         kwargs={
             "url": url,
@@ -30,28 +167,28 @@ def enqueue_download(*, url: str, format_id: str, container: str, mode: str) ->
             "container": container,
             "mode": mode,
             "download_dir": settings.download_dir,
-            "redis_url": settings.redis_url,
             "job_ttl_hours": settings.job_ttl_hours,
+            "batch_id": batch_id,
         },
-        job_timeout="2h",
+        job_id=job_id,
+        job_timeout=_lane_timeout(lane),
         result_ttl=settings.job_ttl_hours * 3600,
         failure_ttl=settings.job_ttl_hours * 3600,
     )
+    return job_id
 
-    set_state(
-        job.id,
-        {
-            "job_id": job.id,
-            "status": "queued",
-            "progress": 0,
-            "message": "queued",
-            "url": url,
-            "format_id": format_id,
-            "container": container,
-            "mode": mode,
-        },
+
+def enqueue_postprocess(rq_job_id: str, **kwargs: Any) -> None:
+    """Queue the ffmpeg stage of a download job (kwargs of run_postprocess)."""
+
+    postprocess_q().enqueue(
+        run_postprocess,
+        kwargs=kwargs,
+        job_id=rq_job_id,
+        job_timeout=settings.postprocess_timeout_seconds,
+        result_ttl=settings.job_ttl_hours * 3600,
+        failure_ttl=settings.job_ttl_hours * 3600,
     )
-    return job.id
 
 
 def get_job_state(job_id: str) -> dict[str, Any] | None:
@@ -59,7 +196,21 @@ def get_job_state(job_id: str) -> dict[str, Any] | None:
     if not state:
         return None
 
-    if state.get("status") == "finished":
+    leader_id = state.get("leader_id")
+    if leader_id and state.get("status") not in TERMINAL_STATUSES:
+        leader = get_state(leader_id)
+        if leader:
+            mirrored = {k: leader[k] for k in _MIRRORED_FIELDS if k in leader}
+            state.update(mirrored)
+            if leader.get("status") in TERMINAL_STATUSES:
+                # Leader settled before this follower was registered; persist the outcome.
+                if leader.get("status") == "finished" and leader.get("file_path"):
+                    add_ref(str(leader["file_path"]), job_id)
+                set_state(job_id, mirrored)
+
+    # Progressive jobs can be downloaded while the worker is still writing the file.
+    streaming = bool(state.get("stream_path")) and state.get("status") not in TERMINAL_STATUSES
+    if state.get("status") == "finished" or streaming:
         base = settings.public_base_url.rstrip("/")
         state["download_url"] = f"{base}/download/{job_id}" if base else f"/download/{job_id}"
     return state
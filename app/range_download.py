@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+import uuid
+from typing import Any
+
+import yt_dlp
+from yt_dlp.downloader import get_suitable_downloader
+from yt_dlp.downloader.http import HttpFD
+from yt_dlp.networking import Request
+
+from app.settings import settings
+from app.store import redis_conn
+
+_SLOTS_KEY = "rangeconn:active"
+
+# Connection slots of a crashed worker are freed after this long without a heartbeat.
+_SLOT_TTL_SECONDS = 60
+_CHUNK_RETRIES = 3
+
+# Grant up to ARGV[4] connection slots without exceeding ARGV[3] cluster-wide.
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local expires = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local want = tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local free = limit - redis.call('ZCARD', KEYS[1])
+local grant = math.max(0, math.min(want, free))
+for i = 1, grant do
+  redis.call('ZADD', KEYS[1], expires, ARGV[5] .. ':' .. i)
+end
+return grant
+"""
+
+
+def enabled() -> bool:
+    return settings.range_connections_per_job > 1
+
+
+def wants_split(info: dict[str, Any]) -> bool:
+    """Whether a single stream is large and plain enough to fetch in parallel ranges."""
+
+    if info.get("protocol") not in ("http", "https"):
+        return False
+    size = info.get("filesize") or info.get("filesize_approx") or 0
+    return int(size) >= settings.range_split_min_bytes
+
+
+class _Slots:
+    # Cluster-wide connection budget (RANGE_CONNECTIONS_TOTAL, 0 = no cap).
+
+    def __init__(self, want: int) -> None:
+        self.members: list[str] = []
+        self._last_beat = time.monotonic()
+        limit = settings.range_connections_total
+        if limit <= 0:
+            self.granted = want
+            return
+        prefix = uuid.uuid4().hex
+        now = time.time()
+        r = redis_conn()
+        self.granted = int(
+            r.eval(_ACQUIRE_SCRIPT, 1, _SLOTS_KEY, now, now + _SLOT_TTL_SECONDS, limit, want, prefix)
+        )
+        self.members = [f"{prefix}:{i}" for i in range(1, self.granted + 1)]
+
+    def heartbeat(self) -> None:
+        if not self.members or time.monotonic() - self._last_beat < _SLOT_TTL_SECONDS / 3:
+            return
+        self._last_beat = time.monotonic()
+        expires = time.time() + _SLOT_TTL_SECONDS
+        redis_conn().zadd(_SLOTS_KEY, {m: expires for m in self.members}, xx=True)
+
+    def release(self) -> None:
+        if self.members:
+            redis_conn().zrem(_SLOTS_KEY, *self.members)
+            self.members = []
+
+
+class RangeSplitFD(HttpFD):
+    """Fetches one HTTP stream as parallel byte ranges into a preallocated file.
+
+    The stream is cut into RANGE_CHUNK_BYTES pieces that a small pool of
+    threads pulls from a shared cursor; each piece is written in place with
+    pwrite, so there is no reassembly step. Falls back to the normal single
+    connection download when the server ignores Range or no slots are free.
+    """
+
+    FD_NAME = "rangesplit"
+
+    def _probe_size(self, url: str, headers: dict[str, str]) -> int:
+        # A one-byte range request tells us the size and whether ranges are honoured.
+        with self.ydl.urlopen(Request(url, headers={**headers, "Range": "bytes=0-0"})) as resp:
+            content_range = resp.headers.get("Content-Range") or ""
+            if resp.status != 206 or "/" not in content_range:
+                return 0
+            total = content_range.rsplit("/", 1)[1]
+            return int(total) if total.isdigit() else 0
+
+    def real_download(self, filename: str, info_dict: dict[str, Any]) -> bool:
+        url = info_dict["url"]
+        headers = {"Accept-Encoding": "identity", **(info_dict.get("http_headers") or {})}
+        try:
+            size = self._probe_size(url, headers)
+        except Exception:
+            size = 0
+        chunk = max(1024 * 1024, settings.range_chunk_bytes)
+        if size <= chunk:
+            return super().real_download(filename, info_dict)
+
+        want = min(settings.range_connections_per_job, -(-size // chunk))
+        slots = _Slots(want)
+        if slots.granted < 2:
+            slots.release()
+            return super().real_download(filename, info_dict)
+
+        try:
+            return self._split_download(filename, info_dict, url, headers, size, chunk, slots)
+        finally:
+            slots.release()
+
+    def _split_download(
+        self,
+        filename: str,
+        info_dict: dict[str, Any],
+        url: str,
+        headers: dict[str, str],
+        size: int,
+        chunk: int,
+        slots: _Slots,
+    ) -> bool:
+        tmpfilename = self.temp_name(filename)
+        self.to_screen(f"[download] Destination: {tmpfilename} ({slots.granted} connections)")
+
+        fd = os.open(tmpfilename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    os.ftruncate(fd, size)
+            else:
+                os.ftruncate(fd, size)
+
+            lock = threading.Lock()
+            cursor = [0]
+            done = [0]
+            errors: list[BaseException] = []
+            start = time.time()
+            block = max(64 * 1024, self.params.get("buffersize") or 0)
+
+            def report() -> None:
+                # Called with the lock held, so hooks and rate limiting see one aggregate stream.
+                now = time.time()
+                elapsed = now - start
+                self.slow_down(start, now, done[0])
+                speed = done[0] / elapsed if elapsed > 0 else None
+                self._hook_progress(
+                    {
+                        "status": "downloading",
+                        "downloaded_bytes": done[0],
+                        "total_bytes": size,
+                        "tmpfilename": tmpfilename,
+                        "filename": filename,
+                        "eta": self.calc_eta(start, now, size, done[0]),
+                        "speed": speed,
+                        "elapsed": elapsed,
+                    },
+                    info_dict,
+                )
+                slots.heartbeat()
+
+            def fetch(begin: int, end: int) -> None:
+                offset = begin
+                for attempt in range(_CHUNK_RETRIES + 1):
+                    try:
+                        req = Request(url, headers={**headers, "Range": f"bytes={offset}-{end}"})
+                        with self.ydl.urlopen(req) as resp:
+                            if resp.status != 206:
+                                raise OSError(f"server answered {resp.status} to a range request")
+                            while offset <= end:
+                                data = resp.read(min(block, end - offset + 1))
+                                if not data:
+                                    break
+                                os.pwrite(fd, data, offset)
+                                offset += len(data)
+                                with lock:
+                                    done[0] += len(data)
+                                    report()
+                        if offset > end:
+                            return
+                        raise OSError("connection closed before the range was complete")
+                    except Exception:
+                        if attempt == _CHUNK_RETRIES or errors:
+                            raise
+                        time.sleep(1 + attempt)
+
+            def worker() -> None:
+                while True:
+                    with lock:
+                        if errors or cursor[0] >= size:
+                            return
+                        begin = cursor[0]
+                        cursor[0] = min(size, begin + chunk)
+                        end = cursor[0] - 1
+                    try:
+                        fetch(begin, end)
+                    except BaseException as e:
+                        with lock:
+                            errors.append(e)
+                        return
+
+            threads = [threading.Thread(target=worker, daemon=True) for _ in range(slots.granted)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            os.close(fd)
+
+        if errors:
+            raise errors[0]
+
+        self.try_rename(tmpfilename, filename)
+        self._hook_progress(
+            {
+                "downloaded_bytes": size,
+                "total_bytes": size,
+                "filename": filename,
+                "status": "finished",
+                "elapsed": time.time() - start,
+            },
+            info_dict,
+        )
+        return True
+
+
+class RangeSplitYoutubeDL(yt_dlp.YoutubeDL):
+    """YoutubeDL that hands large single-file HTTP streams to RangeSplitFD."""
+
+    def dl(self, name: str, info: dict[str, Any], subtitle: bool = False, test: bool = False) -> Any:
+        if test or subtitle or name == "-" or not wants_split(info):
+            return super().dl(name, info, subtitle, test)
+        if get_suitable_downloader(info, self.params) is not HttpFD:
+            # External downloaders or special protocols stay on their own path.
+            return super().dl(name, info, subtitle, test)
+
+        fd = RangeSplitFD(self, self.params)
+        for ph in self._progress_hooks:
+            fd.add_progress_hook(ph)
+        new_info = self._copy_infodict(info)
+        if new_info.get("http_headers") is None:
+            new_info["http_headers"] = self._calc_headers(new_info)
+        return fd.download(name, new_info, subtitle)
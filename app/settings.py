@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from typing import Literal
+
 from pydantic_settings import BaseSettings
 
 
@@ -8,10 +10,94 @@ class Settings(BaseSettings):
     download_dir: str = "/data"
     job_ttl_hours: int = 24
     clean_interval_seconds: int = 3600
+    clean_batch_size: int = 500
+    clean_reconcile_interval_seconds: int = 86400
     public_base_url: str = ""
     basic_auth_user: str = ""
     basic_auth_pass: str = ""
     port: int = 8090
+    # Process-wide Redis connection pool.
+    redis_max_connections: int = 50
+    redis_pool_timeout_seconds: int = 20
+    redis_health_check_interval_seconds: int = 30
+    redis_socket_connect_timeout_seconds: float = 5.0
+    # Leave unset for workers: RQ uses long blocking reads on the same pool.
+    redis_socket_timeout_seconds: float | None = None
+    # Shared yt-dlp metadata cache (format URLs expire after a few hours).
+    info_cache_ttl_seconds: int = 900
+    info_cache_lock_seconds: int = 60
+    # Web-side extraction pool for /api/formats.
+    extract_workers: int = 4
+    extract_queue_max: int = 8
+    extract_timeout_seconds: float = 60.0
+    # Minimum spacing between progress writes per job (status changes are always written).
+    progress_write_interval_seconds: float = 1.0
+    # Worker supervisor (python -m app.worker with WORKER_SUPERVISOR=1).
+    worker_supervisor: bool = False
+    worker_min_processes: int = 1
+    worker_max_processes: int = 4
+    worker_scale_interval_seconds: float = 5.0
+    worker_scale_up_wait_seconds: float = 10.0
+    worker_scale_down_idle_seconds: float = 120.0
+    # Warm workers (WORKER_WARM=1): jobs run in the worker process, yt-dlp is loaded once;
+    # a worker exits after WORKER_MAX_JOBS jobs (0 = never) and is restarted fresh.
+    worker_warm: bool = False
+    worker_max_jobs: int = 200
+    # Pipeline stages (SPLIT_POSTPROCESS=1): downloads hand ffmpeg work to the "postprocess" queue.
+    # WORKER_STAGE picks what a worker drains: download (the lanes), postprocess or all;
+    # unset, that is download when splitting and all otherwise.
+    split_postprocess: bool = False
+    worker_stage: Literal["", "download", "postprocess", "all"] = ""
+    # Supervisor bound for postprocess workers (0 = one per CPU core).
+    postprocess_max_processes: int = 0
+    postprocess_timeout_seconds: int = 3600
+    # Priority lanes: short (audio / short videos), normal, long.
+    lane_short_max_duration_seconds: int = 600
+    lane_long_min_duration_seconds: int = 3600
+    lane_short_timeout_seconds: int = 1800
+    lane_normal_timeout_seconds: int = 7200
+    lane_long_timeout_seconds: int = 14400
+    # Weighted drain order for workers, and how long a long-lane job may wait before it jumps ahead.
+    lane_weight_short: int = 6
+    lane_weight_normal: int = 3
+    lane_weight_long: int = 1
+    lane_long_max_wait_seconds: int = 900
+    # Cluster-wide download bandwidth budget (bytes/s, 0 = unlimited), shared via Redis.
+    bandwidth_total_bytes_per_second: int = 0
+    bandwidth_per_job_bytes_per_second: int = 0
+    bandwidth_refresh_seconds: float = 2.0
+    bandwidth_charge_bytes: int = 262144
+    # Parallel range downloads for large streams (1 connection per job = off).
+    range_connections_per_job: int = 1
+    range_connections_total: int = 0
+    range_split_min_bytes: int = 100 * 1024 * 1024
+    range_chunk_bytes: int = 8 * 1024 * 1024
+    # /download delivery: "" (served by the app), "x-accel" (nginx) or "x-sendfile" (Apache/lighttpd).
+    download_offload: str = ""
+    download_accel_prefix: str = "/protected-downloads"
+    # Stream-while-downloading: remux streamable outputs with one ffmpeg pass that /download tails.
+    progressive_downloads: bool = False
+    # Disk budget for the download volume (0 = off: files only expire with JOB_TTL_HOURS).
+    disk_budget_bytes: int = 0
+    disk_high_watermark: float = 0.9
+    disk_low_watermark: float = 0.8
+    disk_default_reservation_bytes: int = 512 * 1024 * 1024
+    disk_reservation_ttl_seconds: int = 14400
+    disk_reserve_wait_seconds: float = 60.0
+    # Cookie pool: accounts that hit a bot check are skipped for this long.
+    cookie_cooldown_seconds: int = 1800
+    # Batches: children running at once per batch, items per batch, playlist page size.
+    batch_max_concurrency: int = 3
+    batch_max_items: int = 500
+    batch_expand_page_size: int = 50
+    # Prometheus: shared directory for multi-process metrics (set for workers) and the worker exporter port.
+    metrics_multiproc_dir: str = ""
+    worker_metrics_port: int = 9101
+    # /api/stats: width of the time buckets and how long they are kept.
+    stats_bucket_seconds: int = 300
+    stats_retention_seconds: int = 86400
+    # Server-Sent Events: comment ping interval (state is also re-read on each ping).
+    sse_keepalive_seconds: int = 15
 
 
 settings = Settings()
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import math
+import time
+from typing import Any
+
+from app.settings import settings
+from app.store import redis_conn
+
+# One hash per (time bucket, mode, container, phase): log-scale histogram bins
+# plus "n" (count) and "sum". Reads add up the buckets of the requested window,
+# so percentiles never need a scan of job states.
+_DIMS_KEY = "stats:dims"
+
+# Bin i holds durations in [BASE**i, BASE**(i+1)): about 19% wide.
+_BASE = 2**0.25
+_MIN_SECONDS = 0.001
+
+PHASES = ("queue", "extract", "download", "postprocess_queue", "postprocess", "total")
+
+
+def _bin(seconds: float) -> int:
+    return math.floor(math.log(max(seconds, _MIN_SECONDS), _BASE))
+
+
+def _bin_value(index: int) -> float:
+    # Geometric middle of the bin.
+    return _BASE ** (index + 0.5)
+
+
+def _key(bucket: int, dims: str) -> str:
+    return f"stats:{bucket}:{dims}"
+
+
+def phase_durations(timings: dict[str, float]) -> dict[str, float]:
+    """Seconds spent in each phase, from the timestamps recorded in a job's state."""
+
+    spans = {
+        "queue": ("queued", "started"),
+        "extract": ("started", "extracted"),
+        "download": ("download_started", "download_finished"),
+        # Only with pipeline stages: waiting in the postprocess queue.
+        "postprocess_queue": ("handoff", "postprocess_started"),
+        "postprocess": ("postprocess_started", "postprocess_finished"),
+        "total": ("queued", "finished"),
+    }
+    out: dict[str, float] = {}
+    for phase, (a, b) in spans.items():
+        if a in timings and b in timings and timings[b] >= timings[a]:
+            out[phase] = round(timings[b] - timings[a], 3)
+    return out
+
+
+def record(*, mode: str, container: str, phases: dict[str, float], nbytes: int = 0) -> None:
+    """Add one finished job to the current time bucket."""
+
+    width = settings.stats_bucket_seconds
+    bucket = int(time.time()) // width * width
+    ttl = settings.stats_retention_seconds + width
+    pipe = redis_conn().pipeline(transaction=False)
+    for phase, seconds in phases.items():
+        dims = f"{mode}:{container}:{phase}"
+        k = _key(bucket, dims)
+        pipe.hincrby(k, str(_bin(seconds)), 1)
+        pipe.hincrby(k, "n", 1)
+        pipe.hincrbyfloat(k, "sum", seconds)
+        if phase == "download" and nbytes:
+            pipe.hincrby(k, "bytes", nbytes)
+        pipe.expire(k, ttl)
+        pipe.sadd(_DIMS_KEY, dims)
+    pipe.execute()
+
+
+def _percentile(bins: dict[int, int], total: int, q: float) -> float:
+    rank = q * total
+    seen = 0
+    for index in sorted(bins):
+        seen += bins[index]
+        if seen >= rank:
+            return round(_bin_value(index), 3)
+    return 0.0
+
+
+def summary(window_seconds: int) -> dict[str, Any]:
+    """Count, mean and p50/p90/p99 per mode, container and phase over the last window."""
+
+    width = settings.stats_bucket_seconds
+    window_seconds = max(width, min(window_seconds, settings.stats_retention_seconds))
+    newest = int(time.time()) // width * width
+    buckets = list(range(newest - window_seconds + width, newest + width, width))
+
+    r = redis_conn()
+    all_dims = sorted(r.smembers(_DIMS_KEY))
+    pipe = r.pipeline(transaction=False)
+    for dims in all_dims:
+        for bucket in buckets:
+            pipe.hgetall(_key(bucket, dims))
+    rows = pipe.execute()
+
+    groups = []
+    for i, dims in enumerate(all_dims):
+        bins: dict[int, int] = {}
+        n, total_seconds, nbytes = 0, 0.0, 0
+        for h in rows[i * len(buckets) : (i + 1) * len(buckets)]:
+            for field, value in h.items():
+                if field == "n":
+                    n += int(value)
+                elif field == "sum":
+                    total_seconds += float(value)
+                elif field == "bytes":
+                    nbytes += int(value)
+                else:
+                    bins[int(field)] = bins.get(int(field), 0) + int(value)
+        if not n:
+            continue
+        mode, container, phase = dims.split(":", 2)
+        group: dict[str, Any] = {
+            "mode": mode,
+            "container": container,
+            "phase": phase,
+            "count": n,
+            "mean": round(total_seconds / n, 3),
+            "p50": _percentile(bins, n, 0.5),
+            "p90": _percentile(bins, n, 0.9),
+            "p99": _percentile(bins, n, 0.99),
+        }
+        if phase == "download" and total_seconds:
+            group["bytes"] = nbytes
+            group["bytes_per_second"] = int(nbytes / total_seconds)
+        groups.append(group)
+
+    order = {p: i for i, p in enumerate(PHASES)}
+    groups.sort(key=lambda g: (g["mode"], g["container"], order.get(g["phase"], len(order))))
+    return {"window_seconds": window_seconds, "bucket_seconds": width, "groups": groups}
@@ -1,25 +1,80 @@
 from __future__ import annotations
 
 import json
+import threading
 import time
 from typing import Any
 
-from redis import Redis
+from redis import BlockingConnectionPool, Redis
+from redis.exceptions import ResponseError
 
+from app.metrics import REDIS_OP_SECONDS, timed
 from app.settings import settings
 
+# Statuses after which a job's state no longer changes.
+TERMINAL_STATUSES = ("finished", "failed")
+
+
+_pools: dict[bool, BlockingConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(decode_responses: bool) -> BlockingConnectionPool:
+    # One pool per process and response type; redis-py resets it after fork.
+    with _pools_lock:
+        pool = _pools.get(decode_responses)
+        if pool is None:
+            pool = BlockingConnectionPool.from_url(
+                settings.redis_url,
+                decode_responses=decode_responses,
+                max_connections=settings.redis_max_connections,
+                timeout=settings.redis_pool_timeout_seconds,
+                health_check_interval=settings.redis_health_check_interval_seconds,
+                socket_connect_timeout=settings.redis_socket_connect_timeout_seconds,
+                socket_timeout=settings.redis_socket_timeout_seconds,
+                socket_keepalive=True,
+            )
+            _pools[decode_responses] = pool
+    return pool
+
 
 def redis_conn() -> Redis:
-    return Redis.from_url(settings.redis_url, decode_responses=True)
+    """Text (decoded) client backed by the process-wide pool."""
+
+    return Redis(connection_pool=_pool(True))
+
+
+def redis_bytes_conn() -> Redis:
+    """Binary client backed by the process-wide pool (RQ stores pickled payloads)."""
+
+    return Redis(connection_pool=_pool(False))
 
 
 def job_key(job_id: str) -> str:
     return f"job:{job_id}"
 
 
-def set_state(job_id: str, patch: dict[str, Any]) -> dict[str, Any]:
-    r = redis_conn()
-    k = job_key(job_id)
+EVENTS_PREFIX = "jobevents:"
+
+# Deadlines of job states ("job:<id>") and output files ("file:<path>"), so the
+# cleaner only visits what has expired.
+EXPIRY_KEY = "expiry"
+
+
+def file_expiry_member(path: str) -> str:
+    return f"file:{path}"
+
+
+def events_channel(job_id: str) -> str:
+    return f"{EVENTS_PREFIX}{job_id}"
+
+
+def _is_wrongtype(e: ResponseError) -> bool:
+    return str(e).startswith("WRONGTYPE")
+
+
+def _migrate_legacy(r: Redis, k: str) -> None:
+    # Job states used to be a single JSON string; convert in place to a hash.
     raw = r.get(k)
     data: dict[str, Any] = {}
     if raw:
@@ -27,20 +82,101 @@ def set_state(job_id: str, patch: dict[str, Any]) -> dict[str, Any]:
             data = json.loads(raw)
         except Exception:
             data = {}
-    data.update(patch)
-    data.setdefault("created_at", int(time.time()))
-    data["updated_at"] = int(time.time())
-    r.set(k, json.dumps(data))
-    r.expire(k, settings.job_ttl_hours * 3600)
-    return data
+    ttl = r.ttl(k)
+    pipe = r.pipeline(transaction=True)
+    pipe.delete(k)
+    if data:
+        pipe.hset(k, mapping={f: json.dumps(v) for f, v in data.items()})
+        if ttl and ttl > 0:
+            pipe.expire(k, ttl)
+    pipe.execute()
+
+
+def set_state(job_id: str, patch: dict[str, Any], *, ttl: int | None = None) -> None:
+    """Merge patch into the job state and refresh its TTL in one round trip.
+
+    The state is a Redis hash with one JSON-encoded value per field, so the
+    merge happens server-side and concurrent writers never overwrite each
+    other's fields. A notification is published on the job's events channel
+    in the same round trip.
+    """
+
+    r = redis_conn()
+    k = job_key(job_id)
+    now = int(time.time())
+    mapping = {f: json.dumps(v) for f, v in patch.items()}
+    mapping["updated_at"] = json.dumps(now)
+
+    def write() -> None:
+        pipe = r.pipeline(transaction=True)
+        pipe.hset(k, mapping=mapping)
+        pipe.hsetnx(k, "created_at", json.dumps(now))
+        pipe.expire(k, ttl if ttl is not None else settings.job_ttl_hours * 3600)
+        # Like created_at, the deadline is fixed when the job is first written.
+        pipe.zadd(EXPIRY_KEY, {k: now + settings.job_ttl_hours * 3600}, nx=True)
+        pipe.publish(events_channel(job_id), json.dumps(patch.get("status")))
+        pipe.execute()
+
+    try:
+        with timed(REDIS_OP_SECONDS, op="set_state"):
+            write()
+    except ResponseError as e:
+        if not _is_wrongtype(e):
+            raise
+        _migrate_legacy(r, k)
+        write()
 
 
 def get_state(job_id: str) -> dict[str, Any] | None:
     r = redis_conn()
-    raw = r.get(job_key(job_id))
-    if not raw:
-        return None
+    k = job_key(job_id)
     try:
-        return json.loads(raw)
-    except Exception:
+        with timed(REDIS_OP_SECONDS, op="get_state"):
+            raw = r.hgetall(k)
+    except ResponseError as e:
+        if not _is_wrongtype(e):
+            raise
+        _migrate_legacy(r, k)
+        raw = r.hgetall(k)
+    if not raw:
         return None
+
+    data: dict[str, Any] = {}
+    for f, v in raw.items():
+        try:
+            data[f] = json.loads(v)
+        except Exception:
+            data[f] = v
+    return data
+
+
+class ProgressWriter:
+    """Coalesces state writes for one job to at most one per interval.
+
+    Status changes (including terminal states) are written immediately; plain
+    progress updates in between are merged and written when the interval has
+    passed or on flush().
+    """
+
+    def __init__(self, job_id: str, *, ttl: int | None = None, interval: float | None = None) -> None:
+        self.job_id = job_id
+        self.ttl = ttl
+        self.interval = settings.progress_write_interval_seconds if interval is None else interval
+        self._pending: dict[str, Any] = {}
+        self._status: Any = None
+        self._last = 0.0
+
+    def update(self, patch: dict[str, Any], *, force: bool = False) -> None:
+        self._pending.update(patch)
+        now = time.monotonic()
+        status = self._pending.get("status", self._status)
+        if force or status != self._status or status in TERMINAL_STATUSES or now - self._last >= self.interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        patch, self._pending = self._pending, {}
+        set_state(self.job_id, patch, ttl=self.ttl)
+        self._status = patch.get("status", self._status)
+        self._last = time.monotonic()
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+from typing import Any
+
+# Warm workers run their jobs one at a time in one long-lived process (see
+# app.worker.WarmLaneWorker). There, every YoutubeDL a job creates reuses the
+# state earlier jobs built up instead of starting cold.
+_state = {"on": False}
+
+
+class _Shared:
+    """yt-dlp state for one cookie file (and network settings)."""
+
+    def __init__(self) -> None:
+        self.cookiejar: Any = None
+        # HTTP handlers with their connection pools.
+        self.director: Any = None
+        # Extractor instances keep per-process caches (YouTube player JS and signatures).
+        self.ies: dict[str, Any] = {}
+
+
+_shared: dict[tuple[Any, ...], _Shared] = {}
+_classes: dict[type, type] = {}
+
+# Params baked into the cookie jar and the HTTP handlers when they are built.
+_SHARED_BY = ("cookiefile", "proxy", "source_address", "socket_timeout", "nocheckcertificate", "impersonate")
+
+
+def enabled() -> bool:
+    return _state["on"]
+
+
+def enable() -> None:
+    """Import and initialize yt-dlp once; later YoutubeDLs of this process share their state.
+
+    Only for processes that run one job at a time: the shared objects are not
+    meant for concurrent use.
+    """
+
+    from yt_dlp.extractor import gen_extractor_classes
+    from yt_dlp.postprocessor.ffmpeg import FFmpegPostProcessor
+
+    # Modules run_download imports on first use.
+    from app import batches, disk_budget, progressive, range_download, stats  # noqa: F401
+
+    gen_extractor_classes()
+    # Probes the ffmpeg/ffprobe versions; yt-dlp caches them for the process.
+    FFmpegPostProcessor.get_versions()
+    _state["on"] = True
+
+
+class _WarmMixin:
+    params: dict[str, Any]
+
+    @property
+    def _warm(self) -> _Shared:
+        key = tuple(repr(self.params.get(k)) for k in _SHARED_BY)
+        shared = _shared.get(key)
+        if shared is None:
+            shared = _shared[key] = _Shared()
+        return shared
+
+    @property
+    def cookiejar(self) -> Any:
+        import yt_dlp
+
+        shared = self._warm
+        if shared.cookiejar is None:
+            shared.cookiejar = yt_dlp.YoutubeDL.cookiejar.func(self)  # type: ignore[attr-defined]
+        return shared.cookiejar
+
+    @property
+    def _request_director(self) -> Any:
+        # Never in __dict__, so YoutubeDL.close() leaves it open for the next job.
+        import yt_dlp
+
+        shared = self._warm
+        if shared.director is None:
+            shared.director = yt_dlp.YoutubeDL._request_director.func(self)  # type: ignore[attr-defined]
+        return shared.director
+
+    def get_info_extractor(self, ie_key: str) -> Any:
+        ies = self._warm.ies
+        if ie_key not in self._ies_instances and ie_key in ies:  # type: ignore[attr-defined]
+            # Rebinds the extractor to this YoutubeDL.
+            self.add_info_extractor(ies[ie_key])  # type: ignore[attr-defined]
+        ie = super().get_info_extractor(ie_key)  # type: ignore[misc]
+        ies[ie_key] = ie
+        return ie
+
+
+def youtube_dl(params: dict[str, Any], cls: type | None = None) -> Any:
+    """A YoutubeDL (or the subclass `cls`) for `params`, warm when enable() was called."""
+
+    import yt_dlp
+
+    cls = cls or yt_dlp.YoutubeDL
+    if not _state["on"]:
+        return cls(params)
+    warm_cls = _classes.get(cls)
+    if warm_cls is None:
+        warm_cls = _classes[cls] = type(f"Warm{cls.__name__}", (_WarmMixin, cls), {})
+    return warm_cls(params)
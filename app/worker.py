@@ -1,30 +1,304 @@
 from __future__ import annotations
 
+import logging
+import multiprocessing
+import os
+import signal
+import socket
 import time
+from typing import Any
 
 from redis import Redis
 from redis.exceptions import ConnectionError
-from rq import Queue, Worker
+from rq import Queue, SimpleWorker, Worker
+from rq.utils import now
 
+from app import metrics, warm
+from app.postprocess import POSTPROCESS_QUEUE
+from app.queueing import LANE_QUEUES
 from app.settings import settings
+from app.store import redis_bytes_conn
 
+log = logging.getLogger("app.worker")
 
-def main() -> None:
+QUEUE_NAMES = list(LANE_QUEUES.values())
+
+
+def stage_queue_names() -> list[str]:
+    """Queues this worker drains, by WORKER_STAGE."""
+
+    stage = settings.worker_stage or ("download" if settings.split_postprocess else "all")
+    if stage == "download":
+        return QUEUE_NAMES
+    if stage == "postprocess":
+        return [POSTPROCESS_QUEUE]
+    if stage == "all":
+        # Finishing jobs whose streams are already downloaded comes before starting new ones.
+        return [POSTPROCESS_QUEUE, *QUEUE_NAMES]
+    raise ValueError(f"unknown WORKER_STAGE: {stage!r}")
+
+
+def _wait_for_redis() -> Redis:
     # Wait for Redis to be reachable; EasyPanel networks can come up slightly later.
     while True:
         try:
-            redis = Redis.from_url(settings.redis_url)
+            redis = redis_bytes_conn()
             redis.ping()
-            break
+            return redis
         except ConnectionError:
             time.sleep(2)
         except Exception:
             time.sleep(2)
 
-    queue = Queue("downloads", connection=redis)
-    worker = Worker([queue], connection=redis)
+
+def _oldest_wait_seconds(queue: Queue) -> float:
+    ids = queue.get_job_ids(0, 0)
+    job = queue.fetch_job(ids[0]) if ids else None
+    if job is None or job.enqueued_at is None:
+        return 0.0
+    enqueued_at = job.enqueued_at
+    if enqueued_at.tzinfo is None:
+        enqueued_at = enqueued_at.replace(tzinfo=now().tzinfo)
+    return (now() - enqueued_at).total_seconds()
+
+
+class LaneWorker(Worker):
+    """Drains the priority lanes in weighted order (smooth weighted round robin).
+
+    After every dequeue the lane with the highest accumulated weight is put
+    first; the others follow in priority order. A long-lane job that waited
+    more than LANE_LONG_MAX_WAIT_SECONDS always goes first, so bulk jobs
+    cannot starve.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._lane_weights = {
+            LANE_QUEUES["short"]: max(0, settings.lane_weight_short),
+            LANE_QUEUES["normal"]: max(0, settings.lane_weight_normal),
+            LANE_QUEUES["long"]: max(0, settings.lane_weight_long),
+        }
+        self._lane_credit = {name: 0 for name in self._lane_weights}
+
+    def reorder_queues(self, reference_queue: Queue) -> None:
+        by_name = {queue.name: queue for queue in self.queues}
+        priority = [by_name[n] for n in QUEUE_NAMES if n in by_name]
+        others = [queue for queue in self.queues if queue.name not in self._lane_weights]
+
+        long_queue = by_name.get(LANE_QUEUES["long"])
+        first: Queue | None = None
+        if long_queue is not None and _oldest_wait_seconds(long_queue) >= settings.lane_long_max_wait_seconds:
+            first = long_queue
+        else:
+            total = 0
+            for queue in priority:
+                weight = self._lane_weights[queue.name]
+                self._lane_credit[queue.name] += weight
+                total += weight
+            if total:
+                first = max(priority, key=lambda queue: self._lane_credit[queue.name])
+                self._lane_credit[first.name] -= total
+
+        if first is not None:
+            priority = [first] + [queue for queue in priority if queue is not first]
+        # Other queues (postprocess) keep their place in front of the lanes.
+        self._ordered_queues = others + priority
+
+    def main_work_horse(self, *args: Any, **kwargs: Any) -> None:
+        metrics.share_with_parent()
+        super().main_work_horse(*args, **kwargs)
+
+
+class WarmLaneWorker(LaneWorker, SimpleWorker):
+    """LaneWorker that runs jobs in its own process instead of forking a work horse per job.
+
+    yt-dlp is imported and initialized once and its state is reused by every
+    job (app.warm). Job timeouts still apply (SIGALRM in this process); the
+    worker exits after WORKER_MAX_JOBS jobs so leaks cannot pile up.
+    """
+
+
+def run_worker(name: str | None = None) -> None:
+    redis = _wait_for_redis()
+    queues = [Queue(n, connection=redis) for n in stage_queue_names()]
+    if settings.worker_warm:
+        if settings.worker_stage != "postprocess":
+            warm.enable()
+        worker: Worker = WarmLaneWorker(queues, connection=redis, name=name)
+        worker.work(with_scheduler=False, max_jobs=settings.worker_max_jobs or None)
+        return
+    worker = LaneWorker(queues, connection=redis, name=name)
     worker.work(with_scheduler=False)
 
 
+def _child_main(name: str) -> None:
+    # Forked from the supervisor: drop its handlers so RQ installs its own.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    run_worker(name)
+
+
+class Supervisor:
+    """Keeps between min and max RQ worker processes on this host.
+
+    Scales up while jobs wait longer than WORKER_SCALE_UP_WAIT_SECONDS (or
+    outnumber idle workers), retires workers that stayed idle for
+    WORKER_SCALE_DOWN_IDLE_SECONDS, and restarts children that die. Retiring and
+    shutdown use RQ's warm shutdown (SIGTERM), so a running download is never cut.
+    """
+
+    def __init__(self) -> None:
+        self.min_procs = max(1, settings.worker_min_processes)
+        max_procs = settings.worker_max_processes
+        if settings.worker_stage == "postprocess":
+            # ffmpeg is CPU-bound: about one process per core.
+            max_procs = settings.postprocess_max_processes or os.cpu_count() or 1
+        self.max_procs = max(self.min_procs, max_procs)
+        self.children: dict[str, multiprocessing.Process] = {}
+        self.retiring: set[str] = set()
+        self.idle_since: dict[str, float] = {}
+        self.stopping = False
+        self.started_at: dict[str, float] = {}
+        # Crash-loop protection: no restarts before this monotonic time.
+        self.restart_after = 0.0
+        self._seq = 0
+        self._prefix = f"{socket.gethostname()}.{os.getpid()}"
+
+    def _on_signal(self, signum: int, frame: Any) -> None:
+        # First signal: warm shutdown (children finish their job). Second: forwarded again,
+        # which RQ treats as a cold shutdown.
+        self.stopping = True
+        for proc in self.children.values():
+            if proc.pid and proc.is_alive():
+                os.kill(proc.pid, signal.SIGTERM)
+
+    def _spawn(self) -> None:
+        self._seq += 1
+        name = f"{self._prefix}.{self._seq}"
+        proc = multiprocessing.Process(target=_child_main, args=(name,), name=name, daemon=False)
+        proc.start()
+        self.children[name] = proc
+        self.started_at[name] = time.monotonic()
+        log.info("started worker %s (pid %s)", name, proc.pid)
+
+    def _retire(self, name: str) -> None:
+        proc = self.children.get(name)
+        if proc is None or not proc.pid or name in self.retiring:
+            return
+        self.retiring.add(name)
+        os.kill(proc.pid, signal.SIGTERM)
+        log.info("retiring idle worker %s", name)
+
+    def _reap(self) -> None:
+        for name, proc in list(self.children.items()):
+            if proc.is_alive():
+                continue
+            proc.join(0)
+            self.children.pop(name, None)
+            self.idle_since.pop(name, None)
+            started = self.started_at.pop(name, 0.0)
+            if name in self.retiring:
+                self.retiring.discard(name)
+            elif settings.worker_warm and proc.exitcode == 0 and not self.stopping:
+                # Warm worker done with its WORKER_MAX_JOBS jobs; the next scaling step replaces it.
+                log.info("recycled warm worker %s", name)
+            elif not self.stopping:
+                log.warning("worker %s exited with %s; restarting", name, proc.exitcode)
+                if time.monotonic() - started < 10:
+                    # Died right away (bad config, Redis hiccup): back off before respawning.
+                    self.restart_after = time.monotonic() + 10
+
+    def _worker_states(self, redis: Redis) -> dict[str, str]:
+        states: dict[str, str] = {}
+        for name in self.children:
+            try:
+                w = Worker.find_by_key(Worker.redis_worker_namespace_prefix + name, connection=redis)
+                states[name] = w.get_state() if w else "starting"
+            except Exception:
+                states[name] = "starting"
+        return states
+
+    def _queue_load(self, redis: Redis) -> tuple[int, float]:
+        depth = 0
+        oldest = 0.0
+        for n in stage_queue_names():
+            queue = Queue(n, connection=redis)
+            depth += queue.count
+            oldest = max(oldest, _oldest_wait_seconds(queue))
+        return depth, oldest
+
+    def _scale(self, redis: Redis) -> None:
+        depth, oldest = self._queue_load(redis)
+        states = self._worker_states(redis)
+        active = [n for n in self.children if n not in self.retiring]
+        idle = [n for n in active if states.get(n) == "idle"]
+        mono = time.monotonic()
+
+        for n in active:
+            if n in idle:
+                self.idle_since.setdefault(n, mono)
+            else:
+                self.idle_since.pop(n, None)
+
+        if mono < self.restart_after:
+            return
+
+        if len(active) < self.min_procs:
+            for _ in range(self.min_procs - len(active)):
+                self._spawn()
+            return
+
+        waiting = depth > len(idle) or (depth and oldest >= settings.worker_scale_up_wait_seconds)
+        if waiting and len(active) < self.max_procs:
+            # One step per tick keeps the ramp gentle on YouTube.
+            self._spawn()
+            return
+
+        if depth == 0 and len(active) > self.min_procs:
+            quiet = [n for n in idle if mono - self.idle_since.get(n, mono) >= settings.worker_scale_down_idle_seconds]
+            if quiet:
+                self._retire(quiet[0])
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        redis = _wait_for_redis()
+        if settings.worker_warm and settings.worker_stage != "postprocess":
+            # Imported once here, children start with yt-dlp already loaded.
+            warm.enable()
+
+        while not self.stopping:
+            self._reap()
+            try:
+                self._scale(redis)
+            except ConnectionError:
+                pass
+            except Exception:
+                log.exception("scaling step failed")
+            time.sleep(settings.worker_scale_interval_seconds)
+
+        # Drain: wait for every child to finish its current job and exit.
+        while self.children:
+            self._reap()
+            time.sleep(0.5)
+
+
+def _start_metrics_exporter() -> None:
+    # Job metrics are recorded in forked processes; only the multi-process mode can collect them.
+    if not metrics.MULTIPROCESS or not settings.worker_metrics_port:
+        return
+    metrics.reset_multiprocess_dir()
+    metrics.start_exporter(settings.worker_metrics_port)
+
+
+def main() -> None:
+    _start_metrics_exporter()
+    if settings.worker_supervisor:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+        Supervisor().run()
+        return
+    run_worker()
+
+
 if __name__ == "__main__":
     main()
@@ -1,13 +1,21 @@
 from __future__ import annotations
 
+import contextlib
+import copy
 import os
 import re
-from typing import Any
+import time
+from typing import Any, Callable
 
-from redis import Redis
 from rq import get_current_job
+from rq.utils import now
 
-from app.cookies import ensure_cookiefile
+from app import bandwidth, metrics, warm
+from app.cookies import CookieAccount, lease_account, report_failure
+from app.info_cache import get_info
+from app.outputs import output_key, publish_output, release_inflight, reuse_output, settle_followers
+from app.store import ProgressWriter
+from app.yt_meta import height_selector, plan_formats
 
 
 def _safe_filename(s: str) -> str:
@@ -17,6 +25,46 @@ def _safe_filename(s: str) -> str:
     return s[:140] if s else "download"
 
 
+def _settle(
+    job_id: str,
+    patch: dict[str, Any],
+    *,
+    out_key: str,
+    timings: dict[str, float],
+    nbytes: int,
+    set_state: Callable[[dict[str, Any]], None],
+) -> None:
+    """Write a job's terminal state (from either stage) and hand the outcome to coalesced jobs."""
+
+    from app import batches, disk_budget, stats
+
+    if disk_budget.enabled():
+        disk_budget.release(job_id)
+    timings["finished"] = round(time.time(), 3)
+    set_state(
+        {
+            **patch,
+            "timings": dict(timings),
+            "phases": stats.phase_durations(timings),
+            "bytes_transferred": nbytes,
+        }
+    )
+    release_inflight(out_key, job_id)
+    followers = settle_followers(job_id, patch)
+    # Let batches of this job (and of jobs coalesced onto it) start their next children.
+    batches.on_jobs_settled([job_id, *followers])
+
+
+def _record_stats(*, mode: str, container: str, timings: dict[str, float], nbytes: int) -> None:
+    from app import stats
+
+    try:
+        stats.record(mode=mode, container=container, phases=stats.phase_durations(timings), nbytes=nbytes)
+    except Exception:
+        # Stats are best effort; the job already succeeded.
+        pass
+
+
 def run_download(
     *,
     url: str,
@@ -24,80 +72,126 @@ def run_download(
     container: str,
     mode: str,
     download_dir: str,
-    redis_url: str,
     job_ttl_hours: int,
+    batch_id: str = "",
+    # Unused (workers use the process-wide pool); still accepted so jobs queued
+    # by releases that passed it keep running after an upgrade.
+    redis_url: str = "",
 ) -> dict[str, Any]:
     import yt_dlp
+    from yt_dlp.postprocessor import PostProcessor
+
+    from app import disk_budget, postprocess, progressive, range_download
 
     job = get_current_job()
     job_id = job.id if job else ""
     if not job_id:
         raise RuntimeError("missing rq job id")
 
-    r = Redis.from_url(redis_url, decode_responses=True)
+    # Progress hooks fire many times a second; the writer coalesces them.
+    writer = ProgressWriter(job_id, ttl=job_ttl_hours * 3600)
 
     def set_state(patch: dict[str, Any]) -> None:
-        # Write job state to Redis with TTL.
-        import json, time
-
-        k = f"job:{job_id}"
-        raw = r.get(k)
-        data: dict[str, Any] = {}
-        if raw:
-            try:
-                data = json.loads(raw)
-            except Exception:
-                data = {}
-        data.update(patch)
-        data.setdefault("job_id", job_id)
-        data.setdefault("created_at", int(time.time()))
-        data["updated_at"] = int(time.time())
-        r.set(k, json.dumps(data))
-        r.expire(k, job_ttl_hours * 3600)
+        writer.update(patch)
 
     os.makedirs(download_dir, exist_ok=True)
-    set_state({"status": "started", "progress": 1, "message": "starting"})
+    set_state({"job_id": job_id, "status": "started", "progress": 1, "message": "starting"})
 
-    # Pre-fetch metadata so we can understand if selected format has audio.
-    ydl_meta_opts = {
-        "quiet": True,
-        "no_warnings": True,
-        "skip_download": True,
-        "noplaylist": True,
-        "ignoreconfig": True,
-        "format": "best",
-    }
+    # Phase timestamps in epoch seconds: the queued mark comes from another process.
+    timings: dict[str, float] = {"started": round(time.time(), 3)}
+    enqueued_at = getattr(job, "enqueued_at", None)
+    if enqueued_at is not None:
+        if enqueued_at.tzinfo is None:
+            enqueued_at = enqueued_at.replace(tzinfo=now().tzinfo)
+        timings["queued"] = round(enqueued_at.timestamp(), 3)
+        metrics.QUEUE_WAIT_SECONDS.labels(queue=job.origin).observe(max(0.0, (now() - enqueued_at).total_seconds()))
 
-    cookiefile = ensure_cookiefile()
-    if cookiefile:
-        ydl_meta_opts["cookiefile"] = cookiefile
-    def extract_meta(opts: dict[str, Any]) -> dict[str, Any]:
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return dict(info)
+    def mark(phase: str, *, first: bool = False) -> None:
+        if first and phase in timings:
+            return
+        timings[phase] = round(time.time(), 3)
+        set_state({"timings": dict(timings)})
 
-    info = extract_meta(ydl_meta_opts)
+    out_key = output_key(url=url, format_id=format_id, container=container, mode=mode)
+
+    lease = bandwidth.BandwidthLease(job_id) if bandwidth.enabled() else None
+    account: CookieAccount | None = None
+    # YoutubeDL of the running attempt; its params dict is shared with the downloader.
+    active_ydl: list[Any] = []
+    transfer = {"bytes": 0}
+
+    def finish(patch: dict[str, Any]) -> None:
+        # Terminal state: also hand the outcome to jobs coalesced onto this one.
+        if lease is not None:
+            lease.release()
+        if account is not None:
+            account.release()
+        _settle(job_id, patch, out_key=out_key, timings=timings, nbytes=transfer["bytes"], set_state=set_state)
+
+    def fail(error: str) -> None:
+        report_failure(account, error)
+        metrics.count_failure("download", error)
+        finish({"status": "failed", "progress": 0, "error": error, "message": "failed"})
+
+    # Another job may have produced the same output while this one was queued.
+    reused = reuse_output(out_key, job_id)
+    if reused:
+        finish(reused)
+        return {"ok": True, "file_path": reused["file_path"]}
+
+    # Metadata comes from the shared cache (usually warm from the format listing).
+    # This is the only extraction for the job; the download below reuses it.
+    try:
+        info = get_info(url)
+    except Exception as e:
+        fail(str(e))
+        raise
+    account = lease_account()
+    cookiefile = account.path() if account else ""
 
     title = (info.get("title") or "").strip()
     safe_title = _safe_filename(title)
 
     selected = None
-    for f in (info.get("formats") or []):
-        if str(f.get("format_id") or "") == str(format_id):
-            selected = f
-            break
-    if not selected:
-        raise RuntimeError("format_id not found")
-
-    vcodec = selected.get("vcodec") or "none"
-    acodec = selected.get("acodec") or "none"
+    if not str(format_id).startswith("h:") and format_id not in ("best", "bestaudio"):
+        for f in (info.get("formats") or []):
+            if str(f.get("format_id") or "") == str(format_id):
+                selected = f
+                break
+        if not selected:
+            fail("format_id not found")
+            raise RuntimeError("format_id not found")
+    # Streams that go into the output by stream copy, so ffmpeg never re-encodes video.
+    plan = plan_formats(info, format_id=format_id, mode=mode, container=container, selected=selected)
+    set_state({"plan": plan})
+    mark("extracted")
 
     # Output template
     outtmpl = os.path.join(download_dir, f"{job_id}-{safe_title}.%(ext)s")
 
+    seen_bytes: dict[str, int] = {}
+    pp_started: dict[str, float] = {}
+
+    def throttle(d: dict[str, Any]) -> None:
+        # Charge this job's transfer to the global budget and follow its changing share.
+        assert lease is not None
+        name = str(d.get("filename") or "")
+        done = int(d.get("downloaded_bytes") or 0)
+        lease.consume(max(0, done - seen_bytes.get(name, 0)))
+        seen_bytes[name] = done
+        if lease.due():
+            old = lease.rate
+            rate = lease.refresh()
+            for ydl in active_ydl:
+                ydl.params["ratelimit"] = rate
+            if rate != old:
+                set_state({"rate_limit_bps": rate})
+
     def hook(d: dict[str, Any]) -> None:
         status = d.get("status")
         if status == "downloading":
+            if lease is not None:
+                throttle(d)
             pct = 0
             p = (d.get("_percent_str") or "").strip().replace("%", "")
             try:
@@ -113,8 +207,21 @@ def run_download(
             msg = " - ".join(msg_parts)
             set_state({"status": "downloading", "progress": max(2, min(98, pct)), "message": msg})
         elif status == "finished":
+            mark("download_finished")
+            transfer["bytes"] += int(d.get("total_bytes") or d.get("downloaded_bytes") or 0)
             set_state({"status": "processing", "progress": 99, "message": "processing"})
 
+    def pp_hook(d: dict[str, Any]) -> None:
+        name = str(d.get("postprocessor") or "")
+        if not name.startswith("FFmpeg"):
+            return
+        if d.get("status") == "started":
+            pp_started[name] = time.monotonic()
+            mark("postprocess_started", first=True)
+        elif d.get("status") == "finished" and name in pp_started:
+            metrics.POSTPROCESS_SECONDS.labels(postprocessor=name).observe(time.monotonic() - pp_started.pop(name))
+            mark("postprocess_finished")
+
     ydl_opts: dict[str, Any] = {
         "quiet": True,
         "no_warnings": True,
@@ -122,92 +229,321 @@ def run_download(
         "ignoreconfig": True,
         "outtmpl": outtmpl,
         "progress_hooks": [hook],
+        "postprocessor_hooks": [pp_hook],
+        "format": plan["format"],
     }
 
     if cookiefile:
         ydl_opts["cookiefile"] = cookiefile
 
+    if lease is not None:
+        ydl_opts["ratelimit"] = lease.refresh()
+        set_state({"rate_limit_bps": lease.rate})
+
     if mode == "audio_mp3":
-        # Keep it robust: always choose bestaudio when converting to mp3.
-        ydl_opts["format"] = "bestaudio/best"
         ydl_opts["postprocessors"] = [
             {"key": "FFmpegExtractAudio", "preferredcodec": "mp3", "preferredquality": "0"}
         ]
+    elif mode == "audio":
+        if plan["processing"] != "none":
+            # Same codec in, same codec out: yt-dlp copies the stream into an .m4a/.opus/.ogg file.
+            ydl_opts["postprocessors"] = [
+                {"key": "FFmpegExtractAudio", "preferredcodec": plan.get("audio_codec") or "best"}
+            ]
     else:
         ydl_opts["merge_output_format"] = container
-        # Prefer height-based selectors (format_id can be brittle).
-        if str(format_id).startswith("h:"):
-            try:
-                h_int = int(str(format_id).split(":", 1)[1])
-            except Exception:
-                h_int = 0
-            if h_int:
-                ydl_opts["format"] = f"bestvideo[height<={h_int}]+bestaudio/best"
-            else:
-                ydl_opts["format"] = "bestvideo+bestaudio/best"
-        elif str(format_id) == "best":
-            ydl_opts["format"] = "bestvideo+bestaudio/best"
-        else:
-            # Back-compat: if someone passes a real format id.
-            if vcodec != "none" and acodec != "none":
-                ydl_opts["format"] = format_id
-            elif vcodec != "none" and acodec == "none":
-                ydl_opts["format"] = f"{format_id}+bestaudio/best"
-            else:
-                ydl_opts["format"] = "bestvideo+bestaudio/best"
+        if plan["processing"] == "remux":
+            # merge_output_format only applies to merges; a single file needs its own remux.
+            ydl_opts["postprocessors"] = [{"key": "FFmpegVideoRemuxer", "preferedformat": container}]
+
+    produced: list[str] = []
+    produced_formats: list[str] = []
+
+    class FinalPath(PostProcessor):
+        # Runs after merge/conversion and the final move, so filepath is the real output.
+        def run(self, pp_info: dict[str, Any]) -> tuple[list[str], dict[str, Any]]:
+            if pp_info.get("filepath"):
+                produced.append(str(pp_info["filepath"]))
+                produced_formats.append(str(pp_info.get("format_id") or ""))
+            return [], pp_info
+
+    # Large streams (by format filesize) can be fetched over several connections.
+    ydl_class = range_download.RangeSplitYoutubeDL if range_download.enabled() else yt_dlp.YoutubeDL
 
     def attempt_download(opts: dict[str, Any]) -> None:
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            ydl.extract_info(url, download=True)
+        with warm.youtube_dl(opts, ydl_class) as ydl:
+            ydl.add_post_processor(FinalPath(ydl), when="after_move")
+            active_ydl[:] = [ydl]
+            # Download from the already-resolved info instead of extracting again.
+            ydl.process_ie_result(copy.deepcopy(info), download=True)
 
-    try:
-        attempt_download(ydl_opts)
-    except Exception as e:
-        msg = str(e)
+    def stream_download(inputs: list[dict[str, Any]]) -> None:
+        ext = "mp3" if mode == "audio_mp3" else container
+        path = os.path.join(download_dir, f"{job_id}-{safe_title}.{ext}")
+        open(path, "wb").close()
+        # /download starts tailing the file as soon as stream_path is visible.
+        set_state(
+            {
+                "status": "downloading",
+                "progress": 2,
+                "message": "streaming",
+                "stream_path": path,
+                "file_name": os.path.basename(path),
+            }
+        )
+        duration = float(info.get("duration") or 0)
 
-        # Common edge case: formats may differ between listing and download.
-        # Retry with a height-based selector.
-        if "Requested format is not available" in msg and mode != "audio_mp3":
-            h = selected.get("height")
-            try:
-                h_int = int(h) if h else 0
-            except Exception:
-                h_int = 0
+        def on_progress(nbytes: int, seconds: float) -> None:
+            transfer["bytes"] += nbytes
+            if lease is not None:
+                lease.consume(nbytes)
+            pct = int(seconds * 100 / duration) if duration else 0
+            set_state({"status": "downloading", "progress": max(2, min(98, pct)), "message": "streaming"})
 
-            retry_opts = dict(ydl_opts)
-            if h_int:
-                retry_opts["format"] = f"bestvideo[height<={h_int}]+bestaudio/best"
-            else:
-                retry_opts["format"] = "bestvideo+bestaudio/best"
+        cmd = progressive.ffmpeg_command(inputs, mode=mode, container=container)
+        try:
+            progressive.stream_to_file(cmd, path, on_progress)
+        except Exception as e:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            fail(str(e))
+            raise
+        mark("download_finished")
+        produced.append(path)
 
-            set_state({"status": "downloading", "progress": 2, "message": "retrying with fallback format"})
-            try:
-                attempt_download(retry_opts)
-            except Exception as e2:
-                set_state({"status": "failed", "progress": 0, "error": str(e2), "message": "failed"})
-                raise
-        else:
-            set_state({"status": "failed", "progress": 0, "error": msg, "message": "failed"})
+    # Streamable outputs come from a single ffmpeg pass that clients can download while it runs.
+    stream_inputs = None
+    resolved: dict[str, Any] = info
+    if progressive.enabled() or disk_budget.enabled():
+        try:
+            with warm.youtube_dl({**ydl_opts, "progress_hooks": []}) as ydl:
+                resolved = ydl.process_ie_result(copy.deepcopy(info), download=False)
+                if progressive.enabled():
+                    stream_inputs = progressive.plan(ydl, resolved, mode=mode, container=container)
+        except Exception:
+            stream_inputs = None
+
+    if disk_budget.enabled():
+        set_state({"status": "started", "progress": 1, "message": "reserving disk space"})
+        try:
+            disk_budget.reserve(job_id, disk_budget.estimate_bytes(resolved))
+        except Exception as e:
+            fail(str(e))
             raise
 
-    produced = None
-    for name in os.listdir(download_dir):
-        if name.startswith(f"{job_id}-"):
-            produced = os.path.join(download_dir, name)
-            break
-    if not produced:
-        set_state({"status": "failed", "progress": 0, "error": "file not generated", "message": "failed"})
+    # Pipeline stages: fetch the plan's streams as they are and leave ffmpeg to a postprocess worker.
+    handoff = not stream_inputs and postprocess.enabled() and postprocess.wants_handoff(plan)
+    raw_opts = {
+        **{k: v for k, v in ydl_opts.items() if k not in ("postprocessors", "merge_output_format")},
+        "format": postprocess.raw_format(plan),
+        "outtmpl": os.path.join(download_dir, f"{job_id}-{safe_title}.f%(format_id)s.%(ext)s"),
+    }
+
+    def discard_produced() -> None:
+        for path in produced:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        produced.clear()
+        produced_formats.clear()
+
+    def handoff_download() -> bool:
+        # False (and nothing left on disk) when a planned stream is gone since the listing.
+        try:
+            attempt_download(raw_opts)
+        except Exception as e:
+            if "Requested format is not available" not in str(e):
+                raise
+        if sorted(produced_formats) == sorted(postprocess.raw_ids(plan)):
+            return True
+        discard_produced()
+        return False
+
+    mark("download_started")
+    if stream_inputs:
+        stream_download(stream_inputs)
+    else:
+        try:
+            if handoff and not handoff_download():
+                # The plan's own selector falls back to other formats; yt-dlp merges in this job.
+                handoff = False
+                set_state({"status": "downloading", "progress": 2, "message": "retrying with fallback format"})
+                attempt_download(ydl_opts)
+            elif not handoff:
+                attempt_download(ydl_opts)
+        except Exception as e:
+            msg = str(e)
+
+            # Common edge case: formats may differ between listing and download.
+            # Retry with a height-based selector.
+            if "Requested format is not available" in msg and mode == "auto":
+                h = (selected or {}).get("height")
+                if not h and str(format_id).startswith("h:"):
+                    h = str(format_id).split(":", 1)[1]
+                try:
+                    h_int = int(h) if h else 0
+                except Exception:
+                    h_int = 0
+
+                retry_opts = dict(ydl_opts)
+                retry_opts["format"] = height_selector(h_int)
+                # The fallback selector is not a plan: yt-dlp merges in this job.
+                handoff = False
+                discard_produced()
+                if lease is not None:
+                    retry_opts["ratelimit"] = lease.rate
+
+                set_state({"status": "downloading", "progress": 2, "message": "retrying with fallback format"})
+                try:
+                    attempt_download(retry_opts)
+                except Exception as e2:
+                    fail(str(e2))
+                    raise
+            else:
+                fail(msg)
+                raise
+
+    if not produced or not all(os.path.exists(p) for p in (produced if handoff else produced[-1:])):
+        fail("file not generated")
         raise RuntimeError("file not generated")
+    produced_path = produced[-1]
 
-    set_state(
+    elapsed = timings.get("download_finished", 0.0) - timings["download_started"]
+    if elapsed > 0:
+        metrics.DOWNLOAD_SECONDS.labels(mode=mode).observe(elapsed)
+        metrics.DOWNLOAD_THROUGHPUT.labels(mode=mode).observe(transfer["bytes"] / elapsed)
+        metrics.DOWNLOADED_BYTES.labels(mode=mode).inc(transfer["bytes"])
+
+    if handoff:
+        from app.queueing import enqueue_postprocess
+
+        # The network part is done: give back the bandwidth share before waiting for ffmpeg.
+        if lease is not None:
+            lease.release()
+        if account is not None:
+            account.release()
+        video_id = str((plan.get("video") or {}).get("format_id") or "")
+        inputs = [{"path": p, "video": fid == video_id} for p, fid in zip(produced, produced_formats)]
+        inputs.sort(key=lambda src: not src["video"])
+        output = os.path.join(download_dir, f"{job_id}-{safe_title}.{plan['ext']}")
+        mark("handoff")
+        pp_job_id = f"{job_id}-pp"
+        # Written before the enqueue so a fast postprocess worker's updates come after it.
+        set_state(
+            {
+                "status": "processing",
+                "progress": 99,
+                "message": "waiting for post-processing",
+                "stage": "postprocess",
+                "handoff": {
+                    "at": timings["handoff"],
+                    "queue": postprocess.POSTPROCESS_QUEUE,
+                    "rq_job_id": pp_job_id,
+                    "processing": plan["processing"],
+                    "inputs": [os.path.basename(src["path"]) for src in inputs],
+                },
+            }
+        )
+        writer.flush()
+        try:
+            enqueue_postprocess(
+                pp_job_id,
+                job_id=job_id,
+                inputs=inputs,
+                output=output,
+                plan=plan,
+                mode=mode,
+                container=container,
+                out_key=out_key,
+                title=title,
+                timings=dict(timings),
+                bytes_transferred=transfer["bytes"],
+                job_ttl_hours=job_ttl_hours,
+            )
+        except Exception as e:
+            # Nobody will pick the raw streams up.
+            discard_produced()
+            fail(str(e))
+            raise
+        return {"ok": True, "stage": "postprocess", "postprocess_job_id": pp_job_id}
+
+    if disk_budget.enabled():
+        disk_budget.commit(job_id, produced_path, out_key)
+    publish_output(out_key, path=produced_path, title=title, job_id=job_id)
+    finish(
         {
             "status": "finished",
             "progress": 100,
             "message": "ok",
             "title": title,
-            "file_path": produced,
-            "file_name": os.path.basename(produced),
+            "file_path": produced_path,
+            "file_name": os.path.basename(produced_path),
         }
     )
+    _record_stats(mode=mode, container=container, timings=timings, nbytes=transfer["bytes"])
+
+    return {"ok": True, "file_path": produced_path}
 
-    return {"ok": True, "file_path": produced}
+
+def run_postprocess(
+    *,
+    job_id: str,
+    inputs: list[dict[str, Any]],
+    output: str,
+    plan: dict[str, Any],
+    mode: str,
+    container: str,
+    out_key: str,
+    title: str,
+    timings: dict[str, float],
+    bytes_transferred: int,
+    job_ttl_hours: int,
+) -> dict[str, Any]:
+    """Second pipeline stage: the ffmpeg step of a download job whose streams are on disk."""
+
+    from app import disk_budget, postprocess
+
+    writer = ProgressWriter(job_id, ttl=job_ttl_hours * 3600)
+    set_state = writer.update
+    timings = dict(timings)
+
+    def remove(paths: list[str]) -> None:
+        for path in paths:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+    def settle(patch: dict[str, Any]) -> None:
+        _settle(job_id, patch, out_key=out_key, timings=timings, nbytes=bytes_transferred, set_state=set_state)
+
+    timings["postprocess_started"] = round(time.time(), 3)
+    set_state({"status": "processing", "progress": 99, "message": "processing", "timings": dict(timings)})
+
+    partial = output + ".part"
+    start = time.monotonic()
+    try:
+        postprocess.run(postprocess.command(inputs, partial, processing=plan["processing"], ext=plan["ext"]))
+        os.replace(partial, output)
+    except Exception as e:
+        remove([partial, *(src["path"] for src in inputs)])
+        metrics.count_failure("postprocess", str(e))
+        settle({"status": "failed", "progress": 0, "error": str(e), "message": "failed"})
+        raise
+    name = postprocess.PP_NAMES[plan["processing"]]
+    metrics.POSTPROCESS_SECONDS.labels(postprocessor=name).observe(time.monotonic() - start)
+    timings["postprocess_finished"] = round(time.time(), 3)
+    remove([src["path"] for src in inputs])
+
+    if disk_budget.enabled():
+        disk_budget.commit(job_id, output, out_key)
+    publish_output(out_key, path=output, title=title, job_id=job_id)
+    settle(
+        {
+            "status": "finished",
+            "progress": 100,
+            "message": "ok",
+            "title": title,
+            "file_path": output,
+            "file_name": os.path.basename(output),
+        }
+    )
+    _record_stats(mode=mode, container=container, timings=timings, nbytes=bytes_transferred)
+    return {"ok": True, "file_path": output}
@@ -1,8 +1,24 @@
 from __future__ import annotations
 
-from typing import Any, cast
+from typing import Any
 
-from app.cookies import ensure_cookiefile
+from app.info_cache import get_info
+
+# "audio_mp3" converts to mp3; "audio" keeps the source codec (m4a or opus, no transcode).
+AUDIO_MODES = ("audio_mp3", "audio")
+
+# Codecs each container can carry when remuxing without re-encoding, most native
+# first (mkv takes anything).
+CONTAINER_CODECS: dict[str, tuple[tuple[str, ...], tuple[str, ...]]] = {
+    "mp4": (("avc1", "h264", "av01", "hev1", "hvc1", "vp09", "vp9"), ("mp4a", "aac", "opus")),
+    "webm": (("vp9", "vp09", "av01", "vp8"), ("opus", "vorbis")),
+}
+
+# Native audio: preferred source codecs per requested container, and the
+# FFmpegExtractAudio codec that keeps a source codec as-is.
+_NATIVE_AUDIO = {"mp4": ("mp4a", "aac"), "webm": ("opus", "vorbis")}
+_AUDIO_COPY_CODEC = {"mp4a": "m4a", "aac": "m4a", "opus": "opus", "vorbis": "vorbis"}
+_AUDIO_EXT = {"m4a": "m4a", "opus": "opus", "vorbis": "ogg"}
 
 
 def _size_mb(filesize: int | float | None) -> str:
@@ -14,31 +30,208 @@ def _size_mb(filesize: int | float | None) -> str:
         return ""
 
 
-def list_formats(url: str) -> dict[str, Any]:
-    import yt_dlp
-
-    ydl_opts: dict[str, Any] = {
-        "quiet": True,
-        "no_warnings": True,
-        "skip_download": True,
-        "noplaylist": True,
-        # Avoid unexpected global config (e.g. format overrides)
-        "ignoreconfig": True,
-        # Be explicit: some environments end up with an implicit format constraint.
-        "format": "best",
+def height_selector(h_int: int) -> str:
+    if h_int:
+        return f"bestvideo[height<={h_int}]+bestaudio/best"
+    return "bestvideo+bestaudio/best"
+
+
+def format_selector(format_id: str, mode: str, selected: dict[str, Any] | None = None) -> str:
+    """Translate a UI format_id (h:<height>, best, or a raw yt-dlp id) into a selector."""
+
+    if mode in AUDIO_MODES:
+        # Keep it robust: always choose bestaudio for audio outputs.
+        return "bestaudio/best"
+
+    # Prefer height-based selectors (format_id can be brittle).
+    if str(format_id).startswith("h:"):
+        try:
+            h_int = int(str(format_id).split(":", 1)[1])
+        except Exception:
+            h_int = 0
+        return height_selector(h_int)
+    if str(format_id) == "best" or not selected:
+        return "bestvideo+bestaudio/best"
+
+    # Back-compat: if someone passes a real format id.
+    vcodec = selected.get("vcodec") or "none"
+    acodec = selected.get("acodec") or "none"
+    if vcodec != "none" and acodec != "none":
+        return format_id
+    if vcodec != "none" and acodec == "none":
+        return f"{format_id}+bestaudio/best"
+    return "bestvideo+bestaudio/best"
+
+
+def _has(codec: Any) -> bool:
+    return bool(codec) and codec != "none"
+
+
+def _codec_rank(codec: Any, allowed: tuple[str, ...] | None) -> int | None:
+    """Position of codec in allowed (lower is more native); None if it cannot be carried."""
+
+    if allowed is None:
+        return 0
+    c = str(codec).lower()
+    for i, prefix in enumerate(allowed):
+        if c.startswith(prefix):
+            return i
+    return None
+
+
+def _cap(format_id: str) -> int:
+    if str(format_id).startswith("h:"):
+        try:
+            return int(str(format_id).split(":", 1)[1])
+        except Exception:
+            return 0
+    return 0
+
+
+def _summary(f: dict[str, Any]) -> dict[str, Any]:
+    return {
+        k: f.get(k)
+        for k in ("format_id", "ext", "vcodec", "acodec", "height", "fps", "abr", "tbr")
+        if f.get(k) not in (None, "none")
     }
 
-    cookiefile = ensure_cookiefile()
-    if cookiefile:
-        ydl_opts["cookiefile"] = cookiefile
 
-    def extract(opts: dict[str, Any]) -> dict[str, Any]:
-        with yt_dlp.YoutubeDL(cast(Any, opts)) as ydl:
-            # yt-dlp returns a typed InfoDict; treat as plain dict.
-            info = ydl.extract_info(url, download=False)
-            return cast(dict[str, Any], dict(info))
+def _audio_key(f: dict[str, Any], rank: int) -> tuple[Any, ...]:
+    # Original language before dubs, regular before dynamic-range-compressed tracks.
+    drc = "drc" in str(f.get("format_id") or "")
+    return (f.get("language_preference") or 0, not drc, -rank, float(f.get("abr") or f.get("tbr") or 0))
+
+
+def _video_key(f: dict[str, Any], rank: int) -> tuple[Any, ...]:
+    plain = f.get("protocol") in ("http", "https")
+    return (int(f.get("height") or 0), float(f.get("fps") or 0), -rank, plain, float(f.get("tbr") or 0))
+
+
+def _best_audio(formats: list[dict[str, Any]], allowed: tuple[str, ...] | None) -> dict[str, Any] | None:
+    scored = []
+    for f in formats:
+        if _has(f.get("vcodec")) or not _has(f.get("acodec")):
+            continue
+        rank = _codec_rank(f.get("acodec"), allowed)
+        if rank is not None:
+            scored.append((_audio_key(f, rank), f))
+    return max(scored, key=lambda x: x[0])[1] if scored else None
+
+
+def plan_formats(
+    info: dict[str, Any],
+    *,
+    format_id: str,
+    mode: str,
+    container: str,
+    selected: dict[str, Any] | None = None,
+) -> dict[str, Any]:
+    """Choose formats whose codecs go into the output without re-encoding.
+
+    Returns the yt-dlp "format" selector (concrete ids first, the generic
+    selector as fallback), the chosen streams and the processing the output
+    needs: "none", "remux", "merge" (stream copy of video + audio), "transcode"
+    (mp3) or "auto" when the format list gave nothing to plan with.
+    """
+
+    fallback = format_selector(format_id, mode, selected)
+    formats = [f for f in (info.get("formats") or []) if f.get("format_id")]
+    plan: dict[str, Any] = {"format": fallback, "processing": "auto"}
+
+    if mode == "audio_mp3":
+        audio = _best_audio(formats, None)
+        if audio:
+            plan.update({"format": f"{audio['format_id']}/{fallback}", "audio": _summary(audio)})
+        plan.update({"processing": "transcode", "ext": "mp3"})
+        return plan
+
+    if mode == "audio":
+        preferred = _NATIVE_AUDIO.get(container, ())
+        scored = []
+        for f in formats:
+            if not _has(f.get("vcodec")) and _has(f.get("acodec")):
+                rank = _codec_rank(f.get("acodec"), preferred)
+                scored.append((_audio_key(f, len(preferred) if rank is None else rank), f))
+        if not scored:
+            return plan
+        audio = max(scored, key=lambda x: x[0])[1]
+        acodec = str(audio.get("acodec")).lower()
+        copy_codec = next((v for k, v in _AUDIO_COPY_CODEC.items() if acodec.startswith(k)), "best")
+        ext = _AUDIO_EXT.get(copy_codec, str(audio.get("ext") or ""))
+        plan.update(
+            {
+                "format": f"{audio['format_id']}/{fallback}",
+                "audio": _summary(audio),
+                "audio_codec": copy_codec,
+                "ext": ext,
+                "processing": "none" if audio.get("ext") == ext else "remux",
+            }
+        )
+        return plan
+
+    allowed = CONTAINER_CODECS.get(container)
+    v_allowed, a_allowed = allowed if allowed else (None, None)
+
+    if selected:
+        # An explicit yt-dlp id: keep it, only pick an audio stream the container can carry.
+        if _has(selected.get("vcodec")) and not _has(selected.get("acodec")):
+            audio = _best_audio(formats, a_allowed)
+            if audio:
+                plan.update(
+                    {
+                        "format": f"{selected['format_id']}+{audio['format_id']}/{fallback}",
+                        "video": _summary(selected),
+                        "audio": _summary(audio),
+                        "processing": "merge",
+                        "ext": container,
+                    }
+                )
+        return plan
+
+    cap = _cap(format_id)
+    videos, combined = [], []
+    for f in formats:
+        if not _has(f.get("vcodec")) or (cap and int(f.get("height") or 0) > cap):
+            continue
+        rank = _codec_rank(f.get("vcodec"), v_allowed)
+        if rank is None:
+            continue
+        if not _has(f.get("acodec")):
+            videos.append((_video_key(f, rank), f))
+        elif f.get("protocol") in ("http", "https") and _codec_rank(f.get("acodec"), a_allowed) is not None:
+            # Single files only when plain downloads; HLS variants are slower to fetch.
+            combined.append((_video_key(f, rank), f))
+
+    best_video = max(videos, key=lambda x: x[0]) if videos else None
+    best_combined = max(combined, key=lambda x: x[0]) if combined else None
+    audio = _best_audio(formats, a_allowed)
+
+    # A single file of the same resolution needs no merge at all.
+    if best_combined and (not best_video or not audio or best_combined[0][:2] >= best_video[0][:2]):
+        f = best_combined[1]
+        plan.update(
+            {
+                "format": f"{f['format_id']}/{fallback}",
+                "video": _summary(f),
+                "processing": "none" if f.get("ext") == container else "remux",
+                "ext": container,
+            }
+        )
+    elif best_video and audio:
+        plan.update(
+            {
+                "format": f"{best_video[1]['format_id']}+{audio['format_id']}/{fallback}",
+                "video": _summary(best_video[1]),
+                "audio": _summary(audio),
+                "processing": "merge",
+                "ext": container,
+            }
+        )
+    return plan
+
 
-    info = extract(ydl_opts)
+def list_formats(url: str) -> dict[str, Any]:
+    info = get_info(url)
 
     fmts = info.get("formats") or []
 
@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import struct
+import time
+import zlib
+from collections.abc import Iterator
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from app.delivery import content_disposition, etag_for, not_modified
+from app.settings import settings
+from app.store import redis_conn
+
+_CHUNK_BYTES = 256 * 1024
+_CRC_PREFIX = "zipcrc:"
+
+_MAX32 = 0xFFFFFFFF
+_MAX16 = 0xFFFF
+# Bit 11: names are UTF-8.
+_FLAGS = 0x0800
+_VERSION = 20
+_VERSION_ZIP64 = 45
+# Made by: Unix, so external attributes carry the file mode.
+_MADE_BY = (3 << 8) | _VERSION_ZIP64
+_EXTERNAL_ATTR = (0o100644 << 16)
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+# Outputs are named "<job id>-<title>.<ext>"; the archive only needs the title.
+_JOB_PREFIX = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}-")
+
+
+def archive_name(file_name: str, taken: set[str]) -> str:
+    """Entry name for an output, made unique within the archive (and added to taken)."""
+
+    base = _JOB_PREFIX.sub("", os.path.basename(file_name)) or "download"
+    stem, ext = os.path.splitext(base)
+    name, n = base, 1
+    while name in taken:
+        n += 1
+        name = f"{stem} ({n}){ext}"
+    taken.add(name)
+    return name
+
+
+def _dos_datetime(mtime: float) -> tuple[int, int]:
+    t = time.localtime(max(mtime, 315532800))
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+    )
+
+
+class _Entry:
+    def __init__(self, path: str, name: str, st: os.stat_result, offset: int) -> None:
+        self.path = path
+        self.name = name.encode("utf-8")
+        self.st = st
+        self.size = st.st_size
+        self.offset = offset
+        self.crc: int | None = None
+        self.zip64_size = self.size >= _MAX32
+        self.zip64_offset = offset >= _MAX32
+        self.local_len = 30 + len(self.name) + (20 if self.zip64_size else 0)
+
+    @property
+    def crc_key(self) -> str:
+        return f"{_CRC_PREFIX}{self.st.st_dev:x}-{self.st.st_ino:x}-{self.size:x}-{self.st.st_mtime_ns:x}"
+
+    def local_header(self) -> bytes:
+        assert self.crc is not None
+        tm, dt = _dos_datetime(self.st.st_mtime)
+        size = _MAX32 if self.zip64_size else self.size
+        extra = struct.pack("<HHQQ", 1, 16, self.size, self.size) if self.zip64_size else b""
+        head = struct.pack(
+            "<IHHHHHIIIHH",
+            0x04034B50,
+            _VERSION_ZIP64 if self.zip64_size else _VERSION,
+            _FLAGS,
+            0,
+            tm,
+            dt,
+            self.crc,
+            size,
+            size,
+            len(self.name),
+            len(extra),
+        )
+        return head + self.name + extra
+
+    def central_header(self) -> bytes:
+        assert self.crc is not None
+        tm, dt = _dos_datetime(self.st.st_mtime)
+        extra_fields = b""
+        if self.zip64_size:
+            extra_fields += struct.pack("<QQ", self.size, self.size)
+        if self.zip64_offset:
+            extra_fields += struct.pack("<Q", self.offset)
+        extra = struct.pack("<HH", 1, len(extra_fields)) + extra_fields if extra_fields else b""
+        size = _MAX32 if self.zip64_size else self.size
+        head = struct.pack(
+            "<IHHHHHHIIIHHHHHII",
+            0x02014B50,
+            _MADE_BY,
+            _VERSION_ZIP64 if extra else _VERSION,
+            _FLAGS,
+            0,
+            tm,
+            dt,
+            self.crc,
+            size,
+            size,
+            len(self.name),
+            len(extra),
+            0,
+            0,
+            0,
+            _EXTERNAL_ATTR,
+            _MAX32 if self.zip64_offset else self.offset,
+        )
+        return head + self.name + extra
+
+    def central_len(self) -> int:
+        extra = (16 if self.zip64_size else 0) + (8 if self.zip64_offset else 0)
+        return 46 + len(self.name) + (4 + extra if extra else 0)
+
+
+class ZipBundle:
+    """A stored (uncompressed) ZIP of existing files, laid out without reading them.
+
+    The archive size and every offset follow from the names and file sizes, so
+    the response has a Content-Length and any byte range can be produced on
+    its own. CRC-32s are computed the first time an entry header is needed and
+    cached in Redis per file version.
+    """
+
+    def __init__(self, files: list[tuple[str, str]]) -> None:
+        self.entries: list[_Entry] = []
+        offset = 0
+        for path, name in files:
+            st = os.stat(path)
+            e = _Entry(path, name, st, offset)
+            self.entries.append(e)
+            offset += e.local_len + e.size
+        self.cd_offset = offset
+        self.cd_size = sum(e.central_len() for e in self.entries)
+        self.zip64_end = (
+            len(self.entries) >= _MAX16 or self.cd_offset >= _MAX32 or self.cd_size >= _MAX32
+        )
+        self.size = self.cd_offset + self.cd_size + (56 + 20 if self.zip64_end else 0) + 22
+        self.mtime = max((e.st.st_mtime for e in self.entries), default=0.0)
+        digest = hashlib.sha1()
+        for e in self.entries:
+            digest.update(e.name + b"\0" + etag_for(e.st).encode("ascii"))
+        self.etag = f'"zip-{digest.hexdigest()}"'
+        self._load_crcs()
+
+    def _load_crcs(self) -> None:
+        if not self.entries:
+            return
+        cached = redis_conn().mget([e.crc_key for e in self.entries])
+        for e, v in zip(self.entries, cached):
+            if v is not None:
+                e.crc = int(v)
+
+    def _ensure_crc(self, e: _Entry) -> None:
+        if e.crc is not None:
+            return
+        crc = 0
+        with open(e.path, "rb") as f:
+            while chunk := f.read(_CHUNK_BYTES):
+                crc = zlib.crc32(chunk, crc)
+        e.crc = crc
+        redis_conn().set(e.crc_key, crc, ex=settings.job_ttl_hours * 3600)
+
+    def _central_directory(self) -> bytes:
+        for e in self.entries:
+            self._ensure_crc(e)
+        out = b"".join(e.central_header() for e in self.entries)
+        n = len(self.entries)
+        if self.zip64_end:
+            end64_offset = self.cd_offset + self.cd_size
+            out += struct.pack(
+                "<IQHHIIQQQQ",
+                0x06064B50,
+                44,
+                _MADE_BY,
+                _VERSION_ZIP64,
+                0,
+                0,
+                n,
+                n,
+                self.cd_size,
+                self.cd_offset,
+            )
+            out += struct.pack("<IIQI", 0x07064B50, 0, end64_offset, 1)
+        out += struct.pack(
+            "<IHHHHIIH",
+            0x06054B50,
+            0,
+            0,
+            min(n, _MAX16),
+            min(n, _MAX16),
+            min(self.cd_size, _MAX32),
+            min(self.cd_offset, _MAX32),
+            0,
+        )
+        return out
+
+    def _file_range(self, e: _Entry, lo: int, hi: int) -> Iterator[bytes]:
+        with open(e.path, "rb") as f:
+            if os.fstat(f.fileno()).st_ino != e.st.st_ino:
+                raise FileNotFoundError(e.path)
+            f.seek(lo)
+            while lo < hi:
+                chunk = f.read(min(_CHUNK_BYTES, hi - lo))
+                if not chunk:
+                    # Truncated under us; cut the transfer rather than send a corrupt archive.
+                    raise OSError(f"{e.path} changed while streaming")
+                lo += len(chunk)
+                yield chunk
+
+    def iter_range(self, start: int, end: int) -> Iterator[bytes]:
+        """Yield archive bytes [start, end)."""
+
+        for e in self.entries:
+            data_start = e.offset + e.local_len
+            if end <= e.offset:
+                return
+            if start < data_start:
+                self._ensure_crc(e)
+                yield e.local_header()[max(0, start - e.offset) : end - e.offset]
+            lo, hi = max(start, data_start), min(end, data_start + e.size)
+            if lo < hi:
+                yield from self._file_range(e, lo - data_start, hi - data_start)
+        if end > self.cd_offset:
+            yield self._central_directory()[max(0, start - self.cd_offset) : end - self.cd_offset]
+
+
+def _parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """Single byte range as [start, end); multi-range requests are answered with the full body."""
+
+    m = _RANGE.match(header.strip())
+    if not m:
+        return None
+    first, last = m.groups()
+    if not first:
+        if not last:
+            return None
+        return max(0, size - int(last)), size
+    start = int(first)
+    end = min(size, int(last) + 1) if last else size
+    return start, end
+
+
+def _if_range_ok(request: Request, etag: str, mtime: float) -> bool:
+    value = request.headers.get("if-range")
+    if value is None:
+        return True
+    if value.startswith('"') or value.startswith("W/"):
+        return value == etag
+    try:
+        return int(mtime) <= parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def deliver_zip(request: Request, files: list[tuple[str, str]], filename: str) -> Response:
+    """Stream files as one ZIP, with validators, 304s and single-range support."""
+
+    bundle = ZipBundle(files)
+    headers = {
+        "ETag": bundle.etag,
+        "Last-Modified": formatdate(bundle.mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": content_disposition(filename),
+    }
+    if not_modified(request, bundle.etag, bundle.mtime):
+        return Response(status_code=304, headers=headers)
+
+    status, start, end = 200, 0, bundle.size
+    range_header = request.headers.get("range")
+    if range_header and _if_range_ok(request, bundle.etag, bundle.mtime):
+        requested = _parse_range(range_header, bundle.size)
+        if requested is not None:
+            start, end = requested
+            if start >= end:
+                headers["Content-Range"] = f"bytes */{bundle.size}"
+                return Response(status_code=416, headers=headers)
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{bundle.size}"
+
+    headers["Content-Length"] = str(end - start)
+    if request.method == "HEAD":
+        return Response(status_code=status, headers=headers, media_type="application/zip")
+    return StreamingResponse(
+        bundle.iter_range(start, end), status_code=status, headers=headers, media_type="application/zip"
+    )
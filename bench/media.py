@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from urllib.parse import urlparse
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+_CHUNK_BYTES = 256 * 1024
+
+
+def _ffmpeg(*args: str) -> bool:
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args]
+    return subprocess.run(cmd, stdin=subprocess.DEVNULL).returncode == 0
+
+
+def generate(directory: str, *, seconds: int, size_mb: float) -> dict[str, Any]:
+    """Write the benchmark media once and return its manifest.
+
+    With ffmpeg: a video-only and an audio-only stream (so jobs go through the
+    merge path, like YouTube DASH) plus a progressive file. Without ffmpeg: a
+    single progressive file of random bytes, which needs no post-processing.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, f"manifest-{seconds}-{size_mb}.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    video_kbps = max(64, int(size_mb * 8 * 1024 / seconds) - 128)
+    formats: list[dict[str, Any]] = []
+    lavfi_video = ["-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={seconds}"]
+    lavfi_audio = ["-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}"]
+    if shutil.which("ffmpeg") and _ffmpeg(
+        *lavfi_video, "-c:v", "libx264", "-preset", "ultrafast", "-b:v", f"{video_kbps}k", "-an",
+        os.path.join(directory, "video.mp4"),
+    ):
+        _ffmpeg(*lavfi_audio, "-c:a", "aac", "-b:a", "128k", "-vn", os.path.join(directory, "audio.m4a"))
+        _ffmpeg(
+            "-i", os.path.join(directory, "video.mp4"), "-i", os.path.join(directory, "audio.m4a"),
+            "-c", "copy", os.path.join(directory, "progressive.mp4"),
+        )
+        formats = [
+            {"format_id": "137", "path": "video.mp4", "ext": "mp4", "vcodec": "avc1.64001f", "acodec": "none",
+             "width": 1280, "height": 720, "fps": 30, "tbr": video_kbps},
+            {"format_id": "140", "path": "audio.m4a", "ext": "m4a", "vcodec": "none", "acodec": "mp4a.40.2",
+             "abr": 128, "tbr": 128},
+            {"format_id": "18", "path": "progressive.mp4", "ext": "mp4", "vcodec": "avc1.64001f",
+             "acodec": "mp4a.40.2", "width": 1280, "height": 720, "fps": 30, "tbr": video_kbps + 128},
+        ]
+    else:
+        with open(os.path.join(directory, "progressive.mp4"), "wb") as f:
+            remaining = int(size_mb * 1024 * 1024)
+            while remaining > 0:
+                n = min(_CHUNK_BYTES, remaining)
+                f.write(os.urandom(n))
+                remaining -= n
+        formats = [
+            {"format_id": "18", "path": "progressive.mp4", "ext": "mp4", "vcodec": "avc1.64001f",
+             "acodec": "mp4a.40.2", "width": 1280, "height": 720, "fps": 30},
+        ]
+
+    for f in formats:
+        f["filesize"] = os.path.getsize(os.path.join(directory, f["path"]))
+        f["protocol"] = "https"
+    manifest = {"duration": seconds, "formats": formats}
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+class MediaServer:
+    """Local HTTP server for the manifest and media files (single-range aware)."""
+
+    def __init__(self, directory: str, manifest: dict[str, Any], *, extract_delay: float = 0.0) -> None:
+        self.directory = directory
+        self.manifest_body = json.dumps(manifest).encode()
+        self.extract_delay = extract_delay
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self) -> None:
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+            def do_HEAD(self) -> None:
+                self.do_GET()
+
+            def do_GET(self) -> None:
+                with server._lock:
+                    server.requests += 1
+                path = urlparse(self.path).path.lstrip("/")
+                if path == "manifest.json":
+                    # Stands in for the metadata round trips of a real extraction.
+                    if server.extract_delay:
+                        time.sleep(server.extract_delay)
+                    self._send(200, body=server.manifest_body, content_type="application/json")
+                    return
+                full = os.path.join(server.directory, os.path.basename(path))
+                if not path or not os.path.isfile(full):
+                    self._send(404, body=b"not found")
+                    return
+                self._send_file(full)
+
+            def _send(self, status: int, *, body: bytes, content_type: str = "text/plain") -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _send_file(self, full: str) -> None:
+                size = os.path.getsize(full)
+                start, end, status = 0, size, 200
+                m = _RANGE.match(self.headers.get("Range", "").strip())
+                if m and (m.group(1) or m.group(2)):
+                    if m.group(1):
+                        start = int(m.group(1))
+                        end = min(size, int(m.group(2)) + 1) if m.group(2) else size
+                    else:
+                        start = max(0, size - int(m.group(2)))
+                    if start >= end:
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{size}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    status = 206
+                self.send_response(status)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(end - start))
+                if status == 206:
+                    self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+                self.end_headers()
+                if self.command == "HEAD":
+                    return
+                with open(full, "rb") as f:
+                    f.seek(start)
+                    remaining = end - start
+                    while remaining > 0:
+                        chunk = f.read(min(_CHUNK_BYTES, remaining))
+                        if not chunk:
+                            break
+                        try:
+                            self.wfile.write(chunk)
+                        except (BrokenPipeError, ConnectionResetError):
+                            return
+                        remaining -= len(chunk)
+
+        return Handler
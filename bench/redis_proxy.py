@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import socket
+import threading
+from socketserver import BaseRequestHandler, ThreadingTCPServer
+
+
+class _CommandParser:
+    """Splits a client-to-server RESP byte stream into commands."""
+
+    def __init__(self) -> None:
+        self.buf = b""
+        self.bulks_left = 0
+        self.bulk_len = -1
+        self.args: list[bytes] = []
+
+    def feed(self, data: bytes) -> list[list[bytes]]:
+        commands: list[list[bytes]] = []
+        buf = self.buf + data
+        pos = 0
+        while pos < len(buf):
+            if self.bulk_len >= 0:
+                if len(buf) - pos < self.bulk_len + 2:
+                    break
+                self.args.append(buf[pos : pos + self.bulk_len])
+                pos += self.bulk_len + 2
+                self.bulk_len = -1
+                self.bulks_left -= 1
+                if not self.bulks_left:
+                    commands.append(self.args)
+                    self.args = []
+                continue
+            eol = buf.find(b"\r\n", pos)
+            if eol < 0:
+                break
+            line = buf[pos:eol]
+            pos = eol + 2
+            if self.bulks_left:
+                # "$<len>" header of one argument, then <len> bytes and CRLF.
+                self.bulk_len = int(line[1:])
+            elif line[:1] == b"*" and int(line[1:]) > 0:
+                self.bulks_left = int(line[1:])
+            else:
+                commands.append(line.split())
+        self.buf = buf[pos:]
+        return commands
+
+    @property
+    def idle(self) -> bool:
+        return not self.buf and not self.bulks_left and self.bulk_len < 0
+
+
+def _bulk(data: bytes) -> bytes:
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class CountingRedisProxy:
+    """TCP proxy in front of fakeredis that counts the commands it forwards.
+
+    It also answers the two commands the fakeredis TCP server gets wrong for
+    this app: INFO (unknown there; RQ reads the server version from it) and
+    CLIENT LIST (unparsable; RQ workers call it at startup). Both are only
+    ever sent on their own, outside pipelines, so they can be answered
+    without waiting for the upstream replies.
+    """
+
+    def __init__(self, upstream: tuple[str, int]) -> None:
+        self.upstream = upstream
+        self.commands = 0
+        self._lock = threading.Lock()
+        proxy = self
+
+        class Handler(BaseRequestHandler):
+            def handle(self) -> None:
+                up = socket.create_connection(proxy.upstream)
+                up.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                send_lock = threading.Lock()
+                threading.Thread(target=proxy._pipe_back, args=(up, self.request, send_lock), daemon=True).start()
+                parser = _CommandParser()
+                try:
+                    while data := self.request.recv(65536):
+                        commands = parser.feed(data)
+                        with proxy._lock:
+                            proxy.commands += len(commands)
+                        local = proxy._local_reply(commands) if parser.idle and len(commands) == 1 else None
+                        if local is not None:
+                            with send_lock:
+                                self.request.sendall(local)
+                        else:
+                            up.sendall(data)
+                except OSError:
+                    pass
+                finally:
+                    up.close()
+
+        ThreadingTCPServer.allow_reuse_address = True
+        self.server = ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    def _local_reply(self, commands: list[list[bytes]]) -> bytes | None:
+        args = [a.lower() for a in commands[0][:2]]
+        if args[:1] == [b"info"]:
+            with self._lock:
+                count = self.commands
+            text = f"# Server\r\nredis_version:7.2.0\r\n# Stats\r\ntotal_commands_processed:{count}\r\n"
+            return _bulk(text.encode())
+        if args == [b"client", b"list"]:
+            return _bulk(b"")
+        return None
+
+    @staticmethod
+    def _pipe_back(up: socket.socket, client: socket.socket, send_lock: threading.Lock) -> None:
+        try:
+            while data := up.recv(65536):
+                with send_lock:
+                    client.sendall(data)
+        except OSError:
+            pass
+        finally:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self) -> None:
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
@@ -0,0 +1,334 @@
+"""Offline end-to-end benchmark: web app, RQ workers and a local stand-in for YouTube.
+
+    python -m bench.run --jobs 40 --concurrency 8 --workers 2
+
+Starts a local media server, Redis (fakeredis over TCP unless --redis-url is
+given), the FastAPI app and worker processes, then runs jobs through
+/api/formats -> /api/jobs -> polling -> /download/{job_id} and reports
+throughput and latencies. Nothing leaves the machine.
+
+The fakeredis TCP server drops the connection on EVALSHA, which the bandwidth
+budget's token bucket uses; BANDWIDTH_*_BYTES_PER_SECOND settings therefore
+need --redis-url. Plain EVAL scripts (disk budget, range slots) work on it.
+"""
+
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from bench.media import MediaServer, generate
+from bench.redis_proxy import CountingRedisProxy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, "bench")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))], 3)
+
+
+class _Client:
+    """Keep-alive HTTP client for one load thread; records every request's latency."""
+
+    def __init__(self, port: int, stats: _WebStats) -> None:
+        self.port = port
+        self.stats = stats
+        self.conn: http.client.HTTPConnection | None = None
+
+    def request(self, method: str, path: str, body: Any = None, *, sink: bool = False) -> tuple[int, Any]:
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=600)
+            start = time.perf_counter()
+            try:
+                self.conn.request(method, path, body=payload, headers=headers)
+                resp = self.conn.getresponse()
+                if sink:
+                    size = 0
+                    while chunk := resp.read(256 * 1024):
+                        size += len(chunk)
+                    data: Any = size
+                else:
+                    raw = resp.read()
+                    data = json.loads(raw) if raw else None
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+                continue
+            self.stats.add(time.perf_counter() - start)
+            return resp.status, data
+        raise RuntimeError("unreachable")
+
+
+class _WebStats:
+    def __init__(self) -> None:
+        self.latencies: list[float] = []
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self.latencies.append(seconds)
+
+
+def _run_job(client: _Client, args: argparse.Namespace, video_id: str) -> dict[str, Any]:
+    url = f"https://bench.invalid/watch?v={video_id}"
+    t0 = time.perf_counter()
+    status, formats = client.request("POST", "/api/formats", {"url": url})
+    formats_s = time.perf_counter() - t0
+    if status != 200:
+        return {"ok": False, "error": f"formats {status}: {formats}", "formats_s": formats_s}
+
+    t1 = time.perf_counter()
+    status, created = client.request(
+        "POST",
+        "/api/jobs",
+        {
+            "url": url,
+            "format_id": args.format,
+            "container": args.container,
+            "mode": args.mode,
+            "duration": formats.get("duration"),
+        },
+    )
+    if status != 200:
+        return {"ok": False, "error": f"jobs {status}: {created}", "formats_s": formats_s}
+    job_id = created["job_id"]
+
+    deadline = t1 + args.job_timeout
+    state: dict[str, Any] = {}
+    while time.perf_counter() < deadline:
+        _, state = client.request("GET", f"/api/jobs/{job_id}")
+        if state.get("status") in ("finished", "failed"):
+            break
+        time.sleep(args.poll_interval)
+    if state.get("status") != "finished":
+        return {"ok": False, "error": state.get("error") or "timed out", "formats_s": formats_s}
+
+    status, nbytes = client.request("GET", f"/download/{job_id}", sink=True)
+    if status != 200:
+        return {"ok": False, "error": f"download {status}", "formats_s": formats_s}
+    return {
+        "ok": True,
+        "formats_s": formats_s,
+        "time_to_file_s": time.perf_counter() - t1,
+        "bytes": nbytes,
+        "phases": state.get("phases") or {},
+    }
+
+
+class _Redis:
+    """The Redis used by the run, and how to read its command counter."""
+
+    def __init__(self, url: str) -> None:
+        self.proxy: CountingRedisProxy | None = None
+        self.fake: Any = None
+        if url:
+            self.url = url
+            return
+        from fakeredis import TcpFakeServer
+
+        port = _free_port()
+        self.fake = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+        self.fake.daemon_threads = True
+        threading.Thread(target=self.fake.serve_forever, daemon=True).start()
+        self.proxy = CountingRedisProxy(("127.0.0.1", port))
+        self.proxy.start()
+        self.url = f"redis://127.0.0.1:{self.proxy.port}/0"
+
+    def commands(self) -> int:
+        import redis
+
+        with redis.Redis.from_url(self.url) as r:
+            return int(r.info("stats")["total_commands_processed"])
+
+
+def _wait_http(port: int, path: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", path)
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"web app did not answer on port {port}")
+
+
+def main(argv: list[str] | None = None) -> int:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--jobs", type=int, default=40, help="jobs to run")
+    p.add_argument("--concurrency", type=int, default=8, help="simulated clients")
+    p.add_argument("--workers", type=int, default=2, help="worker processes (python -m app.worker)")
+    p.add_argument("--redis-url", default="", help="use this Redis instead of an in-process fakeredis")
+    p.add_argument("--size-mb", type=float, default=8.0, help="approximate size of the generated media")
+    p.add_argument("--seconds", type=int, default=20, help="duration of the generated media")
+    p.add_argument("--extract-delay", type=float, default=0.0, help="seconds added to each metadata extraction")
+    p.add_argument("--distinct", type=int, default=0, help="distinct videos (0 = one per job, no output reuse)")
+    p.add_argument("--format", default="best")
+    p.add_argument("--container", default="mp4")
+    p.add_argument("--mode", default="auto")
+    p.add_argument("--poll-interval", type=float, default=0.25)
+    p.add_argument("--job-timeout", type=float, default=600.0)
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra settings for web and workers")
+    p.add_argument("--media-dir", default=os.path.join(tempfile.gettempdir(), "baixar-bench-media"))
+    p.add_argument("--keep", action="store_true", help="keep the download directory and logs")
+    p.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = p.parse_args(argv)
+    overrides = {**os.environ, **dict(item.partition("=")[::2] for item in args.env)}
+    if not args.redis_url and any(
+        float(overrides.get(k) or 0) > 0
+        for k in ("BANDWIDTH_TOTAL_BYTES_PER_SECOND", "BANDWIDTH_PER_JOB_BYTES_PER_SECOND")
+    ):
+        p.error("the bandwidth budget needs --redis-url (fakeredis over TCP does not run EVALSHA)")
+
+    manifest = generate(args.media_dir, seconds=args.seconds, size_mb=args.size_mb)
+    media = MediaServer(args.media_dir, manifest, extract_delay=args.extract_delay)
+    media.start()
+    redis_ = _Redis(args.redis_url)
+
+    work_dir = tempfile.mkdtemp(prefix="baixar-bench-")
+    env = dict(os.environ)
+    env.update(
+        {
+            "REDIS_URL": redis_.url,
+            "DOWNLOAD_DIR": os.path.join(work_dir, "data"),
+            "PUBLIC_BASE_URL": "",
+            "BAIXAR_BENCH_MEDIA_URL": media.url,
+            # The app from this checkout, and bench/ so yt-dlp finds the stand-in extractor.
+            "PYTHONPATH": os.pathsep.join([ROOT, BENCH_DIR, env.get("PYTHONPATH", "")]).rstrip(os.pathsep),
+        }
+    )
+    # The bench has no separate postprocess workers: its workers drain every queue unless told otherwise.
+    env.setdefault("WORKER_STAGE", "all")
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    web_port = _free_port()
+    procs: list[subprocess.Popen[bytes]] = []
+    logs = []
+    try:
+        log = open(os.path.join(work_dir, "web.log"), "wb")
+        logs.append(log)
+        procs.append(
+            subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(web_port),
+                 "--log-level", "warning"],
+                env=env, stdout=log, stderr=subprocess.STDOUT,
+            )
+        )
+        for i in range(args.workers):
+            log = open(os.path.join(work_dir, f"worker-{i}.log"), "wb")
+            logs.append(log)
+            procs.append(
+                subprocess.Popen([sys.executable, "-m", "app.worker"], env=env, stdout=log, stderr=subprocess.STDOUT)
+            )
+        _wait_http(web_port, "/health", 30)
+
+        web = _WebStats()
+        clients = threading.local()
+        run_id = uuid.uuid4().hex[:8]
+
+        def one(i: int) -> dict[str, Any]:
+            if not hasattr(clients, "c"):
+                clients.c = _Client(web_port, web)
+            n = i % args.distinct if args.distinct else i
+            try:
+                return _run_job(clients.c, args, f"{run_id}-{n}")
+            except Exception as e:
+                return {"ok": False, "error": str(e)}
+
+        commands_before = redis_.commands()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(one, range(args.jobs)))
+        wall = time.perf_counter() - started
+        commands = redis_.commands() - commands_before
+    finally:
+        for proc in procs:
+            proc.send_signal(signal.SIGTERM)
+        for proc in procs:
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        for log in logs:
+            log.close()
+        media.stop()
+
+    ok = [r for r in results if r["ok"]]
+    failed = [r for r in results if not r["ok"]]
+    report: dict[str, Any] = {
+        "jobs": args.jobs,
+        "ok": len(ok),
+        "failed": len(failed),
+        "errors": sorted({str(r.get("error"))[:200] for r in failed})[:5],
+        "concurrency": args.concurrency,
+        "workers": args.workers,
+        "redis": "external" if args.redis_url else "fakeredis",
+        "media_bytes": max((r["bytes"] for r in ok), default=0),
+        "wall_seconds": round(wall, 3),
+        "jobs_per_minute": round(len(ok) * 60 / wall, 2) if wall else 0.0,
+        "time_to_file_p50": _percentile([r["time_to_file_s"] for r in ok], 0.5),
+        "time_to_file_p95": _percentile([r["time_to_file_s"] for r in ok], 0.95),
+        "formats_p50": _percentile([r["formats_s"] for r in results if "formats_s" in r], 0.5),
+        "formats_p95": _percentile([r["formats_s"] for r in results if "formats_s" in r], 0.95),
+        "web_requests": len(web.latencies),
+        "web_requests_per_second": round(len(web.latencies) / wall, 2) if wall else 0.0,
+        "web_latency_p50": _percentile(web.latencies, 0.5),
+        "web_latency_p95": _percentile(web.latencies, 0.95),
+        "redis_commands": commands,
+        "redis_commands_per_job": round(commands / args.jobs, 1) if args.jobs else 0.0,
+        "media_server_requests": media.requests,
+    }
+    for phase in ("queue", "extract", "download", "postprocess_queue", "postprocess"):
+        values = [r["phases"][phase] for r in ok if phase in r.get("phases", {})]
+        if values:
+            report[f"{phase}_p50"] = _percentile(values, 0.5)
+            report[f"{phase}_p95"] = _percentile(values, 0.95)
+
+    if args.keep:
+        report["work_dir"] = work_dir
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        width = max(len(k) for k in report)
+        for k, v in report.items():
+            print(f"{k.ljust(width)}  {v}")
+    return 0 if not failed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
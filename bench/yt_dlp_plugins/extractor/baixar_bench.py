@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import os
+from typing import Any
+
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class BaixarBenchIE(InfoExtractor):
+    """Stand-in for YouTube: formats come from the benchmark's local media server.
+
+    Loaded by yt-dlp as a plugin when bench/ is on PYTHONPATH; the server URL is
+    taken from BAIXAR_BENCH_MEDIA_URL.
+    """
+
+    IE_NAME = "baixar:bench"
+    _VALID_URL = r"https?://bench\.invalid/watch\?v=(?P<id>[\w-]+)"
+
+    def _real_extract(self, url: str) -> dict[str, Any]:
+        video_id = self._match_id(url)
+        base = os.environ["BAIXAR_BENCH_MEDIA_URL"].rstrip("/")
+        manifest = self._download_json(f"{base}/manifest.json", video_id, query={"v": video_id})
+        formats = []
+        for f in manifest["formats"]:
+            f = dict(f)
+            f["url"] = f"{base}/{f.pop('path')}"
+            formats.append(f)
+        return {
+            "id": video_id,
+            "title": f"Bench {video_id}",
+            "duration": manifest["duration"],
+            "webpage_url": url,
+            "formats": formats,
+        }
@@ -0,0 +1,22 @@
+from __future__ import annotations
+
+import fakeredis
+import pytest
+import redis
+
+from app import store
+
+
+@pytest.fixture(autouse=True)
+def fake_redis(monkeypatch: pytest.MonkeyPatch) -> fakeredis.FakeServer:
+    """Point the process-wide pools at an in-memory Redis, fresh for every test."""
+
+    server = fakeredis.FakeServer()
+    pools = {
+        decode: redis.ConnectionPool(
+            connection_class=fakeredis.FakeRedisConnection, server=server, decode_responses=decode
+        )
+        for decode in (True, False)
+    }
+    monkeypatch.setattr(store, "_pool", lambda decode_responses: pools[decode_responses])
+    return server
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app import bandwidth
+from app.bandwidth import BandwidthLease
+
+
+@pytest.fixture
+def budget(monkeypatch: pytest.MonkeyPatch) -> list[float]:
+    monkeypatch.setattr(bandwidth.settings, "bandwidth_total_bytes_per_second", 1000)
+    monkeypatch.setattr(bandwidth.settings, "bandwidth_per_job_bytes_per_second", 0)
+    monkeypatch.setattr(bandwidth.settings, "bandwidth_charge_bytes", 100)
+    sleeps: list[float] = []
+    # A frozen clock: the bucket refills only when a test says so.
+    clock = SimpleNamespace(time=lambda: 1000.0, monotonic=time.monotonic, sleep=sleeps.append)
+    monkeypatch.setattr(bandwidth, "time", clock)
+    return sleeps
+
+
+def take(lease: BandwidthLease, now: float, requested: int) -> float:
+    return float(lease._take(keys=[bandwidth._BUCKET_KEY], args=[1000, 1000, now, requested]))
+
+
+def test_bucket_starts_full_and_refills_at_the_rate(budget: list[float]) -> None:
+    lease = BandwidthLease("a")
+    assert take(lease, 100.0, 600) == 0
+    assert take(lease, 100.0, 400) == 0
+    # Empty: the caller waits for the deficit to refill.
+    assert take(lease, 100.0, 500) == pytest.approx(0.5)
+    # 0.5 s later the debt is paid; another 0.25 s refills 250 bytes.
+    assert take(lease, 100.75, 250) == 0
+    assert take(lease, 100.75, 100) == pytest.approx(0.1)
+
+
+def test_refill_is_capped_at_one_second_of_burst(budget: list[float]) -> None:
+    lease = BandwidthLease("a")
+    take(lease, 100.0, 1000)
+    assert take(lease, 200.0, 1000) == 0
+    assert take(lease, 200.0, 1) > 0
+
+
+def test_consume_charges_in_batches_and_sleeps_off_the_deficit(budget: list[float]) -> None:
+    lease = BandwidthLease("a")
+    lease.consume(60)
+    assert budget == []
+    lease.consume(1940)
+    lease.consume(100)
+    # 2000 bytes against a full 1000-byte bucket, then 100 more.
+    assert len(budget) == 2
+    assert budget == [pytest.approx(1.0), pytest.approx(1.1)]
+
+
+def test_rate_is_split_between_active_jobs(budget: list[float], monkeypatch: pytest.MonkeyPatch) -> None:
+    a, b = BandwidthLease("a"), BandwidthLease("b")
+    assert a.refresh() == 1000
+    assert b.refresh() == 500
+    assert a.refresh() == 500
+    monkeypatch.setattr(bandwidth.settings, "bandwidth_per_job_bytes_per_second", 300)
+    assert a.refresh() == 300
+    b.release()
+    monkeypatch.setattr(bandwidth.settings, "bandwidth_per_job_bytes_per_second", 0)
+    assert a.refresh() == 1000
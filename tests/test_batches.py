@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import itertools
+
+import pytest
+
+from app import batches
+from app.store import set_state
+
+URLS = [f"https://youtu.be/video{n:05d}" for n in range(5)]
+
+
+@pytest.fixture
+def submitted(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    """Stub out the queue: children are registered as queued jobs, or finished if cached."""
+
+    monkeypatch.setattr(batches.settings, "batch_max_concurrency", 2)
+    urls: list[str] = []
+    ids = itertools.count()
+
+    def enqueue_download(*, url: str, batch_id: str, **kwargs) -> str:
+        job_id = f"child-{next(ids)}"
+        urls.append(url)
+        status = "finished" if url.endswith("cached") else "queued"
+        set_state(job_id, {"job_id": job_id, "status": status, "url": url, "batch_id": batch_id})
+        return job_id
+
+    monkeypatch.setattr(batches, "enqueue_download", enqueue_download)
+    return urls
+
+
+def create(urls: list[str]) -> str:
+    return batches.create_batch(urls=urls, playlist_url="", format_id="best", container="mp4", mode="video")
+
+
+def test_children_are_submitted_up_to_the_concurrency_cap(submitted: list[str]) -> None:
+    batch_id = create(URLS)
+    assert submitted == URLS[:2]
+    status = batches.batch_status(batch_id)
+    assert (status["status"], status["total"], status["pending"], status["queued"]) == ("running", 5, 3, 2)
+
+    set_state("child-0", {"status": "finished"})
+    batches.on_jobs_settled(["child-0"])
+    assert submitted == URLS[:3]
+
+    # Nothing settled: another look submits nothing.
+    batches.advance(batch_id)
+    assert submitted == URLS[:3]
+
+
+def test_cached_children_do_not_take_a_slot(submitted: list[str]) -> None:
+    urls = ["https://youtu.be/cached", "https://youtu.be/cached", *URLS[:3]]
+    batch_id = create(urls)
+    assert submitted == urls[:4]
+    assert batches.batch_status(batch_id)["finished"] == 2
+
+
+def test_advance_during_a_pass_triggers_another_pass(
+    submitted: list[str], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(batches.settings, "batch_max_concurrency", 1)
+    passes = []
+    advance_locked = batches._advance_locked
+
+    def one_pass(batch_id: str, *, expand: bool) -> None:
+        advance_locked(batch_id, expand=expand)
+        passes.append(list(submitted))
+        if len(passes) == 1:
+            # The first child settles while the pass is still running.
+            set_state("child-0", {"status": "finished"})
+            batches.advance(batch_id)
+
+    monkeypatch.setattr(batches, "_advance_locked", one_pass)
+    batch_id = create(URLS)
+    assert passes == [URLS[:1], URLS[:2]]
+    assert not batches.redis_conn().exists(f"batch:{batch_id}:lock")
+
+
+def test_a_lock_taken_over_meanwhile_is_left_alone(submitted: list[str], monkeypatch: pytest.MonkeyPatch) -> None:
+    advance_locked = batches._advance_locked
+
+    def slow_pass(batch_id: str, *, expand: bool) -> None:
+        advance_locked(batch_id, expand=expand)
+        # The pass outlived the lock TTL and another call took the lock over.
+        batches.redis_conn().set(f"batch:{batch_id}:lock", "other")
+
+    monkeypatch.setattr(batches, "_advance_locked", slow_pass)
+    batch_id = create(URLS)
+    assert batches.redis_conn().get(f"batch:{batch_id}:lock") == "other"
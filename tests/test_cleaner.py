@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import time
+
+from app import cleaner
+from app.cleaner import sweep_expired
+from app.outputs import _refs_key, add_ref
+from app.store import EXPIRY_KEY, file_expiry_member, get_state, job_key, redis_conn, set_state
+
+
+def test_sweep_keeps_referenced_outputs_and_deletes_the_rest(tmp_path) -> None:
+    r = redis_conn()
+    now = time.time()
+    unused, reused = tmp_path / "a.mp4", tmp_path / "b.mp4"
+    unused.write_bytes(b"a")
+    reused.write_bytes(b"b")
+
+    # Its only job expired an hour ago.
+    r.zadd(_refs_key(str(unused)), {"old-job": now - 3600})
+    # Produced by an expired job, but a newer job still serves it.
+    r.zadd(_refs_key(str(reused)), {"old-job": now - 3600})
+    add_ref(str(reused), "new-job")
+    new_deadline = r.zscore(EXPIRY_KEY, file_expiry_member(str(reused)))
+    r.zadd(EXPIRY_KEY, {file_expiry_member(str(unused)): now - 1, file_expiry_member(str(reused)): now - 1})
+
+    set_state("old-job", {"status": "finished"})
+    set_state("new-job", {"status": "finished"})
+    r.zadd(EXPIRY_KEY, {job_key("old-job"): now - 1})
+
+    assert sweep_expired(r, now) == 3
+    assert not unused.exists()
+    assert reused.exists()
+    assert r.zscore(EXPIRY_KEY, file_expiry_member(str(reused))) == new_deadline
+    assert get_state("old-job") is None
+    assert get_state("new-job") is not None
+    # Nothing is due any more.
+    assert sweep_expired(r, now) == 0
+
+
+def test_sweep_works_through_large_backlogs_in_batches(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(cleaner.settings, "clean_batch_size", 7)
+    r = redis_conn()
+    now = time.time()
+    for i in range(20):
+        set_state(f"j{i}", {"status": "failed"})
+        r.zadd(EXPIRY_KEY, {job_key(f"j{i}"): now - 1})
+
+    assert sweep_expired(r, now) == 20
+    assert r.zcard(EXPIRY_KEY) == 0
+    assert not r.keys("job:*")
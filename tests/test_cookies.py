@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from app import cookies
+
+
+@pytest.fixture(autouse=True)
+def pool(monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    src = tmp_path / "accounts"
+    src.mkdir()
+    for name in "abc":
+        (src / f"{name}.txt").write_text(f"# Netscape HTTP Cookie File\n# {name}\n")
+    for key in list(os.environ):
+        if key.startswith("YTDLP_COOKIES"):
+            monkeypatch.delenv(key)
+    monkeypatch.setenv("YTDLP_COOKIES_DIR", str(src))
+    monkeypatch.setenv("DOWNLOAD_DIR", str(tmp_path / "data"))
+    monkeypatch.setattr(cookies, "_accounts_cache", (0.0, []))
+
+
+def test_accounts_are_leased_least_recently_used_first() -> None:
+    leased = [cookies.lease_account().name for _ in range(6)]
+    assert leased == ["a", "b", "c", "a", "b", "c"]
+
+
+def test_bot_checked_accounts_cool_down() -> None:
+    a = cookies.lease_account()
+    assert a.name == "a"
+    assert not cookies.report_failure(a, "HTTP Error 403: Forbidden")
+    assert cookies.report_failure(a, "ERROR: Sign in to confirm you're not a bot")
+
+    leased = [cookies.lease_account().name for _ in range(4)]
+    assert leased == ["b", "c", "b", "c"]
+    status = {item["name"]: item for item in cookies.pool_status()["accounts"]}
+    assert status["a"]["bot_checks"] == 1
+    assert status["a"]["cooldown_seconds"] > 0
+    assert status["b"]["cooldown_seconds"] == 0
+
+
+def test_everyone_cooling_down_still_gets_an_account() -> None:
+    for account in cookies.accounts():
+        cookies.report_failure(account, "confirm you’re not a bot")
+    assert cookies.lease_account() is not None
+
+
+def test_release_deletes_the_threads_copy() -> None:
+    account = cookies.lease_account()
+    path = account.path()
+    assert open(path).read() == account.data.decode()
+    account.release()
+    assert not os.path.exists(path)
+    account.release()
+
+
+def test_ensure_cookiefile_deletes_its_copy_on_exit() -> None:
+    with cookies.ensure_cookiefile() as path:
+        assert os.path.exists(path)
+    assert not os.path.exists(path)
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+from typing import Any
+
+import pytest
+from fastapi import Request
+
+from app.delivery import OutputFileResponse, deliver_file, etag_for, not_modified
+from app.settings import settings
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def output(tmp_path) -> str:
+    path = tmp_path / "job-Title.mp4"
+    path.write_bytes(DATA)
+    return str(path)
+
+
+def scope(headers: dict[str, str], method: str = "GET") -> dict[str, Any]:
+    raw = [(k.lower().encode(), v.encode()) for k, v in headers.items()]
+    return {"type": "http", "method": method, "path": "/", "headers": raw, "query_string": b""}
+
+
+def send_through(response: Any, headers: dict[str, str], method: str = "GET") -> tuple[int, dict[str, str], bytes]:
+    messages: list[dict[str, Any]] = []
+
+    async def receive() -> dict[str, Any]:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: dict[str, Any]) -> None:
+        messages.append(message)
+
+    asyncio.run(response(scope(headers, method), receive, send))
+    start = messages[0]
+    out_headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    return start["status"], out_headers, b"".join(m.get("body", b"") for m in messages[1:])
+
+
+def test_multipart_byteranges(output) -> None:
+    status, headers, body = send_through(
+        OutputFileResponse(output, filename="t.mp4", media_type="video/mp4"), {"Range": "bytes=0-9,100-109"}
+    )
+    assert status == 206
+    boundary = re.fullmatch(r"multipart/byteranges; boundary=(\w+)", headers["content-type"]).group(1)
+    assert int(headers["content-length"]) == len(body)
+    assert body == (
+        f"--{boundary}\r\nContent-Type: video/mp4\r\nContent-Range: bytes 0-9/{len(DATA)}\r\n\r\n".encode()
+        + DATA[0:10]
+        + b"\r\n"
+        + f"--{boundary}\r\nContent-Type: video/mp4\r\nContent-Range: bytes 100-109/{len(DATA)}\r\n\r\n".encode()
+        + DATA[100:110]
+        + b"\r\n"
+        + f"--{boundary}--\r\n".encode()
+    )
+
+
+def test_multipart_head_has_the_same_length(output) -> None:
+    response = OutputFileResponse(output, filename="t.mp4", media_type="video/mp4")
+    _, get_headers, body = send_through(response, {"Range": "bytes=0-9,100-109"})
+    response = OutputFileResponse(output, filename="t.mp4", media_type="video/mp4")
+    status, head_headers, head_body = send_through(response, {"Range": "bytes=0-9,100-109"}, method="HEAD")
+    assert status == 206
+    assert head_body == b""
+    assert head_headers["content-length"] == get_headers["content-length"] == str(len(body))
+
+
+def test_single_range(output) -> None:
+    response = OutputFileResponse(output, filename="t.mp4", media_type="video/mp4")
+    status, headers, body = send_through(response, {"Range": "bytes=10-19"})
+    assert status == 206
+    assert headers["content-range"] == f"bytes 10-19/{len(DATA)}"
+    assert body == DATA[10:20]
+
+
+def test_etag_and_conditional_requests(output) -> None:
+    st = os.stat(output)
+    etag = etag_for(st)
+    assert etag == f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+    response = deliver_file(Request(scope({})), output, "t.mp4")
+    assert response.status_code == 200
+    assert response.headers["etag"] == etag
+
+    for header in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        assert deliver_file(Request(scope({"If-None-Match": header})), output, "t.mp4").status_code == 304
+    assert deliver_file(Request(scope({"If-None-Match": '"other"'})), output, "t.mp4").status_code == 200
+    # If-None-Match wins over If-Modified-Since.
+    assert not not_modified(
+        Request(scope({"If-None-Match": '"other"', "If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})),
+        etag,
+        st.st_mtime,
+    )
+    assert not_modified(Request(scope({"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})), etag, st.st_mtime)
+
+
+def test_offload_to_the_proxy(output, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings, "download_dir", os.path.dirname(output))
+    monkeypatch.setattr(settings, "download_offload", "x-accel")
+    response = deliver_file(Request(scope({})), output, "Título.mp4")
+    assert response.headers["x-accel-redirect"].endswith("/job-Title.mp4")
+    assert response.headers["content-disposition"] == "attachment; filename*=utf-8''T%C3%ADtulo.mp4"
+    assert response.body == b""
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from app import disk_budget
+from app.disk_budget import DiskFull
+from app.outputs import publish_output
+from app.store import redis_conn
+
+
+@pytest.fixture(autouse=True)
+def budget(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(disk_budget.settings, "disk_budget_bytes", 1000)
+    monkeypatch.setattr(disk_budget.settings, "disk_high_watermark", 0.9)
+    monkeypatch.setattr(disk_budget.settings, "disk_low_watermark", 0.8)
+    monkeypatch.setattr(disk_budget.settings, "disk_reserve_wait_seconds", 0)
+
+
+def output(tmp_path, name: str, size: int) -> str:
+    path = tmp_path / name
+    path.write_bytes(b"x" * size)
+    return str(path)
+
+
+def finish(job_id: str, path: str) -> None:
+    disk_budget.reserve(job_id, os.path.getsize(path))
+    publish_output(f"out:{job_id}", path=path, title="", job_id=job_id)
+    disk_budget.commit(job_id, path, f"out:{job_id}")
+
+
+def test_oversize_requests_are_rejected_at_once() -> None:
+    with pytest.raises(DiskFull):
+        disk_budget.reserve("j", 1001)
+    assert disk_budget.usage() == 0
+
+
+def test_reservation_becomes_the_file_size(tmp_path) -> None:
+    disk_budget.reserve("j", 400)
+    assert disk_budget.usage() == 400
+    path = output(tmp_path, "j.mp4", 150)
+    disk_budget.commit("j", path)
+    assert disk_budget.usage() == 150
+    assert disk_budget.tracked(path)
+
+
+def test_least_recently_downloaded_outputs_are_evicted(tmp_path) -> None:
+    paths = [output(tmp_path, f"{n}.mp4", 250) for n in "abc"]
+    for n, path in zip("abc", paths):
+        finish(n, path)
+    assert disk_budget.usage() == 750
+    # "a" was just downloaded again, so "b" is now the oldest.
+    disk_budget.touch(paths[0])
+
+    disk_budget.reserve("d", 300)
+    assert [os.path.exists(p) for p in paths] == [True, False, True]
+    assert not disk_budget.tracked(paths[1])
+    assert redis_conn().get("out:b") is None
+    assert disk_budget.usage() == 500 + 300
+
+
+def test_reserved_space_is_not_handed_out_twice() -> None:
+    disk_budget.reserve("a", 900)
+    with pytest.raises(DiskFull):
+        disk_budget.reserve("b", 200)
+    disk_budget.release("a")
+    disk_budget.reserve("b", 200)
+    assert disk_budget.usage() == 200
+
+
+def test_reservations_of_crashed_workers_expire(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(disk_budget.settings, "disk_reservation_ttl_seconds", -1)
+    disk_budget.reserve("crashed", 900)
+    monkeypatch.setattr(disk_budget.settings, "disk_reservation_ttl_seconds", 3600)
+    disk_budget.reserve("b", 500)
+    assert disk_budget.usage() == 500
+
+
+def test_reconcile_forgets_files_removed_by_hand(tmp_path) -> None:
+    path = output(tmp_path, "a.mp4", 100)
+    finish("a", path)
+    os.remove(path)
+    disk_budget.reconcile()
+    assert disk_budget.usage() == 0
+    assert redis_conn().get("out:a") is None
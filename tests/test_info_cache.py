@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+from typing import Any
+
+import pytest
+
+from app import info_cache
+from app.info_cache import canonical_video_id, get_info, info_key
+from app.store import redis_conn
+
+URL = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+
+
+@pytest.fixture
+def extractions(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    calls: list[str] = []
+
+    def extract(url: str) -> dict[str, Any]:
+        calls.append(url)
+        time.sleep(0.2)
+        return {"id": "dQw4w9WgXcQ", "title": "t"}
+
+    monkeypatch.setattr(info_cache, "_extract", extract)
+    return calls
+
+
+def test_canonical_video_id() -> None:
+    for url in (
+        URL,
+        "youtube.com/watch?v=dQw4w9WgXcQ&t=42",
+        "https://m.youtube.com/watch?v=dQw4w9WgXcQ",
+        "https://youtu.be/dQw4w9WgXcQ",
+        "https://www.youtube.com/shorts/dQw4w9WgXcQ",
+        "https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ",
+    ):
+        assert canonical_video_id(url) == "yt:dQw4w9WgXcQ", url
+    assert canonical_video_id("https://example.com/v.mp4").startswith("url:")
+    assert canonical_video_id(" https://example.com/v.mp4 ") == canonical_video_id("https://example.com/v.mp4")
+
+
+def test_concurrent_lookups_extract_once(extractions: list[str]) -> None:
+    results: list[dict[str, Any]] = []
+    threads = [threading.Thread(target=lambda: results.append(get_info(URL))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(extractions) == 1
+    assert results == [{"id": "dQw4w9WgXcQ", "title": "t"}] * 8
+    # Later lookups, from any URL form, are served from Redis.
+    assert get_info("https://youtu.be/dQw4w9WgXcQ")["title"] == "t"
+    assert len(extractions) == 1
+    assert redis_conn().ttl(info_key("yt:dQw4w9WgXcQ")) > 0
+
+
+def test_waits_for_another_process_holding_the_lock(extractions: list[str]) -> None:
+    r = redis_conn()
+    r.set(info_cache._lock_key("yt:dQw4w9WgXcQ"), "other", ex=30)
+
+    def other_process_finishes() -> None:
+        time.sleep(0.3)
+        r.set(info_key("yt:dQw4w9WgXcQ"), json.dumps({"id": "dQw4w9WgXcQ", "title": "theirs"}))
+
+    t = threading.Thread(target=other_process_finishes)
+    t.start()
+    assert get_info(URL)["title"] == "theirs"
+    t.join()
+    assert extractions == []
+
+
+def test_result_cached_just_before_the_lock_is_taken_is_used(
+    extractions: list[str], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    peek_info = info_cache.peek_info
+    peeks = []
+
+    def peek(url: str) -> dict[str, Any] | None:
+        peeks.append(url)
+        if len(peeks) == 1:
+            # Another process caches the result and releases its lock right after our first look.
+            redis_conn().set(info_key("yt:dQw4w9WgXcQ"), json.dumps({"id": "dQw4w9WgXcQ", "title": "theirs"}))
+            return None
+        return peek_info(url)
+
+    monkeypatch.setattr(info_cache, "peek_info", peek)
+    assert get_info(URL)["title"] == "theirs"
+    assert extractions == []
+    assert not redis_conn().exists(info_cache._lock_key("yt:dQw4w9WgXcQ"))
+
+
+def test_errors_reach_every_waiter_and_are_not_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    def extract(url: str) -> dict[str, Any]:
+        time.sleep(0.2)
+        raise RuntimeError("unavailable")
+
+    monkeypatch.setattr(info_cache, "_extract", extract)
+    errors: list[str] = []
+
+    def lookup() -> None:
+        try:
+            get_info(URL)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == ["unavailable"] * 4
+    assert redis_conn().get(info_key("yt:dQw4w9WgXcQ")) is None
+    assert redis_conn().get(info_cache._lock_key("yt:dQw4w9WgXcQ")) is None
@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import os
+
+from app.outputs import live_refs, output_key, publish_output, reuse_output
+from app.store import redis_conn
+
+
+def key(url: str = "https://www.youtube.com/watch?v=dQw4w9WgXcQ", **kwargs: str) -> str:
+    args = {"format_id": "h:720", "container": "mp4", "mode": "auto", **kwargs}
+    return output_key(url=url, **args)
+
+
+def test_same_video_from_any_url_shares_a_key() -> None:
+    assert key() == key("https://youtu.be/dQw4w9WgXcQ") == key("https://m.youtube.com/watch?v=dQw4w9WgXcQ&t=10")
+    assert key() == "out:yt:dQw4w9WgXcQ:auto:mp4:bestvideo[height<=720]+bestaudio/best"
+
+
+def test_container_and_selector_are_part_of_the_key() -> None:
+    assert key() != key(container="mkv")
+    assert key() != key(format_id="h:1080")
+    assert key(format_id="137") == "out:yt:dQw4w9WgXcQ:auto:mp4:id:137"
+
+
+def test_audio_modes() -> None:
+    # mp3 ignores the container; native audio depends on it (m4a vs opus).
+    assert key(mode="audio_mp3", container="mp4") == key(mode="audio_mp3", container="webm")
+    assert key(mode="audio_mp3").startswith("out:yt:dQw4w9WgXcQ:audio_mp3:mp3:")
+    assert key(mode="audio", container="mp4") != key(mode="audio", container="webm")
+    # Any format id resolves to the best audio.
+    assert key(mode="audio", format_id="137") == key(mode="audio", format_id="best")
+
+
+def test_reuse_points_new_jobs_at_the_file(tmp_path) -> None:
+    path = tmp_path / "job-a-Title.mp4"
+    path.write_bytes(b"x")
+    publish_output(key(), path=str(path), title="Title", job_id="a")
+
+    patch = reuse_output(key(), "b")
+    assert patch is not None
+    assert (patch["status"], patch["file_path"], patch["file_name"]) == ("finished", str(path), path.name)
+    assert live_refs(str(path)) == 2
+    assert reuse_output(key(container="mkv"), "c") is None
+
+
+def test_missing_file_is_dropped_from_the_index(tmp_path) -> None:
+    path = tmp_path / "job-a-Title.mp4"
+    path.write_bytes(b"x")
+    publish_output(key(), path=str(path), title="Title", job_id="a")
+    os.remove(path)
+
+    assert reuse_output(key(), "b") is None
+    assert redis_conn().get(key()) is None
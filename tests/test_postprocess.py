@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from app import postprocess
+
+VIDEO = {"path": "/data/j.f137.mp4", "video": True}
+AUDIO = {"path": "/data/j.f140.m4a", "video": False}
+
+
+def args_after_inputs(cmd: list[str]) -> list[str]:
+    last_input = max(i for i, arg in enumerate(cmd) if arg == "-i")
+    return cmd[last_input + 2 :]
+
+
+def test_merge_copies_video_and_audio() -> None:
+    cmd = postprocess.command([VIDEO, AUDIO], "/data/j.mp4", processing="merge", ext="mp4")
+    assert cmd[:6] == ["ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "error", "-y"]
+    assert cmd[6:10] == ["-i", VIDEO["path"], "-i", AUDIO["path"]]
+    assert args_after_inputs(cmd) == [
+        "-map", "0:v:0", "-map", "1:a:0", "-c", "copy", "-movflags", "+faststart", "-f", "mp4", "/data/j.mp4",
+    ]
+
+
+def test_merge_finds_the_video_input_in_any_order() -> None:
+    cmd = postprocess.command([AUDIO, VIDEO], "/data/j.mkv", processing="merge", ext="mkv")
+    assert args_after_inputs(cmd) == ["-map", "1:v:0", "-map", "0:a:0", "-c", "copy", "-f", "matroska", "/data/j.mkv"]
+
+
+def test_remux() -> None:
+    cmd = postprocess.command([VIDEO], "/data/j.mkv", processing="remux", ext="mkv")
+    assert args_after_inputs(cmd) == ["-map", "0:v:0", "-map", "0:a:0?", "-c", "copy", "-f", "matroska", "/data/j.mkv"]
+
+    cmd = postprocess.command([{"path": "/data/j.f251.webm", "video": False}], "/data/j.opus", processing="remux",
+                              ext="opus")
+    assert args_after_inputs(cmd) == ["-map", "0:a:0", "-vn", "-c", "copy", "-f", "opus", "/data/j.opus"]
+
+
+def test_transcode_to_mp3() -> None:
+    cmd = postprocess.command([AUDIO], "/data/j.mp3", processing="transcode", ext="mp3")
+    assert args_after_inputs(cmd) == [
+        "-map", "0:a:0", "-vn", "-c:a", "libmp3lame", "-q:a", "0", "-f", "mp3", "/data/j.mp3",
+    ]
+
+
+def test_handoff_needs_concrete_streams() -> None:
+    merge = {"processing": "merge", "video": {"format_id": "137"}, "audio": {"format_id": "140"}}
+    assert postprocess.wants_handoff(merge)
+    assert postprocess.raw_format(merge) == "137,140"
+    assert postprocess.raw_ids(merge) == ["137", "140"]
+
+    assert not postprocess.wants_handoff({"processing": "merge", "video": {"format_id": "137"}})
+    assert not postprocess.wants_handoff({"processing": "none", "video": {"format_id": "18"}})
+    assert not postprocess.wants_handoff({"processing": "auto"})
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import time
+
+import pytest
+from rq.job import Job
+
+from app import queueing
+from app.outputs import _inflight_key, output_key, release_inflight, settle_followers
+from app.store import get_state, redis_conn, set_state
+
+JOB = {"url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ", "format_id": "h:720", "container": "mp4", "mode": "auto"}
+
+
+@pytest.fixture(autouse=True)
+def download_dir(tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(queueing.settings, "download_dir", str(tmp_path))
+
+
+@pytest.mark.parametrize(
+    ("mode", "duration", "lane"),
+    [
+        ("auto", None, "normal"),
+        ("auto", 1200, "normal"),
+        ("auto", 120, "short"),
+        # Audio of unknown length may be long: it must not get the short timeout.
+        ("audio_mp3", None, "normal"),
+        ("audio_mp3", 1200, "short"),
+        ("audio", 1200, "short"),
+        ("auto", 3600, "long"),
+        # Long audio is still long: its transfer takes as long as a video's.
+        ("audio_mp3", 7200, "long"),
+    ],
+)
+def test_classify_lane(mode: str, duration: float | None, lane: str) -> None:
+    assert queueing.classify_lane(mode=mode, duration=duration) == lane
+
+
+def test_jobs_go_to_their_lane_with_its_timeout() -> None:
+    job_id = queueing.enqueue_download(**JOB, duration=5 * 3600)
+    assert queueing.get_job_state(job_id)["lane"] == "long"
+    assert queueing.q("long").job_ids == [job_id]
+    assert queueing.q("long").fetch_job(job_id).timeout == queueing.settings.lane_long_timeout_seconds
+
+
+def test_identical_request_follows_a_queued_job() -> None:
+    leader = queueing.enqueue_download(**JOB)
+    follower = queueing.enqueue_download(**JOB)
+    assert get_state(follower)["leader_id"] == leader
+    assert len(queueing.q()) == 1
+
+    set_state(leader, {"status": "downloading", "progress": 40})
+    assert queueing.get_job_state(follower)["progress"] == 40
+
+
+def test_followers_get_the_leaders_outcome() -> None:
+    leader = queueing.enqueue_download(**JOB)
+    follower = queueing.enqueue_download(**JOB)
+    outcome = {"status": "finished", "progress": 100, "file_path": "/data/x.mp4", "file_name": "x.mp4"}
+    set_state(leader, outcome)
+    settle_followers(leader, outcome)
+
+    state = queueing.get_job_state(follower)
+    assert (state["status"], state["file_path"]) == ("finished", "/data/x.mp4")
+    assert state["download_url"] == f"/download/{follower}"
+
+
+def test_settled_leader_claim_is_taken_over() -> None:
+    leader = queueing.enqueue_download(**JOB)
+    set_state(leader, {"status": "failed"})
+
+    retry = queueing.enqueue_download(**JOB)
+    assert "leader_id" not in get_state(retry)
+    assert redis_conn().get(_inflight_key(output_key(**JOB))) == retry
+
+
+def test_dead_leader_is_taken_over() -> None:
+    leader = queueing.enqueue_download(**JOB)
+    follower = queueing.enqueue_download(**JOB)
+
+    # Started on a worker that has since been killed (its key expired).
+    job = Job.fetch(leader, connection=queueing.rq_conn())
+    job.set_status("started")
+    job.worker_name = "gone"
+    job.save()
+
+    new = queueing.enqueue_download(**JOB)
+    assert "leader_id" not in get_state(new)
+    assert redis_conn().get(_inflight_key(output_key(**JOB))) == new
+    assert get_state(follower)["leader_id"] == new
+
+
+def test_leader_about_to_enqueue_is_followed() -> None:
+    redis_conn().set(_inflight_key(output_key(**JOB)), "fresh")
+    set_state("fresh", {"status": "queued", "timings": {"queued": time.time()}})
+    assert get_state(queueing.enqueue_download(**JOB))["leader_id"] == "fresh"
+
+
+def test_state_is_written_before_the_claim(monkeypatch: pytest.MonkeyPatch) -> None:
+    states = []
+    claim_inflight = queueing.claim_inflight
+
+    def claim(key: str, job_id: str) -> str:
+        states.append(get_state(job_id))
+        return claim_inflight(key, job_id)
+
+    monkeypatch.setattr(queueing, "claim_inflight", claim)
+    queueing.enqueue_download(**JOB)
+    assert states[0]["status"] == "queued"
+    assert states[0]["timings"]["queued"]
+
+
+def test_never_enqueues_without_the_claim(monkeypatch: pytest.MonkeyPatch) -> None:
+    # Every attempt loses the claim to a request that turns out to be stale.
+    stale = iter(range(10))
+    monkeypatch.setattr(queueing, "claim_inflight", lambda key, job_id: f"stale-{next(stale)}")
+
+    job_id = queueing.enqueue_download(**JOB)
+    assert get_state(job_id)["status"] == "failed"
+    assert all(len(queueing.q(lane)) == 0 for lane in queueing.LANE_QUEUES)
+
+
+def test_only_the_holder_releases_a_claim() -> None:
+    key = output_key(**JOB)
+    leader = queueing.enqueue_download(**JOB)
+    release_inflight(key, "someone-else")
+    assert redis_conn().get(_inflight_key(key)) == leader
+    release_inflight(key, leader)
+    assert redis_conn().get(_inflight_key(key)) is None
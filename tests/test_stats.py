@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from app.stats import phase_durations
+
+
+def test_single_job() -> None:
+    timings = {
+        "queued": 100.0,
+        "started": 101.5,
+        "extracted": 102.0,
+        "download_started": 102.1,
+        "download_finished": 110.1,
+        "postprocess_started": 110.2,
+        "postprocess_finished": 112.0,
+        "finished": 112.1,
+    }
+    assert phase_durations(timings) == {
+        "queue": 1.5,
+        "extract": 0.5,
+        "download": 8.0,
+        "postprocess": 1.8,
+        "total": 12.1,
+    }
+
+
+def test_handoff_adds_the_postprocess_queue() -> None:
+    timings = {"queued": 0.0, "download_finished": 5.0, "handoff": 5.0, "postprocess_started": 9.25}
+    assert phase_durations(timings) == {"postprocess_queue": 4.25}
+
+
+def test_missing_or_backwards_timestamps_are_skipped() -> None:
+    assert phase_durations({}) == {}
+    assert phase_durations({"queued": 10.0, "started": 9.0}) == {}
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import json
+
+import pytest
+
+from app import store
+from app.store import ProgressWriter, get_state, job_key, redis_conn, set_state
+
+
+@pytest.fixture
+def writes(monkeypatch: pytest.MonkeyPatch) -> list[dict]:
+    seen: list[dict] = []
+    real = store.set_state
+
+    def set_state(job_id: str, patch: dict, **kwargs) -> None:
+        seen.append(dict(patch))
+        real(job_id, patch, **kwargs)
+
+    monkeypatch.setattr(store, "set_state", set_state)
+    return seen
+
+
+def test_set_state_merges_fields() -> None:
+    set_state("j", {"status": "queued", "progress": 0, "url": "u"})
+    set_state("j", {"progress": 50, "message": "half"})
+    state = get_state("j")
+    assert state is not None
+    assert (state["status"], state["progress"], state["message"], state["url"]) == ("queued", 50, "half", "u")
+    assert state["created_at"] <= state["updated_at"]
+    assert redis_conn().ttl(job_key("j")) > 0
+
+
+def test_legacy_json_states_are_migrated() -> None:
+    redis_conn().set(job_key("old"), json.dumps({"status": "finished", "file_path": "/data/x.mp4"}))
+    assert get_state("old") == {"status": "finished", "file_path": "/data/x.mp4"}
+    set_state("old", {"progress": 100})
+    assert redis_conn().type(job_key("old")) == "hash"
+    assert get_state("old")["file_path"] == "/data/x.mp4"
+
+
+def test_progress_is_coalesced_until_the_interval(writes: list[dict]) -> None:
+    w = ProgressWriter("j", interval=60)
+    w.update({"status": "downloading", "progress": 1})
+    for pct in range(2, 50):
+        w.update({"status": "downloading", "progress": pct, "message": f"{pct}%"})
+    # Only the status change went out; the latest progress waits.
+    assert writes == [{"status": "downloading", "progress": 1}]
+    assert get_state("j")["progress"] == 1
+
+    w.flush()
+    assert writes[-1] == {"status": "downloading", "progress": 49, "message": "49%"}
+    w.flush()
+    assert len(writes) == 2
+
+
+def test_status_changes_and_terminal_states_are_written_at_once(writes: list[dict]) -> None:
+    w = ProgressWriter("j", interval=60)
+    w.update({"status": "downloading", "progress": 1})
+    w.update({"progress": 90})
+    w.update({"status": "processing"})
+    assert writes[-1] == {"progress": 90, "status": "processing"}
+
+    w.update({"progress": 99})
+    w.update({"status": "finished", "progress": 100, "file_path": "/data/x.mp4"})
+    assert writes[-1] == {"progress": 100, "status": "finished", "file_path": "/data/x.mp4"}
+    assert get_state("j")["status"] == "finished"
+
+
+def test_interval_elapsed_writes_progress(writes: list[dict]) -> None:
+    w = ProgressWriter("j", interval=0)
+    w.update({"status": "downloading", "progress": 1})
+    w.update({"progress": 2})
+    assert writes == [{"status": "downloading", "progress": 1}, {"progress": 2}]
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+from typing import Any
+
+from app.yt_meta import plan_formats
+
+FORMATS: list[dict[str, Any]] = [
+    {"format_id": "139", "vcodec": "none", "acodec": "mp4a.40.5", "ext": "m4a", "abr": 48, "protocol": "https"},
+    {"format_id": "140", "vcodec": "none", "acodec": "mp4a.40.2", "ext": "m4a", "abr": 129, "protocol": "https"},
+    {"format_id": "140-drc", "vcodec": "none", "acodec": "mp4a.40.2", "ext": "m4a", "abr": 129, "protocol": "https"},
+    {"format_id": "251", "vcodec": "none", "acodec": "opus", "ext": "webm", "abr": 135, "protocol": "https"},
+    {"format_id": "18", "vcodec": "avc1.42001E", "acodec": "mp4a.40.2", "ext": "mp4", "height": 360, "fps": 30,
+     "tbr": 500, "protocol": "https"},
+    {"format_id": "134", "vcodec": "avc1.4d401e", "acodec": "none", "ext": "mp4", "height": 360, "fps": 30,
+     "tbr": 300, "protocol": "https"},
+    {"format_id": "137", "vcodec": "avc1.640028", "acodec": "none", "ext": "mp4", "height": 1080, "fps": 30,
+     "tbr": 4000, "protocol": "https"},
+    {"format_id": "248", "vcodec": "vp9", "acodec": "none", "ext": "webm", "height": 1080, "fps": 30, "tbr": 2500,
+     "protocol": "https"},
+    {"format_id": "96", "vcodec": "avc1.640028", "acodec": "mp4a.40.2", "ext": "mp4", "height": 1080, "fps": 30,
+     "tbr": 5000, "protocol": "m3u8_native"},
+]
+INFO = {"formats": FORMATS}
+
+
+def plan(format_id: str, *, mode: str = "auto", container: str = "mp4", **kwargs: Any) -> dict[str, Any]:
+    return plan_formats(INFO, format_id=format_id, mode=mode, container=container, **kwargs)
+
+
+def test_merges_codecs_the_container_carries() -> None:
+    p = plan("h:1080")
+    assert p["format"] == "137+140/bestvideo[height<=1080]+bestaudio/best"
+    assert p["processing"] == "merge"
+    assert (p["video"]["format_id"], p["audio"]["format_id"], p["ext"]) == ("137", "140", "mp4")
+
+
+def test_webm_picks_vp9_and_opus() -> None:
+    p = plan("h:1080", container="webm")
+    assert (p["video"]["format_id"], p["audio"]["format_id"]) == ("248", "251")
+
+
+def test_skips_hls_combined_formats() -> None:
+    assert plan("h:1080")["video"]["format_id"] != "96"
+
+
+def test_combined_file_in_its_own_container_needs_nothing() -> None:
+    p = plan("h:360")
+    assert p["format"] == "18/bestvideo[height<=360]+bestaudio/best"
+    assert p["processing"] == "none"
+    assert "audio" not in p
+
+
+def test_combined_file_in_another_container_is_remuxed() -> None:
+    p = plan("h:360", container="mkv")
+    assert p["video"]["format_id"] == "18"
+    assert (p["processing"], p["ext"]) == ("remux", "mkv")
+
+
+def test_explicit_video_id_gets_a_matching_audio_stream() -> None:
+    selected = next(f for f in FORMATS if f["format_id"] == "137")
+    p = plan("137", selected=selected)
+    assert p["format"] == "137+140/137+bestaudio/best"
+    assert p["processing"] == "merge"
+
+
+def test_audio_mp3_transcodes_the_best_audio() -> None:
+    p = plan("bestaudio", mode="audio_mp3")
+    assert p["format"] == "251/bestaudio/best"
+    assert (p["processing"], p["ext"]) == ("transcode", "mp3")
+
+
+def test_native_audio_prefers_the_container_codec() -> None:
+    p = plan("bestaudio", mode="audio", container="mp4")
+    assert p["audio"]["format_id"] == "140"
+    assert (p["audio_codec"], p["ext"], p["processing"]) == ("m4a", "m4a", "none")
+
+    p = plan("bestaudio", mode="audio", container="webm")
+    assert p["audio"]["format_id"] == "251"
+    assert (p["audio_codec"], p["ext"], p["processing"]) == ("opus", "opus", "remux")
+
+
+def test_no_formats_leaves_it_to_yt_dlp() -> None:
+    p = plan_formats({}, format_id="best", mode="auto", container="mp4")
+    assert p == {"format": "bestvideo+bestaudio/best", "processing": "auto"}
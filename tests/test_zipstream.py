@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import io
+import zipfile
+
+import pytest
+from fastapi import Request
+
+from app.zipstream import ZipBundle, _parse_range, archive_name, deliver_zip
+
+
+@pytest.fixture
+def files(tmp_path) -> list[tuple[str, str]]:
+    out = []
+    for i, size in enumerate((0, 1, 70_000, 300_000)):
+        path = tmp_path / f"f{i}.bin"
+        path.write_bytes(bytes((i * 7 + n) % 251 for n in range(size)))
+        out.append((str(path), f"clip {i}.mp4"))
+    return out
+
+
+def body(bundle: ZipBundle, start: int, end: int) -> bytes:
+    return b"".join(bundle.iter_range(start, end))
+
+
+def request(headers: dict[str, str]) -> Request:
+    raw = [(k.lower().encode(), v.encode()) for k, v in headers.items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw, "query_string": b""})
+
+
+def test_archive_matches_the_computed_size(files) -> None:
+    bundle = ZipBundle(files)
+    data = body(bundle, 0, bundle.size)
+    assert len(data) == bundle.size
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == [name for _, name in files]
+        for path, name in files:
+            with open(path, "rb") as f:
+                assert zf.read(name) == f.read()
+
+
+def test_any_range_is_a_slice_of_the_whole(files) -> None:
+    bundle = ZipBundle(files)
+    whole = body(bundle, 0, bundle.size)
+    cd = bundle.cd_offset
+    first_data = bundle.entries[0].local_len
+    for start, end in [
+        (0, 1),
+        (0, first_data + 1),
+        (first_data - 3, first_data + 5),
+        (bundle.entries[2].offset + 10, bundle.entries[3].offset + 10),
+        (cd - 1, cd + 1),
+        (cd + 5, bundle.size),
+        (bundle.size - 1, bundle.size),
+    ]:
+        assert body(bundle, start, end) == whole[start:end], (start, end)
+
+
+def test_crcs_are_cached_per_file_version(files) -> None:
+    first = ZipBundle(files)
+    body(first, 0, first.size)
+    again = ZipBundle(files)
+    assert [e.crc for e in again.entries] == [e.crc for e in first.entries]
+    assert again.etag == first.etag
+
+
+@pytest.mark.parametrize(
+    ("header", "expected"),
+    [
+        ("bytes=0-99", (0, 100)),
+        ("bytes=100-", (100, 1000)),
+        ("bytes=-100", (900, 1000)),
+        ("bytes=-5000", (0, 1000)),
+        ("bytes=990-5000", (990, 1000)),
+        ("bytes=1000-", (1000, 1000)),
+        ("bytes=-", None),
+        ("bytes=0-1,5-6", None),
+        ("items=0-1", None),
+    ],
+)
+def test_parse_range(header: str, expected: tuple[int, int] | None) -> None:
+    assert _parse_range(header, 1000) == expected
+
+
+def test_deliver_zip_ranges_and_validators(files) -> None:
+    full = deliver_zip(request({}), files, "batch.zip")
+    size = int(full.headers["content-length"])
+    etag = full.headers["etag"]
+    assert full.status_code == 200
+
+    partial = deliver_zip(request({"Range": "bytes=10-19"}), files, "batch.zip")
+    assert partial.status_code == 206
+    assert partial.headers["content-range"] == f"bytes 10-19/{size}"
+    assert partial.headers["content-length"] == "10"
+
+    assert deliver_zip(request({"Range": f"bytes={size}-"}), files, "batch.zip").status_code == 416
+    assert deliver_zip(request({"If-None-Match": etag}), files, "batch.zip").status_code == 304
+    # A stale If-Range validator gets the whole archive.
+    stale = deliver_zip(request({"Range": "bytes=10-19", "If-Range": '"zip-old"'}), files, "batch.zip")
+    assert stale.status_code == 200
+
+
+def test_archive_names_drop_the_job_id_and_stay_unique() -> None:
+    taken: set[str] = set()
+    job = "0f8fad5b-d9cb-469f-a165-70867728950e"
+    assert archive_name(f"/data/{job}-Song.mp3", taken) == "Song.mp3"
+    assert archive_name(f"/data/{job}-Song.mp3", taken) == "Song (2).mp3"
+    assert archive_name("", taken) == "download"